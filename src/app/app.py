@@ -1,5 +1,7 @@
 from dash import Dash, html, dcc
 from dash.long_callback import DiskcacheLongCallbackManager
+from flask import jsonify
+from os import getenv
 import diskcache
 
 # map layout imports
@@ -9,6 +11,30 @@ from app.layout.data_viewer import build_layout_data_viewer, callbacks_data_view
 from app.layout.nina_warnings import build_layout_nina_warnings, callbacks_nina_warnings
 from app.layout.config import build_layout_config, callbacks_config
 from app.layout.text_geolocation import build_layout_text_geolocation, callbacks_text_geolocation
+from data.connect import get_engine, pool_status
+from data.metrics import instrument_engine, tagged, get_sql_metrics, start_metrics_logger
+from app.tiles import register_tile_routes
+
+def instrument_callbacks(app: Dash):
+    """
+    Count the SQL statements of every callback registered with `app.callback` under the name of the callback function.
+    Background callbacks run in a separate process and are not instrumented.
+    """
+
+    register = app.callback
+
+    def callback(*args, **kwargs):
+        decorator = register(*args, **kwargs)
+
+        if kwargs.get('background', False):
+            return decorator
+
+        def wrapper(func):
+            return decorator(tagged(func))
+
+        return wrapper
+
+    app.callback = callback
 
 def get_app():
 
@@ -78,6 +104,10 @@ def get_app():
         style={'display': 'flex', 'flex-wrap': 'wrap'}
     )
 
+    # record the SQL statements of each callback, see /metrics
+    instrument_engine(get_engine())
+    instrument_callbacks(app)
+
     # link the callbacks
     callbacks_map(app)
     callbacks_scenario_editor(app)
@@ -86,4 +116,20 @@ def get_app():
     callbacks_config(app)
     callbacks_text_geolocation(app)
 
+    # connection pool statistics, used to size DB_POOL_SIZE and DB_MAX_OVERFLOW under load
+    @app.server.route('/pool-status')
+    def route_pool_status():
+        return jsonify(pool_status())
+
+    # SQL statistics per callback: statement count, time, rows and the slowest statement
+    @app.server.route('/metrics')
+    def route_sql_metrics():
+        return jsonify(get_sql_metrics())
+
+    # vector tiles of the map layers, see app/tiles.py
+    register_tile_routes(app.server)
+
+    # print a summary of the SQL statistics every SQL_METRICS_INTERVAL seconds, 0 disables it
+    start_metrics_logger(int(getenv('SQL_METRICS_INTERVAL', 300)))
+
     return app
\ No newline at end of file
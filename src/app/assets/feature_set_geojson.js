@@ -0,0 +1,75 @@
+// Style, point to layer and popup functions of the dl.GeoJSON components that hold all features of a FeatureSet.
+// The Style of the FeatureSet is passed in the hideout of the component, see style_to_hideout() in src/app/convert.py.
+// The features are drawn like the per feature components of create_geojson() and create_awesome_marker().
+(function () {
+
+    function getHideout(context) {
+        return (context && (context.hideout || (context.props && context.props.hideout))) || {};
+    }
+
+    function parseHex(color) {
+        var match = /^#?([0-9a-f]{2})([0-9a-f]{2})([0-9a-f]{2})/i.exec(color || '');
+        if (!match) return null;
+        return [parseInt(match[1], 16), parseInt(match[2], 16), parseInt(match[3], 16)];
+    }
+
+    function toHex(rgb) {
+        return '#' + rgb.map(function (c) {
+            var hex = Math.round(c).toString(16);
+            return hex.length === 1 ? '0' + hex : hex;
+        }).join('');
+    }
+
+    // the same linear colormap as branca's LinearColormap in style_to_dict_colormap(), values outside the range are clamped
+    function colormapColor(colormap, properties) {
+        var value = Number((properties || {})[colormap.property] || 0);
+        var range = colormap.max_value - colormap.min_value;
+        var t = range ? (value - colormap.min_value) / range : 0;
+        t = Math.max(0, Math.min(1, t));
+
+        var min = parseHex(colormap.min_color), max = parseHex(colormap.max_color);
+        if (!min || !max) return t < 0.5 ? colormap.min_color : colormap.max_color;
+
+        return toHex([0, 1, 2].map(function (i) { return min[i] + (max[i] - min[i]) * t; }));
+    }
+
+    window.featureSetGeoJSON = {
+
+        style: function (feature, context) {
+            var hideout = getHideout(context);
+            var style = Object.assign({}, hideout.style || {});
+
+            if (hideout.colormap) {
+                var color = colormapColor(hideout.colormap, feature.properties);
+                style.color = color;
+                style.fillColor = color;
+            }
+
+            return style;
+        },
+
+        pointToLayer: function (feature, latlng, context) {
+            var hideout = getHideout(context);
+
+            var icon = L.divIcon({
+                html: '<i class="awesome-marker awesome-marker-icon-' + hideout.marker_color + ' leaflet-zoom-animated leaflet-interactive"></i>' +
+                    '<i class="fa fa-' + hideout.marker_icon + ' icon-white" aria-hidden="true" style="position: relative; top: 33% !important; left: 37% !important; transform: translate(-50%, -50%) scale(1.2);"></i>',
+                className: 'custom-div-icon',
+                iconSize: [20, 20],
+                iconAnchor: [10, 30],
+                tooltipAnchor: [10, -20],
+                popupAnchor: [-3, -31]
+            });
+
+            return L.marker(latlng, {icon: icon});
+        },
+
+        // the popup html is part of the payload feature, see popup_html() in src/data/payloads.py
+        onEachFeature: function (feature, layer) {
+            if (feature.popup) {
+                layer.bindPopup(feature.popup);
+            }
+        }
+    };
+
+})();
@@ -0,0 +1,357 @@
+// A small Leaflet layer for Mapbox Vector Tiles, used by assets/vector_tiles.js instead of loading Leaflet.VectorGrid from a CDN.
+// It decodes the tiles of /tiles/<layer_id>/<z>/<x>/<y>.pbf (see src/app/tiles.py), draws them on one canvas per tile
+// and fires 'click' with {layer: {properties}, latlng} for the feature under the cursor, like L.vectorGrid.protobuf.
+// Only what the map needs is supported: one style (object or function(properties, zoom, dimension)) per MVT layer.
+// Usage: window.mvtLayer(url, {vectorTileLayerStyles: {fs_<id>: style}}), the url contains {z}, {x} and {y}.
+(function () {
+
+    var GEOMETRY_POINT = 1, GEOMETRY_LINE = 2, GEOMETRY_POLYGON = 3;
+
+    // protobuf decoding, see https://protobuf.dev/programming-guides/encoding/
+
+    function Reader(bytes) {
+        this.bytes = bytes;
+        this.pos = 0;
+    }
+
+    Reader.prototype.varint = function () {
+        var value = 0, factor = 1, byte;
+        do {
+            byte = this.bytes[this.pos++];
+            value += (byte & 0x7f) * factor;
+            factor *= 128;
+        } while (byte & 0x80);
+        return value;
+    };
+
+    Reader.prototype.sint = function () {
+        var value = this.varint();
+        return value % 2 === 1 ? (value + 1) / -2 : value / 2;
+    };
+
+    Reader.prototype.sub = function () {
+        var length = this.varint();
+        var reader = new Reader(this.bytes.subarray(this.pos, this.pos + length));
+        this.pos += length;
+        return reader;
+    };
+
+    Reader.prototype.string = function () {
+        var reader = this.sub();
+        return new TextDecoder('utf-8').decode(reader.bytes);
+    };
+
+    Reader.prototype.packed = function () {
+        var reader = this.sub(), values = [];
+        while (reader.pos < reader.bytes.length) values.push(reader.varint());
+        return values;
+    };
+
+    Reader.prototype.float = function () {
+        var value = new DataView(this.bytes.buffer, this.bytes.byteOffset + this.pos, 4).getFloat32(0, true);
+        this.pos += 4;
+        return value;
+    };
+
+    Reader.prototype.double = function () {
+        var value = new DataView(this.bytes.buffer, this.bytes.byteOffset + this.pos, 8).getFloat64(0, true);
+        this.pos += 8;
+        return value;
+    };
+
+    Reader.prototype.skip = function (wireType) {
+        if (wireType === 0) this.varint();
+        else if (wireType === 1) this.pos += 8;
+        else if (wireType === 2) this.pos += this.varint();
+        else if (wireType === 5) this.pos += 4;
+        else throw new Error('Unsupported wire type ' + wireType);
+    };
+
+    // calls fn(field, wireType) for every field of the message, fn returns false if it did not read the field
+    Reader.prototype.fields = function (fn) {
+        while (this.pos < this.bytes.length) {
+            var key = this.varint();
+            if (fn(Math.floor(key / 8), key & 7) === false) this.skip(key & 7);
+        }
+    };
+
+    // the MVT messages, see https://github.com/mapbox/vector-tile-spec/blob/master/2.1/vector_tile.proto
+
+    function readValue(reader) {
+        var value = null;
+        reader.fields(function (field) {
+            if (field === 1) value = reader.string();
+            else if (field === 2) value = reader.float();
+            else if (field === 3) value = reader.double();
+            else if (field === 4 || field === 5) value = reader.varint();
+            else if (field === 6) value = reader.sint();
+            else if (field === 7) value = reader.varint() !== 0;
+            else return false;
+        });
+        return value;
+    }
+
+    function readGeometry(commands, scale) {
+        var rings = [], ring = null, x = 0, y = 0, i = 0;
+
+        while (i < commands.length) {
+            var command = commands[i] & 7, count = Math.floor(commands[i] / 8);
+            i++;
+
+            if (command === 7) {
+                if (ring && ring.length) ring.push(ring[0]);
+                continue;
+            }
+
+            for (var n = 0; n < count; n++) {
+                var dx = commands[i++], dy = commands[i++];
+                x += dx % 2 === 1 ? (dx + 1) / -2 : dx / 2;
+                y += dy % 2 === 1 ? (dy + 1) / -2 : dy / 2;
+
+                if (command === 1) {
+                    ring = [];
+                    rings.push(ring);
+                }
+                ring.push([x * scale, y * scale]);
+            }
+        }
+
+        return rings;
+    }
+
+    function readLayer(reader, tileSize) {
+        var layer = {name: null, extent: 4096, keys: [], values: [], features: []};
+
+        reader.fields(function (field) {
+            if (field === 1) layer.name = reader.string();
+            else if (field === 2) layer.features.push(reader.sub());
+            else if (field === 3) layer.keys.push(reader.string());
+            else if (field === 4) layer.values.push(readValue(reader.sub()));
+            else if (field === 5) layer.extent = reader.varint();
+            else return false;
+        });
+
+        // the features refer to the keys and values of the layer, which may come after them
+        var scale = tileSize / layer.extent;
+
+        layer.features = layer.features.map(function (featureReader) {
+            var feature = {id: null, type: 0, properties: {}, rings: []};
+            var tags = [], commands = [];
+
+            featureReader.fields(function (field) {
+                if (field === 1) feature.id = featureReader.varint();
+                else if (field === 2) tags = featureReader.packed();
+                else if (field === 3) feature.type = featureReader.varint();
+                else if (field === 4) commands = featureReader.packed();
+                else return false;
+            });
+
+            for (var i = 0; i + 1 < tags.length; i += 2) {
+                feature.properties[layer.keys[tags[i]]] = layer.values[tags[i + 1]];
+            }
+
+            feature.rings = readGeometry(commands, scale);
+
+            return feature;
+        });
+
+        return layer;
+    }
+
+    function readTile(buffer, tileSize) {
+        var reader = new Reader(new Uint8Array(buffer)), layers = [];
+
+        reader.fields(function (field) {
+            if (field === 3) layers.push(readLayer(reader.sub(), tileSize));
+            else return false;
+        });
+
+        return layers;
+    }
+
+    // drawing and hit testing, the styles use the options of L.Path
+
+    function tracePath(ctx, feature) {
+        ctx.beginPath();
+        feature.rings.forEach(function (ring) {
+            ring.forEach(function (point, i) {
+                if (i === 0) ctx.moveTo(point[0], point[1]);
+                else ctx.lineTo(point[0], point[1]);
+            });
+        });
+    }
+
+    function drawFeature(ctx, feature, style) {
+        if (feature.type === GEOMETRY_POINT) {
+            feature.rings.forEach(function (ring) {
+                ring.forEach(function (point) {
+                    ctx.beginPath();
+                    ctx.arc(point[0], point[1], style.radius || 6, 0, 2 * Math.PI);
+                    fillAndStroke(ctx, style, true);
+                });
+            });
+            return;
+        }
+
+        tracePath(ctx, feature);
+        fillAndStroke(ctx, style, feature.type === GEOMETRY_POLYGON);
+    }
+
+    function fillAndStroke(ctx, style, fill) {
+        if (fill && style.fill !== false) {
+            ctx.globalAlpha = style.fillOpacity !== undefined ? style.fillOpacity : 0.2;
+            ctx.fillStyle = style.fillColor || style.color || '#3388ff';
+            ctx.fill('evenodd');
+        }
+
+        if (style.stroke !== false) {
+            ctx.globalAlpha = style.opacity !== undefined ? style.opacity : 1;
+            ctx.strokeStyle = style.color || '#3388ff';
+            ctx.lineWidth = style.weight !== undefined ? style.weight : 3;
+            ctx.lineCap = ctx.lineJoin = 'round';
+            ctx.setLineDash(style.dashArray ? String(style.dashArray).split(/[ ,]+/).map(Number) : []);
+            ctx.stroke();
+        }
+
+        ctx.globalAlpha = 1;
+    }
+
+    function distanceToSegment(p, a, b) {
+        var dx = b[0] - a[0], dy = b[1] - a[1];
+        var t = dx || dy ? ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / (dx * dx + dy * dy) : 0;
+        t = Math.max(0, Math.min(1, t));
+        return Math.sqrt(Math.pow(p[0] - a[0] - t * dx, 2) + Math.pow(p[1] - a[1] - t * dy, 2));
+    }
+
+    function containsPoint(feature, style, p) {
+        var tolerance = (style.weight !== undefined ? style.weight : 3) / 2 + 3;
+
+        if (feature.type === GEOMETRY_POINT) {
+            return feature.rings.some(function (ring) {
+                return ring.some(function (point) {
+                    return Math.sqrt(Math.pow(p[0] - point[0], 2) + Math.pow(p[1] - point[1], 2)) <= (style.radius || 6) + 2;
+                });
+            });
+        }
+
+        var inside = false;
+
+        for (var r = 0; r < feature.rings.length; r++) {
+            var ring = feature.rings[r];
+
+            for (var i = 1; i < ring.length; i++) {
+                if (distanceToSegment(p, ring[i - 1], ring[i]) <= tolerance) return true;
+
+                // even-odd rule over all rings, so holes are not part of the polygon
+                if (feature.type === GEOMETRY_POLYGON && (ring[i][1] > p[1]) !== (ring[i - 1][1] > p[1]) &&
+                    p[0] < (ring[i - 1][0] - ring[i][0]) * (p[1] - ring[i][1]) / (ring[i - 1][1] - ring[i][1]) + ring[i][0]) {
+                    inside = !inside;
+                }
+            }
+        }
+
+        return inside;
+    }
+
+    // the layer class extends L.GridLayer, it is created on first use because the assets may be loaded before Leaflet
+    var MVTLayer = null;
+
+    function createLayerClass() {
+        return L.GridLayer.extend({
+
+            options: {
+                vectorTileLayerStyles: {}
+            },
+
+            initialize: function (url, options) {
+                this._url = url;
+                this._tileData = {};
+                L.GridLayer.prototype.initialize.call(this, options);
+                this.on('tileunload', function (e) { delete this._tileData[this._tileCoordsToKey(e.coords)]; }, this);
+            },
+
+            onAdd: function (map) {
+                L.GridLayer.prototype.onAdd.call(this, map);
+                map.on('click', this._onClick, this);
+            },
+
+            onRemove: function (map) {
+                map.off('click', this._onClick, this);
+                L.GridLayer.prototype.onRemove.call(this, map);
+            },
+
+            _style: function (layerName, properties, zoom, dimension) {
+                var style = this.options.vectorTileLayerStyles[layerName];
+                if (typeof style === 'function') style = style(properties, zoom, dimension);
+                return style || {};
+            },
+
+            createTile: function (coords, done) {
+                var size = this.getTileSize();
+                var ratio = window.devicePixelRatio || 1;
+                var canvas = document.createElement('canvas');
+                canvas.width = size.x * ratio;
+                canvas.height = size.y * ratio;
+
+                var key = this._tileCoordsToKey(coords);
+                var url = L.Util.template(this._url, {z: coords.z, x: coords.x, y: coords.y});
+                var self = this;
+
+                fetch(url).then(function (response) {
+                    if (!response.ok) throw new Error('HTTP ' + response.status + ' for ' + url);
+                    return response.arrayBuffer();
+                }).then(function (buffer) {
+                    var layers = readTile(buffer, size.x);
+                    var ctx = canvas.getContext('2d');
+                    ctx.scale(ratio, ratio);
+
+                    layers.forEach(function (layer) {
+                        layer.features.forEach(function (feature) {
+                            drawFeature(ctx, feature, self._style(layer.name, feature.properties, coords.z, feature.type));
+                        });
+                    });
+
+                    self._tileData[key] = {coords: coords, layers: layers};
+                    done(null, canvas);
+                }).catch(function (error) {
+                    done(error, canvas);
+                });
+
+                return canvas;
+            },
+
+            // the topmost feature under the click, in the same order as they are drawn
+            _onClick: function (e) {
+                var zoom = this._tileZoom !== undefined ? this._tileZoom : Math.round(this._map.getZoom());
+                var size = this.getTileSize();
+                var pixel = this._map.project(e.latlng, zoom);
+                var coords = L.point(Math.floor(pixel.x / size.x), Math.floor(pixel.y / size.y));
+                coords.z = zoom;
+
+                var data = this._tileData[this._tileCoordsToKey(coords)];
+                if (!data) return;
+
+                var p = [pixel.x - coords.x * size.x, pixel.y - coords.y * size.y];
+
+                for (var l = data.layers.length - 1; l >= 0; l--) {
+                    var layer = data.layers[l];
+
+                    for (var f = layer.features.length - 1; f >= 0; f--) {
+                        var feature = layer.features[f];
+
+                        if (containsPoint(feature, this._style(layer.name, feature.properties, zoom, feature.type), p)) {
+                            this.fire('click', {layer: {properties: feature.properties, id: feature.id}, latlng: e.latlng, originalEvent: e.originalEvent});
+                            return;
+                        }
+                    }
+                }
+            }
+        });
+    }
+
+    window.mvtLayer = function (url, options) {
+        if (!MVTLayer) MVTLayer = createLayerClass();
+        return new MVTLayer(url, options);
+    };
+
+})();
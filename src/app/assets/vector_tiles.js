@@ -0,0 +1,87 @@
+// Shows the selected map layers as vector tile layers (see assets/vector_tile_grid.js), used when the vector_tiles map option is set.
+// The tiles are served by /tiles/<layer_id>/<z>/<x>/<y>.pbf (see src/app/tiles.py), every FeatureSet is a layer inside the tile.
+// Controlled via window.updateVectorTileLayers(layers) with layers = [{layer_id, version, styles, popups}].
+(function () {
+
+    var _layers = {};       // "<layer_id>:<version>" -> window.mvtLayer layer
+    var _pending = null;
+
+    function escapeHtml(value) {
+        return String(value === null || value === undefined ? '' : value)
+            .replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;');
+    }
+
+    // points are drawn as circles in the marker color of their Style
+    function styleFunction(style) {
+        return function (properties, zoom, dimension) {
+            if (dimension === 1) {
+                var color = style.markerColor || style.fillColor || '#3388ff';
+                return {
+                    radius: style.radius || 6, fill: true, fillColor: color, fillOpacity: 0.9,
+                    stroke: true, color: '#ffffff', weight: 1
+                };
+            }
+            return style;
+        };
+    }
+
+    function createLayer(layer) {
+        var layerStyles = {};
+        Object.keys(layer.styles).forEach(function (name) {
+            layerStyles[name] = styleFunction(layer.styles[name]);
+        });
+
+        var grid = window.mvtLayer('/tiles/' + layer.layer_id + '/{z}/{x}/{y}.pbf?v=' + layer.version, {
+            vectorTileLayerStyles: layerStyles
+        });
+
+        // the same popup content as the component layers: the name of the FeatureSet and its popup properties
+        grid.on('click', function (e) {
+            var props = e.layer.properties || {};
+            var popup = (layer.popups || {})['fs_' + props._feature_set];
+            if (!popup) return;
+            var html = '<b>' + escapeHtml(popup.name) + '</b><br>';
+            Object.keys(popup.properties || {}).forEach(function (label) {
+                html += '<b>' + escapeHtml(label) + '</b>: ' + escapeHtml(props[popup.properties[label]]) + '<br>';
+            });
+            L.popup().setLatLng(e.latlng).setContent(html).openOn(window._leafletMap);
+        });
+
+        return grid;
+    }
+
+    function update(layers) {
+        var lmap = window._leafletMap;
+        var wanted = {};
+
+        layers.forEach(function (layer) {
+            var key = layer.layer_id + ':' + layer.version;
+            wanted[key] = true;
+            if (!_layers[key]) {
+                _layers[key] = createLayer(layer);
+                _layers[key].addTo(lmap);
+            }
+        });
+
+        // deselected layers and outdated versions
+        Object.keys(_layers).forEach(function (key) {
+            if (!wanted[key]) {
+                try { _layers[key].remove(); } catch (e) {}
+                delete _layers[key];
+            }
+        });
+    }
+
+    window.updateVectorTileLayers = function (layers) {
+        _pending = layers || [];
+
+        if (!window._leafletMap) {
+            // Map not ready yet — retry shortly
+            setTimeout(function () { window.updateVectorTileLayers(_pending); }, 300);
+            return;
+        }
+
+        update(_pending);
+    };
+
+})();
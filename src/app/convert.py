@@ -1,15 +1,45 @@
+import os
 from typing import Optional
 
 import branca.colormap as cm
 import dash_leaflet as dl
 from datetime import datetime
 from sqlalchemy import func
-from shapely.geometry import mapping
-from shapely.wkb import loads
+from sqlalchemy.orm import object_session
+from dotenv import load_dotenv
 
 # internal imports
-from data.model import Base, Feature, FeatureSet, Collection, Dataset, Layer, Style, Colormap, Scenario
-from data.connect import autoconnect_db
+from data.model import GEOMETRY_LEVELS, Base, FeatureSet, Collection, Dataset, Layer, Style, Colormap, Scenario
+from data.connect import session_scope
+from data.payloads import get_payload, get_viewport_features
+from app.layer_cache import layer_group_cache, layer_cache_key
+
+# the settings below are read on import, load them from .env first
+load_dotenv()
+
+# set to True to build one dl.GeoJSON per FeatureSet instead of one component per feature by default, see feature_set_to_geojson()
+MAP_FEATURE_SET_GEOJSON = os.getenv('MAP_FEATURE_SET_GEOJSON', 'false').lower() in ('1', 'true', 'yes')
+
+# the most features of a FeatureSet that are loaded for the map viewport, the ones closest to its center are loaded first
+MAP_MAX_FEATURES = int(os.getenv('MAP_MAX_FEATURES', '5000'))
+
+# FeatureSets whose features are clicked by callbacks in the frontend, they need one component with its own id per feature
+PER_FEATURE_FEATURE_SETS = ['Events', 'Predictions']
+
+def geometry_level(zoom: Optional[float] = None) -> str:
+    """
+    Returns the name of the geometry column of Feature to display at the map zoom level `zoom`, see GEOMETRY_LEVELS.
+    Without a zoom level, the original geometry is used.
+    """
+
+    if zoom is None:
+        return 'geometry'
+
+    for column, max_zoom, _ in GEOMETRY_LEVELS:
+        if zoom < max_zoom:
+            return column
+
+    return 'geometry'
 
 def style_to_dict(style: Style) -> dict:
     """
@@ -34,11 +64,12 @@ def style_to_dict(style: Style) -> dict:
 
     return style_dict
 
-def style_to_dict_colormap(style: Style, feature: Feature) -> dict:
+def style_to_dict_colormap(style: Style, feature: dict) -> dict:
     """
     Convert a Style from the database to a dictionary that can be used by dash-leaflet.
     See the [leaflet docs](https://leafletjs.com/reference.html#path)
     This function is used specifically for features that have a colormap
+    - feature: a feature of a FeatureSet payload, see data/payloads.py
     """
 
     style_dict_base = style_to_dict(style)
@@ -52,7 +83,7 @@ def style_to_dict_colormap(style: Style, feature: Feature) -> dict:
     colormap_max_color = colormap.max_color
 
     # get the value of the colormap property
-    properties = feature.properties
+    properties = feature['properties'] or {}
     colormap_value = properties.get(colormap_property, 0)
 
     # create the colormap
@@ -71,33 +102,25 @@ def style_to_dict_colormap(style: Style, feature: Feature) -> dict:
 
     return style_dict_base
 
-def get_lat_long(feature: Feature) -> tuple:
+def get_lat_long(feature: dict) -> list:
     """
     Get the latitude and longitude of a feature, if its geometry type is 'Point' or 'MultiPoint'
-    returns a tuple of (lat, long)
+    returns a list of (lat, long) tuples
+    - feature: a feature of a FeatureSet payload, see data/payloads.py
     """
 
-    assert feature.geometry_type in ['Point', 'MultiPoint'], 'Features geometry_type must be "Point" or "MultiPoint"'
-
-    # save the coordinates in here
-    coordinates = []
+    geometry = feature['geometry']
+    geometry_type = geometry['type']
 
-    geometry = feature.geometry
-    geometry_type = feature.geometry_type
-    shapely_geometry = loads(bytes(geometry.data), hex=True)
+    assert geometry_type in ['Point', 'MultiPoint'], 'Features geometry_type must be "Point" or "MultiPoint"'
 
+    # GeoJSON coordinates are (long, lat)
     if geometry_type == 'Point':
-        coordinate = (shapely_geometry.y, shapely_geometry.x)
-        coordinates.append(coordinate)
-    
-    if geometry_type == 'MultiPoint':
-        for point in shapely_geometry.geoms:
-            coordinate = (point.y, point.x)
-            coordinates.append(coordinate)
+        return [(geometry['coordinates'][1], geometry['coordinates'][0])]
 
-    return coordinates
+    return [(point[1], point[0]) for point in geometry['coordinates']]
 
-def create_marker(feature: Feature, popup=None) -> dl.Marker:
+def create_marker(feature: dict, feature_set: FeatureSet, popup=None) -> dl.Marker:
     """
     Create a simple dash-leaflet Marker from a feature.
     Don't use this, use create_awesome_marker() instead (much cooler)
@@ -107,13 +130,6 @@ def create_marker(feature: Feature, popup=None) -> dl.Marker:
 
     children = []
 
-    # get the style of the feature
-    style = feature.feature_set.style
-
-    if style is not None:
-        icon = style.icon_name
-        color = style.color
-
     if popup is not None:
         children.append(dl.Popup(content=popup))
 
@@ -124,25 +140,18 @@ def create_marker(feature: Feature, popup=None) -> dl.Marker:
 
     return marker
 
-def create_geojson(feature: Feature, popup=None) -> dl.GeoJSON:
+def create_geojson(feature: dict, feature_set: FeatureSet, popup=None) -> dl.GeoJSON:
     """
-    Create a dash-leaflet GeoJSON object from a database Feature.
+    Create a dash-leaflet GeoJSON object from a feature of a FeatureSet payload (see data/payloads.py).
     """
 
-    properties = feature.properties
-    geometry_type = feature.geometry_type
-    feature_set = feature.feature_set
     style = feature_set.style
 
-    # create a geojson dict from the feature
-    raw_geometry = feature.geometry.data
-    shape_geometry = loads(bytes(raw_geometry))
-    geojson_geometry = mapping(shape_geometry)
-
+    # the payload feature already is GeoJSON
     geojson_dict =  {
         "type": "Feature",
-        "geometry": geojson_geometry,
-        "properties": properties
+        "geometry": feature['geometry'],
+        "properties": feature['properties']
     }
 
     # create the dl.GeoJSON object
@@ -170,9 +179,9 @@ def create_geojson(feature: Feature, popup=None) -> dl.GeoJSON:
     # if the feature_set name is 'Events' or 'Predictions', we set a special id
     # so we can target these features with a callback in the frontend
     if feature_set_name in ['Events', 'Predictions']:
-        id = {'type': 'geojson', 'id': f'{feature_set_name.lower()}-{feature.id}'}  # e.g. {'type': 'geojson', 'id': 'events-17'}
+        id = {'type': 'geojson', 'id': f'{feature_set_name.lower()}-{feature["id"]}'}  # e.g. {'type': 'geojson', 'id': 'events-17'}
     else:
-        id = f'feature-{feature.id}'    # e.g. 'feature-17'
+        id = f'feature-{feature["id"]}'    # e.g. 'feature-17'
     
     geojson = dl.GeoJSON(
         data=geojson_dict,
@@ -184,11 +193,11 @@ def create_geojson(feature: Feature, popup=None) -> dl.GeoJSON:
     return geojson
 
 # david is a god for making this work
-def create_awesome_marker(feature: Feature, popup=None) -> dl.DivMarker:
+def create_awesome_marker(feature: dict, feature_set: FeatureSet, popup=None) -> dl.DivMarker:
     """
     Create an awesome marker with a Font Awesome icon
-    - feature: Feature from the database
-    - style: Style from the database
+    - feature: a feature of a FeatureSet payload, see data/payloads.py
+    - feature_set: FeatureSet of the feature, its style sets the icon and color
     - popup: Popup html content as string
     - icon: Font Awesome icon name from https://fontawesome.com/icons
     - color: marker color as string. Possible values: ```{red, darkred, lightred, orange, beige, green, darkgreen,
@@ -200,7 +209,7 @@ def create_awesome_marker(feature: Feature, popup=None) -> dl.DivMarker:
     # if MultiPoint -> multiple coordinates
     coordinates = get_lat_long(feature)
 
-    style = feature.feature_set.style
+    style = feature_set.style
 
     children = []
 
@@ -225,48 +234,64 @@ def create_awesome_marker(feature: Feature, popup=None) -> dl.DivMarker:
                 tooltipAnchor=[10, -20],
                 popupAnchor=[-3, -31]
             ),
-            id=f'feature-{feature.id}'
+            id=f'feature-{feature["id"]}'
         )
 
     return awesome_marker
 
-def feature_to_map_object(feature: Feature, popup=None):
+def feature_to_map_object(feature: dict, feature_set: FeatureSet, popup=None):
     """
-    Takes in a Feature from the database and returns a dash-leaflet object.
-    Returns an awesome marker or a GeoJSON object, based on its geometry_type
+    Takes in a feature of a FeatureSet payload (see data/payloads.py) and returns a dash-leaflet object.
+    Returns an awesome marker or a GeoJSON object, based on its geometry type
     """
 
-    geometry_type = feature.geometry_type
+    geometry_type = feature['geometry']['type']
 
     # if the geometry type is a point or multiple points, create markers
     # otherwise create a geojson object
     if geometry_type in ['Point', 'MultiPoint']:
-        map_object = create_awesome_marker(feature, popup=popup)
+        map_object = create_awesome_marker(feature, feature_set, popup=popup)
 
     else:
-        map_object = create_geojson(feature, popup=popup)
+        map_object = create_geojson(feature, feature_set, popup=popup)
 
     return map_object
 
-def feature_set_to_map_objects(feature_set: FeatureSet, event_range: Optional[dict] = None, hide_with_timestamp: bool = False, hide_without_timestamp: bool = False) -> list:
+def load_features(feature_set: FeatureSet, zoom: Optional[float] = None, bbox: Optional[list] = None) -> list:
     """
-    Takes in a FeatureSet from the database and returns a list of dash-leaflet objects.
-    that contains all AwesomeMarkers or GeoJSON objects of the FeatureSet
-    - feature_set: FeatureSet from the database
-    - event_range: a dictionary with the keys 'start' and 'end' (datetime objects). If given, only features with a timestamp that are within this range will be returned
-    - hide_with_timestamp: if True, features with a timestamp will not be returned
-    - hide_without_timestamp: if True, features without a timestamp will not be returned
+    Returns the features of `feature_set` to display, in the format of the payload features (see data/payloads.py).
+    Without `bbox`, all features are read from the precomputed payload of the FeatureSet.
+    With `bbox` ([west, south, east, north], see the map_viewport store), only the features in it are queried, at most MAP_MAX_FEATURES.
     """
 
-    map_objects = []
+    session = object_session(feature_set)
 
-    # get the popup properties of this feature
-    style = feature_set.style
-    popup_properties = style.popup_properties
+    if bbox is not None:
+        return get_viewport_features(session, feature_set, geometry_level(zoom), bbox, MAP_MAX_FEATURES)
 
-    for feature in feature_set.features:
+    # the payload with the geometry level of the zoom, built once per version of the FeatureSet
+    return get_payload(session, feature_set, geometry_level(zoom))['features']
 
-        timestamp = feature.timestamp
+def filter_features(features: list, event_range: Optional[dict] = None, hide_with_timestamp: bool = False, hide_without_timestamp: bool = False):
+    """
+    Yields the features of a FeatureSet payload (see data/payloads.py) that pass the timestamp filters.
+    - event_range: a dictionary with the keys 'start' and 'end' (ISO strings). If given, only features with a timestamp that are within this range are yielded
+    - hide_with_timestamp: if True, features with a timestamp are skipped
+    - hide_without_timestamp: if True, features without a timestamp are skipped
+    """
+
+    # transform the start and end of event_range into datetime objects
+    if event_range is not None and len(event_range) > 0:
+        start = datetime.fromisoformat(event_range['start'])
+        end = datetime.fromisoformat(event_range['end'])
+
+        # swap start and end if start is greater than end
+        if start > end:
+            start, end = end, start
+
+    for feature in features:
+
+        timestamp = feature['timestamp']
 
         # if the Feature has a timestamp and hide_with_timestamp is True, skip this feature
         if hide_with_timestamp and timestamp is not None:
@@ -279,36 +304,92 @@ def feature_set_to_map_objects(feature_set: FeatureSet, event_range: Optional[di
         # if the Feature has a timestamp and event_range is given, check if the timestamp is within the range
         if event_range is not None and len(event_range) > 0 and timestamp is not None:
 
-            # transform the start and end of event_range into datetime objects
-            start = datetime.fromisoformat(event_range['start'])
-            end = datetime.fromisoformat(event_range['end'])
-
-            # swap start and end if start is greater than end
-            if start > end:
-                start, end = end, start
+            timestamp = datetime.fromisoformat(timestamp)
 
             # if the timestamp is not within the range, skip this feature
             if timestamp < start or timestamp > end:
                 continue
 
-        properties = feature.properties
-            
-        # build the popup window
-        popup_content = f"<b>{feature_set.name}</b><br>"
+        yield feature
 
-        if popup_properties is not None:
+def style_to_hideout(style: Style) -> dict:
+    """
+    Convert a Style from the database to the `hideout` of a dl.GeoJSON with all features of a FeatureSet.
+    The style, point to layer and popup functions in assets/feature_set_geojson.js read it to draw the features like
+    create_geojson() and create_awesome_marker() do.
+    """
 
-            for property in popup_properties:
-                current_property = popup_properties[property]
-                value = properties.get(current_property, '')
-                popup_content += f"<b>{property}</b>: {value}<br>"
-    
-        map_object = feature_to_map_object(feature, popup_content)
+    if style is None:
+        return {'style': {}, 'colormap': None, 'marker_icon': None, 'marker_color': None}
+
+    colormap = None
+
+    if style.colormap is not None:
+        colormap = {
+            'property': style.colormap.property,
+            'min_value': style.colormap.min_value,
+            'max_value': style.colormap.max_value,
+            'min_color': style.colormap.min_color,
+            'max_color': style.colormap.max_color,
+        }
+
+    return {
+        'style': style_to_dict(style),
+        'colormap': colormap,
+        'marker_icon': style.marker_icon,
+        'marker_color': style.marker_color,
+    }
+
+def feature_set_to_geojson(feature_set: FeatureSet, event_range: Optional[dict] = None, hide_with_timestamp: bool = False, hide_without_timestamp: bool = False, zoom: Optional[float] = None, bbox: Optional[list] = None) -> list:
+    """
+    Takes in a FeatureSet from the database and returns a list with a single dl.GeoJSON that contains all its features.
+    The features are styled in the browser from the Style of the FeatureSet (see style_to_hideout() and assets/feature_set_geojson.js),
+    instead of sending one component with its own style and popup per feature.
+    The FeatureSets in PER_FEATURE_FEATURE_SETS are built with feature_set_to_map_objects(), their features are clicked by callbacks.
+    Takes the same arguments as feature_set_to_map_objects().
+    """
+
+    if feature_set.name in PER_FEATURE_FEATURE_SETS:
+        return feature_set_to_map_objects(feature_set, event_range, hide_with_timestamp, hide_without_timestamp, zoom, bbox)
+
+    features = list(filter_features(load_features(feature_set, zoom, bbox), event_range, hide_with_timestamp, hide_without_timestamp))
+
+    if not features:
+        return []
+
+    geojson = dl.GeoJSON(
+        data={'type': 'FeatureCollection', 'features': features},
+        hideout=style_to_hideout(feature_set.style),
+        style={'variable': 'featureSetGeoJSON.style'},
+        pointToLayer={'variable': 'featureSetGeoJSON.pointToLayer'},
+        onEachFeature={'variable': 'featureSetGeoJSON.onEachFeature'},
+        id=f'featureset-{feature_set.id}'
+    )
+
+    return [geojson]
+
+def feature_set_to_map_objects(feature_set: FeatureSet, event_range: Optional[dict] = None, hide_with_timestamp: bool = False, hide_without_timestamp: bool = False, zoom: Optional[float] = None, bbox: Optional[list] = None) -> list:
+    """
+    Takes in a FeatureSet from the database and returns a list of dash-leaflet objects.
+    that contains all AwesomeMarkers or GeoJSON objects of the FeatureSet
+    The features are read from the precomputed payload of the FeatureSet or queried for the viewport, see load_features()
+    - feature_set: FeatureSet from the database
+    - event_range: a dictionary with the keys 'start' and 'end' (datetime objects). If given, only features with a timestamp that are within this range will be returned
+    - hide_with_timestamp: if True, features with a timestamp will not be returned
+    - hide_without_timestamp: if True, features without a timestamp will not be returned
+    - zoom: the zoom level of the map, lines and polygons are simplified to match it (see `geometry_level()`)
+    - bbox: [west, south, east, north] of the map viewport, if given only the features in it are loaded (see `load_features()`)
+    """
+
+    map_objects = []
+
+    for feature in filter_features(load_features(feature_set, zoom, bbox), event_range, hide_with_timestamp, hide_without_timestamp):
+        map_object = feature_to_map_object(feature, feature_set, feature['popup'])
         map_objects.append(map_object)
 
     return map_objects
 
-def layer_id_to_layer_group(layer_id, event_range: Optional[dict] = None, hide_with_timestamp: bool = False, hide_without_timestamp: bool = False) -> dl.LayerGroup:
+def layer_id_to_layer_group(layer_id, event_range: Optional[dict] = None, hide_with_timestamp: bool = False, hide_without_timestamp: bool = False, zoom: Optional[float] = None, feature_set_geojson: bool = MAP_FEATURE_SET_GEOJSON, bbox: Optional[list] = None) -> dl.LayerGroup:
     """
     Takes in an overlay_id and returns the corresponding layer group.
     This is a wrapper for collection_to_map_objects()
@@ -316,27 +397,36 @@ def layer_id_to_layer_group(layer_id, event_range: Optional[dict] = None, hide_w
     - event_range (dict): a dictionary with the keys 'start' and 'end' (datetime objects). If given, only features with a timestamp that are within this range will be returned
     - hide_with_timestamp (bool): if True, features with a timestamp will not be returned
     - hide_without_timestamp (bool): if True, features without a timestamp will not be returned
+    - zoom (float): the zoom level of the map, selects the simplified geometries
+    - feature_set_geojson (bool): if True, every FeatureSet is a single dl.GeoJSON (see feature_set_to_geojson()), otherwise every feature is a component
+    - bbox (list): [west, south, east, north] of the map viewport, if given only the features in it are loaded
     """
 
-    engine, session = autoconnect_db()
+    map_objects = []
 
-    # get the layer with the given id
-    layer = session.query(Layer).get(layer_id)
+    with session_scope() as session:
 
-    if layer is None:
-        return dl.LayerGroup(id=f'layergroup-{layer_id}')
+        # get the layer with the given id
+        layer = session.query(Layer).get(layer_id)
 
-    feature_sets = layer.feature_sets
+        if layer is None:
+            return dl.LayerGroup(id=f'layergroup-{layer_id}')
 
-    map_objects = []
+        feature_sets = layer.feature_sets
 
-    for feature_set in feature_sets:
-        # build the layer group for this collections
-        map_objects.extend(feature_set_to_map_objects(feature_set, event_range, hide_with_timestamp, hide_without_timestamp))
+        # the same layer with the same filters and unchanged features is served from memory, see app/layer_cache.py
+        key = layer_cache_key('layer', layer_id, feature_sets, event_range, hide_with_timestamp, hide_without_timestamp, geometry_level(zoom), feature_set_geojson, bbox)
+        layer_group = layer_group_cache.get(key)
 
-    # close database connection
-    session.close()
-    engine.dispose()
+        if layer_group is not None:
+            return layer_group
+
+        # one dl.GeoJSON per FeatureSet, or one component per feature
+        build_map_objects = feature_set_to_geojson if feature_set_geojson else feature_set_to_map_objects
+
+        for feature_set in feature_sets:
+            # build the layer group for this collections
+            map_objects.extend(build_map_objects(feature_set, event_range, hide_with_timestamp, hide_without_timestamp, zoom, bbox))
 
     # create the layer group
     layer_group = dl.LayerGroup(
@@ -344,9 +434,11 @@ def layer_id_to_layer_group(layer_id, event_range: Optional[dict] = None, hide_w
         id=f'layergroup-{layer_id}'
     )
 
+    layer_group_cache.put(key, layer_group)
+
     return layer_group
 
-def scenario_id_to_layer_group(scenario_id, event_range: Optional[dict] = None, hide_with_timestamp: bool = False, hide_without_timestamp: bool = False) -> dl.LayerGroup:
+def scenario_id_to_layer_group(scenario_id, event_range: Optional[dict] = None, hide_with_timestamp: bool = False, hide_without_timestamp: bool = False, zoom: Optional[float] = None, feature_set_geojson: bool = MAP_FEATURE_SET_GEOJSON, bbox: Optional[list] = None) -> dl.LayerGroup:
     """
     Takes in a scenario_id and returns the corresponding layer group.
     This is a wrapper for collection_to_map_objects()
@@ -354,27 +446,36 @@ def scenario_id_to_layer_group(scenario_id, event_range: Optional[dict] = None,
     - event_range (dict): a dictionary with the keys 'start' and 'end' (datetime objects). If given, only features with a timestamp that are within this range will be returned
     - hide_with_timestamp (bool): if True, features with a timestamp will not be returned
     - hide_without_timestamp (bool): if True, features without a timestamp will not be returned
+    - zoom (float): the zoom level of the map, selects the simplified geometries
+    - feature_set_geojson (bool): if True, every FeatureSet is a single dl.GeoJSON (see feature_set_to_geojson()), otherwise every feature is a component
+    - bbox (list): [west, south, east, north] of the map viewport, if given only the features in it are loaded
     """
 
-    engine, session = autoconnect_db()
+    map_objects = []
+
+    with session_scope() as session:
 
-    # get the scenario with the given id
-    scenario = session.query(Scenario).get(scenario_id)
+        # get the scenario with the given id
+        scenario = session.query(Scenario).get(scenario_id)
 
-    if scenario is None:
-        return dl.LayerGroup(id=f'scenariogroup-{scenario_id}')
+        if scenario is None:
+            return dl.LayerGroup(id=f'scenariogroup-{scenario_id}')
 
-    feature_sets = scenario.feature_sets
+        feature_sets = scenario.feature_sets
 
-    map_objects = []
+        # the same scenario with the same filters and unchanged features is served from memory, see app/layer_cache.py
+        key = layer_cache_key('scenario', scenario_id, feature_sets, event_range, hide_with_timestamp, hide_without_timestamp, geometry_level(zoom), feature_set_geojson, bbox)
+        layer_group = layer_group_cache.get(key)
 
-    for feature_set in feature_sets:
-        # build the layer group for this collections
-        map_objects.extend(feature_set_to_map_objects(feature_set, event_range, hide_with_timestamp, hide_without_timestamp))
+        if layer_group is not None:
+            return layer_group
 
-    # close database connection
-    session.close()
-    engine.dispose()
+        # one dl.GeoJSON per FeatureSet, or one component per feature
+        build_map_objects = feature_set_to_geojson if feature_set_geojson else feature_set_to_map_objects
+
+        for feature_set in feature_sets:
+            # build the layer group for this collections
+            map_objects.extend(build_map_objects(feature_set, event_range, hide_with_timestamp, hide_without_timestamp, zoom, bbox))
 
     # create the layer group
     layer_group = dl.LayerGroup(
@@ -382,4 +483,6 @@ def scenario_id_to_layer_group(scenario_id, event_range: Optional[dict] = None,
         id=f'scenariogroup-{scenario_id}'
     )
 
+    layer_group_cache.put(key, layer_group)
+
     return layer_group
\ No newline at end of file
@@ -0,0 +1,76 @@
+import os
+import threading
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+# in-process cache of the layer groups built by app/convert.py
+# the key contains the data versions of the FeatureSets of the layer (see data/payloads.py), so when refresh(), an upload or the event server
+# changes features, the next lookup misses and the outdated entry is evicted over time, also when the change happened in another process
+
+# the settings below are read on import, load them from .env first
+load_dotenv()
+
+# how many layer groups are kept, the least recently used ones are evicted first
+LAYER_CACHE_SIZE = int(os.getenv('LAYER_CACHE_SIZE', '32'))
+
+class LayerGroupCache:
+    """
+    A thread safe least recently used cache with at most `max_size` entries.
+    """
+
+    def __init__(self, max_size: int = LAYER_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns the entry of `key` and marks it as recently used, or None if it is not cached.
+        """
+
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'size': len(self.entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
+
+# shared by all callbacks of the process
+layer_group_cache = LayerGroupCache()
+
+def layer_cache_key(kind: str, group_id, feature_sets, event_range, hide_with_timestamp: bool, hide_without_timestamp: bool, level: str, feature_set_geojson: bool = False, bbox: list = None) -> tuple:
+    """
+    Returns the cache key of a layer or scenario group (`kind` 'layer' or 'scenario'), built from `feature_sets` with the given filters
+    and rendering mode (`feature_set_geojson`, see app.convert.feature_set_to_geojson()) for the viewport `bbox`.
+    """
+
+    versions = tuple(sorted((feature_set.id, feature_set.data_version) for feature_set in feature_sets))
+    event_range_key = (event_range['start'], event_range['end']) if event_range else None
+
+    bbox_key = tuple(bbox) if bbox else None
+
+    return (kind, int(group_id), versions, event_range_key, hide_with_timestamp, hide_without_timestamp, level, feature_set_geojson, bbox_key)
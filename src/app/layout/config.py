@@ -5,8 +5,10 @@ from sqlalchemy import inspect
 
 # internal imports
 from data.model import Base, Feature, FeatureSet, Collection, Dataset, Layer, Style, Colormap, Scenario
-from data.connect import autoconnect_db
-from data.build import get_default_style, feature_to_obj
+from data.connect import session_scope
+from data.build import get_default_style
+from data.bulk import copy_features
+from data.payloads import build_payloads
 
 import base64
 import json
@@ -100,68 +102,61 @@ def callbacks_config(app: Dash):
                     return f"Error: {full_filename} is not a valid GeoJSON file"
                 
                 # now, we create database entries for the file
-                engine, session = autoconnect_db()
+                with session_scope() as session:
 
-                # first we create a scenario
-                # try to find a name that isnt taken
-                existing_layers = session.query(Layer).filter(Layer.name.startswith(filename))
-                existing_names = [layer.name for layer in existing_layers]
+                    # first we create a scenario
+                    # try to find a name that isnt taken
+                    existing_layers = session.query(Layer).filter(Layer.name.startswith(filename))
+                    existing_names = [layer.name for layer in existing_layers]
                 
 
-                layer_name = filename
-                found_name = False
+                    layer_name = filename
+                    found_name = False
 
-                if layer_name in existing_names: # does the name already exist?
+                    if layer_name in existing_names: # does the name already exist?
 
-                    # 1000 tries to find a new name
-                    # after that, give up
-                    for i in range(1, 1000):
-                        layer_name = f'{filename}_{i}'
+                        # 1000 tries to find a new name
+                        # after that, give up
+                        for i in range(1, 1000):
+                            layer_name = f'{filename}_{i}'
 
-                        if layer_name not in existing_names: # we found a new, valid scenario name!
-                            found_name = True
-                            break
+                            if layer_name not in existing_names: # we found a new, valid scenario name!
+                                found_name = True
+                                break
                 
-                else:
-                    found_name = True
+                    else:
+                        found_name = True
                 
-                if not found_name:
-                    return f"Error saving file {full_filename}: too many entries with this name exist. Consider deleting some."
+                    if not found_name:
+                        return f"Error saving file {full_filename}: too many entries with this name exist. Consider deleting some."
                 
-                # if we got here, we have a valid GeoJSON file and a valid name for it
-                # now, we create the layer and featureset
+                    # if we got here, we have a valid GeoJSON file and a valid name for it
+                    # now, we create the layer and featureset
 
-                layer = Layer(
-                    name = layer_name
-                )
+                    layer = Layer(
+                        name = layer_name
+                    )
 
-                session.add(layer)
+                    session.add(layer)
 
-                # and the featureset
-                style = get_default_style()
+                    # and the featureset
+                    style = get_default_style()
 
-                feature_set = FeatureSet(
-                    name=layer_name,
-                    layer=layer,
-                    style=style
-                )
-                session.add(feature_set)
+                    feature_set = FeatureSet(
+                        name=layer_name,
+                        layer=layer,
+                        style=style
+                    )
+                    session.add(feature_set)
+                    session.flush()
 
-                # now we convert the geojson dict to features
-                for geojson_feature in json_data['features']:
-                    db_feature = feature_to_obj(geojson_feature)
+                    # now we COPY the geojson features into the database, features without geometry are skipped
+                    copy_features(session, json_data['features'], feature_set.id)
 
-                    if db_feature is None:
-                        continue
+                    # the ready to serve FeatureCollections of the new layer
+                    build_payloads(session, [feature_set.id])
 
-                    # set the feature set manually
-                    db_feature.feature_set = feature_set
-
-                    session.add(db_feature)
-                
-                session.commit()
-                
-                session.close()
+                    session.commit()
 
                 return f"Successfully uploaded {full_filename}. Parsed JSON: {json_data}"
             except Exception as e:
@@ -9,7 +9,7 @@ from sqlalchemy import inspect
 
 # internal imports
 from data.model import Base, Feature, FeatureSet, Collection, Dataset, Layer, Style, Colormap, Scenario, Alert
-from data.connect import autoconnect_db
+from data.connect import session_scope, stream_query
 from app.convert import layer_id_to_layer_group
 
 # tables to display in the data viewer
@@ -25,33 +25,33 @@ tables = {
     'Alert': Alert 
 }
 
+# the most rows of a table that are sent to the data viewer
+MAX_ROWS = 5000
+
 def format_table(table_name):
     # get the table
     table = tables[table_name]
 
-    # connect to the database
-    engine, session = autoconnect_db()
-
     # get the column names
     columns = [column.name for column in table.__table__.columns]  # Use list comprehension to get column names
 
-    # get all rows from the table, ordered by id
-    data = session.query(table).order_by(table.id).all()
-
-    # close the database connection
-    session.close()
-    engine.dispose()
-
     # format the data for DataTable
     formatted_columns = [{'name': col, 'id': col} for col in columns]
-    formatted_data = [{col: str(getattr(row, col)) for col in columns} for row in data]
+
+    # stream the first MAX_ROWS rows from the table, ordered by id
+    # only the columns are queried, no ORM objects are built
+    formatted_data = []
+
+    with session_scope() as session:
+        query = session.query(*table.__table__.columns).order_by(table.id).limit(MAX_ROWS)
+
+        for row in stream_query(query):
+            formatted_data.append({col: str(value) for col, value in zip(columns, row)})
 
     return formatted_columns, formatted_data
 
 def build_layout_data_viewer():
 
-    engine, session = autoconnect_db()
-
     # get the data from the Layer table
     columns, data = format_table("Layer")
 
@@ -85,10 +85,6 @@ def build_layout_data_viewer():
         )
 
     ]
-
-    # close the database connection
-    session.close()
-    engine.dispose()
     
     return layout_data_viewer
 
@@ -9,20 +9,41 @@ import dash
 from dash import Dash, html, dcc, Output, Input, State, callback_context, MATCH, ALL, ctx
 from dash.exceptions import PreventUpdate
 import dash_leaflet as dl
+from dotenv import load_dotenv
 
-from sqlalchemy import inspect
+from sqlalchemy import inspect, func
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 # internal imports
-from data.model import Base, Feature, FeatureSet, Collection, Dataset, Layer, Style, Colormap, Scenario, Report, UserReportState
-from data.connect import autoconnect_db
+from data.model import Base, Feature, FeatureSet, Collection, Dataset, Layer, Style, Colormap, Scenario, Report, UserReportState, ReportLocation
+from data.connect import get_engine, session_scope
 from data.build import build, refresh
-from app.convert import layer_id_to_layer_group, scenario_id_to_layer_group, style_to_dict
-from app.layout.map.sidebar import get_sidebar_content, get_sidebar_dropdown_platform_values, get_sidebar_dropdown_event_type_values, get_sidebar_dropdown_relevance_type_values, ALL_EVENT_TYPES, ALL_RELEVANCE_TYPES, get_sidebar_max_timestamp
+from data.report_locations import sync_report_locations, effective_locations
+from app.convert import layer_id_to_layer_group, scenario_id_to_layer_group, style_to_dict, geometry_level, MAP_FEATURE_SET_GEOJSON
+from app.layer_cache import layer_group_cache
+from app.tiles import MAP_VECTOR_TILES, get_tile_styles
+from app.layout.map.sidebar import get_sidebar_content, get_sidebar_dropdown_platform_values, get_sidebar_dropdown_event_type_values, get_sidebar_dropdown_relevance_type_values, ALL_EVENT_TYPES, ALL_RELEVANCE_TYPES, get_sidebar_max_timestamp, location_filter_clause, location_status
 from app.i18n import t as _t, new_posts_label, TRANSLATIONS
 from app.layout.map.geocoder import geolocate, PREDICTED_LABELS
 from server_reports import fetch_osm_polygon
 
+# the settings below are read on import, load them from .env first
+load_dotenv()
+
+# the layers are loaded for the map bounds extended by this fraction of their size on every side
+VIEWPORT_MARGIN = float(os.getenv('MAP_VIEWPORT_MARGIN', '0.25'))
+
+# milliseconds the map has to stand still before the layers are loaded for its new bounds
+VIEWPORT_DEBOUNCE_MS = int(os.getenv('MAP_VIEWPORT_DEBOUNCE_MS', '400'))
+
+# the layers are loaded again when the viewport is this many times larger than the map bounds, i.e. after zooming in two levels
+VIEWPORT_MAX_AREA_RATIO = 16
+
+# positions of the containers in the map children, the callbacks patch their container instead of sending all map children
+MAP_SLOT_LAYER_GROUPS = 2       # the layer and scenario groups, see update_map()
+MAP_SLOT_REPORT_POLYGONS = 3    # the locations of the selected report, see render_report_polygons()
+MAP_SLOT_GEOCODER = 4           # the entities found by the geocoder, see show_entities()
+
 
 # IMPORTANT NOTE
 # in this branch, some components have been disabled
@@ -35,25 +56,18 @@ def build_layer_checkboxes(lang='de'):
     """
     from app.i18n import layer_name as _layer_name
 
-    # get all available layers sets
-    engine, session = autoconnect_db()
-
     # Check if the Layer table exists
-    inspector = inspect(engine)
+    inspector = inspect(get_engine())
     if 'layers' not in inspector.get_table_names():
-        # Close database connection and return empty list if Layer does not exist
-        session.close()
-        engine.dispose()
+        # return empty list if Layer does not exist
         print("Warning: Table 'layers' does not exist. No Layer checkboxes will be created. You can rebuild the database by running 'python main.py -rebuild'. See more information with 'python main.py -help'.")
         return []
 
-    layers = session.query(Layer).all()
-
-    layer_checkboxes = [{'label': _layer_name(lang, layer.name), 'value': layer.id} for layer in layers]
+    # get all available layers sets
+    with session_scope() as session:
+        layers = session.query(Layer).all()
 
-    # close database connection
-    session.close()
-    engine.dispose()
+        layer_checkboxes = [{'label': _layer_name(lang, layer.name), 'value': layer.id} for layer in layers]
 
     return layer_checkboxes
 
@@ -63,33 +77,40 @@ def build_scenario_checkboxes():
     Format: `[{'label': 'Scenario Display Name', 'value': 'Scenario ID'}]`
     """
 
-    # get all available layers sets
-    engine, session = autoconnect_db()
-
     # Check if the Layer table exists
-    inspector = inspect(engine)
+    inspector = inspect(get_engine())
     if 'scenarios' not in inspector.get_table_names():
-        # Close database connection and return empty list if Layer does not exist
-        session.close()
-        engine.dispose()
+        # return empty list if Layer does not exist
         print("Warning: Table 'scenarios' does not exist. No Layer checkboxes will be created. You can rebuild the database by running 'python main.py -rebuild'. See more information with 'python main.py -help'.")
         return []
 
-    scenarios = session.query(Scenario).all()
-
-    scenario_checkboxes = [{'label': scenario.name, 'value': scenario.id} for scenario in scenarios]
+    # get all available layers sets
+    with session_scope() as session:
+        scenarios = session.query(Scenario).all()
 
-    # close database connection
-    session.close()
-    engine.dispose()
+        scenario_checkboxes = [{'label': scenario.name, 'value': scenario.id} for scenario in scenarios]
 
     return scenario_checkboxes
 
+def layer_group_slots(layer_checkboxes, scenario_checkboxes) -> list:
+    """
+    Returns the ids of the layer and scenario groups in the order of their slots in the map_layer_groups container, one slot per layer and scenario.
+    """
+
+    return [f"layergroup-{checkbox['value']}" for checkbox in layer_checkboxes] + [f"scenariogroup-{checkbox['value']}" for checkbox in scenario_checkboxes]
+
+def empty_layer_group(group_id: str):
+    """
+    Returns the content of the slot of a group that is not shown.
+    """
+
+    return dl.LayerGroup(children=[], id=group_id)
+
 def highlight_events_predictions(hash, map_children, hide_other=False):
     """
     Highlights all events and predictions with the same hash.
     - hash: The hash to highlight
-    - map_children: The map children to iterate over
+    - map_children: The layer and scenario groups to iterate over, the children of the map_layer_groups container
     - hide_other: If True, hides all events and predictions with a different hash
     """
 
@@ -99,18 +120,13 @@ def highlight_events_predictions(hash, map_children, hide_other=False):
         print("No trigger")
         raise PreventUpdate
 
-    # connect to the db
-    engine, session = autoconnect_db()
-
     # get the styles for later
     # this first gets the styles from the database, then converts them to dictionaries that can be used in the map children
-    style_event_default = style_to_dict(session.query(Style).filter(Style.name == 'Events').first())
-    style_event_highlight = style_to_dict(session.query(Style).filter(Style.name == 'Events Selected').first())
-    style_prediction_default = style_to_dict(session.query(Style).filter(Style.name == 'Predictions').first())
-    style_prediction_highlight = style_to_dict(session.query(Style).filter(Style.name == 'Predictions Selected').first())
-
-    session.close()
-    engine.dispose()
+    with session_scope() as session:
+        style_event_default = style_to_dict(session.query(Style).filter(Style.name == 'Events').first())
+        style_event_highlight = style_to_dict(session.query(Style).filter(Style.name == 'Events Selected').first())
+        style_prediction_default = style_to_dict(session.query(Style).filter(Style.name == 'Predictions').first())
+        style_prediction_highlight = style_to_dict(session.query(Style).filter(Style.name == 'Predictions Selected').first())
 
 
     # iterate over all children, change the following:
@@ -183,6 +199,7 @@ def get_layout_map():
     # like the checkboxes of the layers or the values of the dropdowns in the reports menu
     layer_checkboxes = build_layer_checkboxes()
     scenario_checkboxes = build_scenario_checkboxes()
+    slots = layer_group_slots(layer_checkboxes, scenario_checkboxes)
     reports_dropdown_platform = get_sidebar_dropdown_platform_values()
     reports_dropdown_event_type = get_sidebar_dropdown_event_type_values()
     reports_dropdown_relevance_type = get_sidebar_dropdown_relevance_type_values()
@@ -199,7 +216,11 @@ def get_layout_map():
                     url='https://sgx.geodatenzentrum.de/wmts_basemapde/tile/1.0.0/de_basemapde_web_raster_farbe/default/GLOBAL_WEBMERCATOR/{z}/{y}/{x}.png',
                     attribution='&copy; <a href="https://basemap.de/">basemap.de</a>',
                     id='tile_layer'
-                )
+                ),
+                # the containers patched by the callbacks, see MAP_SLOT_*
+                dl.LayerGroup(children=[empty_layer_group(group_id) for group_id in slots], id='map_layer_groups'),
+                dl.LayerGroup(children=[], id='map_report_polygons'),
+                dl.LayerGroup(children=[], id='map_geocoder')
             ],
             zoom=12,
             doubleClickZoom=False,
@@ -244,9 +265,11 @@ def get_layout_map():
                     options=[
                         {'label': 'Hide Features with Timestamp', 'value': 'hide_with_timestamp'},
                         {'label': 'Hide Features without Timestamp', 'value': 'hide_without_timestamp'},
-                        {'label': 'Filter by Timestamp', 'value': 'filter_by_timestamp'}
+                        {'label': 'Filter by Timestamp', 'value': 'filter_by_timestamp'},
+                        {'label': 'Vector Tiles', 'value': 'vector_tiles'},
+                        {'label': 'One GeoJSON per Feature Set', 'value': 'feature_set_geojson'}
                         ],
-                    value=[],
+                    value=(['vector_tiles'] if MAP_VECTOR_TILES else []) + (['feature_set_geojson'] if MAP_FEATURE_SET_GEOJSON else []),
                     style={"display": "none"}
                 ),
                 # special buttons, hidden for now from the end user
@@ -507,6 +530,11 @@ def get_layout_map():
         dcc.Store(id='event_range_selected', data=[]),             # the selected event range, selected by slider_events
         dcc.Store(id='geocoder_types', data={}),                   # the types of events the geocoder found
         dcc.Store(id='geocoder_entities', data=[]),                # the geocoder entities, selected by geocoder_entity_dropdown
+        dcc.Store(id='map_geometry_level', data=geometry_level(12)),  # the simplified geometry level for the current zoom, only changes between zoom bands
+        dcc.Store(id='map_bounds', data=None),                     # the bounds of the map, debounced while the map is moved
+        dcc.Store(id='map_viewport', data=None),                   # [west, south, east, north] the layers are loaded for, the map bounds with a margin
+        dcc.Store(id='vector_tile_layers', data=[]),               # the layers shown as vector tiles, see assets/vector_tiles.js
+        dcc.Store(id='map_layer_groups_state', data={'slots': slots, 'ids': [], 'signature': None}),  # the slots of the map_layer_groups container, the ids of the shown groups and the options they were built with
         dcc.Interval(id='interval_refresh_reports', interval=10000 , n_intervals=0),  # refresh the reports every hour
         html.Div(id='dummy_output_1', style={'display': 'none'}),  # for some reason callback functions always need an output, so we create a dummy output for functions that dont return anything
         dcc.Store(id='active-report-locations'),   # list of {lat, lon} for active report's dots (offscreen arrows)
@@ -815,21 +843,26 @@ def callbacks_map(app: Dash):
     # meaning, we create/modify/delete markers and polygons on the map
     @app.callback(
         [
-            Output('map', 'children', allow_duplicate=True)
+            Output('map', 'children', allow_duplicate=True),
+            Output('vector_tile_layers', 'data'),
+            Output('map_layer_groups_state', 'data')
         ],
         [
             Input('overlay_checklist', 'value'),        # triggered when a layer is selected or deselected
             Input('scenario_checklist', 'value'),       # triggered when a scenario is selected or deselected
             Input('options_checklist', 'value'),        # triggered when the options checklist changes
             Input('event_range_selected', 'data'),      # triggered when a different event range is selected
-            Input('map-tabs', 'value')                  # triggered when the tab value changes
+            Input('map-tabs', 'value'),                 # triggered when the tab value changes
+            Input('map_geometry_level', 'data'),        # triggered when the zoom crosses into another band of simplified geometries
+            Input('map_viewport', 'data')               # triggered when the map is moved out of the area the layers were loaded for
         ],
         [
-            State('map', 'children'),
+            State('map_layer_groups_state', 'data'),
+            State('map', 'zoom'),
         ],
         prevent_initial_call=True
     )
-    def update_map(overlay_checklist_value, scenario_checklist_value, options_checklist_value, event_range_selected_data, map_tabs_value, map_children):
+    def update_map(overlay_checklist_value, scenario_checklist_value, options_checklist_value, event_range_selected_data, map_tabs_value, geometry_level_value, viewport, layer_groups, zoom):
         """
         This callback is triggered on the following events:
         - A layer is selected or deselected in the overlay_checklist
@@ -837,70 +870,171 @@ def callbacks_map(app: Dash):
         - The options checklist changes
         - A different event range is selected
         - The tab value changes
-
-        It updates the map children, meaning it deletes all existing marker/polygon objects and creates new ones from the Features in the database.
+        - The zoom level changes the simplified geometries to use (see `geometry_level()`)
+        - The map is moved out of the area the layers were loaded for (see `update_map_viewport()`)
+
+        It updates the layer and scenario groups in the map_layer_groups container of the map with a dash.Patch.
+        Every layer and scenario has a fixed slot in the container (see `layer_group_slots()`), only the slots that change are sent:
+        a selected group is built into its slot, a deselected group is replaced with an empty one (see `empty_layer_group()`).
+        When anything else changed, the shown groups are built again (most of them come from the layer cache, see app/layer_cache.py).
+        A layer or scenario that was added after the page was loaded gets a new slot, then all slots are sent.
+        The slots, the ids of the shown groups and the options they were built with are kept in the map_layer_groups_state store.
+        Only the features in the viewport are loaded, once the bounds of the map are known.
+        With the feature_set_geojson option, every FeatureSet is a single dl.GeoJSON styled in the browser (see `feature_set_to_geojson()`).
+        With the vector_tiles option, the layers are not added as children but shown as vector tile layers by assets/vector_tiles.js.
+        The tiles are rendered by the database (see app/tiles.py), the timestamp options do not apply to them.
         """
 
-        # first, divide the map children into layer groups and non-layer groups
-        # we keep the non-layer groups (i.e. the tilemap) and delete the layer groups (markers and polygons)
-        # afterwards, we create new layer groups and add them to the map children
-        map_children_no_layergroup = []
-        map_children_layergroup = []
-
-        for child in map_children:
-
-            id = child['props']['id']
-
-            # check if the child is a layer group
-            # layer groups have an id that starts with 'layer' or 'scenario'
-            if id.startswith('layer') or id.startswith('scenario'):
-                map_children_layergroup.append(child)
-            else:
-                map_children_no_layergroup.append(child)
-        
-        # TODO: modifying the layer groups can be done more efficiently by only adding/removing the layer groups affected by the change, not rebuilding them from scratch
-        # but i will warn you, it will cost you a lot of time and nerves (as it has me already)
-        # here, we take the easy way and just delete all layer groups and create new ones
-        
-        # delete all current layer groups (meaning, delete all existing markers and polygons)
-        map_children_layergroup = []
-
         # the selected options
         hide_with_timestamp: bool = 'hide_with_timestamp' in options_checklist_value
         hide_without_timestamp: bool = 'hide_without_timestamp' in options_checklist_value
         filter_by_timestamp: bool = 'filter_by_timestamp' in options_checklist_value
+        vector_tiles: bool = 'vector_tiles' in options_checklist_value
+        feature_set_geojson: bool = 'feature_set_geojson' in options_checklist_value
+
+        event_range = event_range_selected_data if filter_by_timestamp else None
+
+        # the layers shown as vector tiles
+        vector_tile_layers = []
+
+        # the groups to show, {group id: function that builds the group}
+        groups = {}
+
+        # we are in the Layers tab, showing the layers as vector tiles
+        if map_tabs_value == 'tab-1' and vector_tiles:
+            vector_tile_layers = get_tile_styles(overlay_checklist_value)
 
         # we are in the Layers tab
-        if map_tabs_value == 'tab-1':
+        elif map_tabs_value == 'tab-1':
             for overlay in overlay_checklist_value:
-                if filter_by_timestamp:
-                    # get the layer group with the event range data
-                    layer_group = layer_id_to_layer_group(overlay, event_range_selected_data, hide_with_timestamp, hide_without_timestamp)
-                else:
-                    # get the layer group without the event range data
-                    layer_group = layer_id_to_layer_group(overlay, None, hide_with_timestamp, hide_without_timestamp)
-
-                # add the layer group to the map
-                map_children_layergroup.append(layer_group)
+                groups[f'layergroup-{overlay}'] = lambda overlay=overlay: layer_id_to_layer_group(overlay, event_range, hide_with_timestamp, hide_without_timestamp, zoom, feature_set_geojson, viewport)
         
         # we are in the Scenarios tab
         elif map_tabs_value == 'tab-2':
             for scenario in scenario_checklist_value:
-                if filter_by_timestamp:
-                    # get the layer group with the event range data
-                    layer_group = scenario_id_to_layer_group(scenario, event_range_selected_data, hide_with_timestamp, hide_without_timestamp)
-                else:
-                    # get the layer group without the event range data
-                    layer_group = scenario_id_to_layer_group(scenario, None, hide_with_timestamp, hide_without_timestamp)
-
-                # add the layer group to the map
-                map_children_layergroup.append(layer_group)
+                groups[f'scenariogroup-{scenario}'] = lambda scenario=scenario: scenario_id_to_layer_group(scenario, event_range, hide_with_timestamp, hide_without_timestamp, zoom, feature_set_geojson, viewport)
         
         else:
             # unknown tab selected, do nothing
             raise PreventUpdate
 
-        return [map_children_no_layergroup + map_children_layergroup]
+        # everything except the selection, the groups have to be built again when it changes
+        signature = [map_tabs_value, sorted(options_checklist_value), event_range, geometry_level_value, viewport]
+
+        patch = dash.Patch()
+        ids = list(groups)
+
+        slots = layer_groups.get('slots', []) if layer_groups is not None else []
+        shown = layer_groups['ids'] if layer_groups is not None else []
+        same_options = layer_groups is not None and layer_groups['signature'] == signature
+
+        if any(group_id not in slots for group_id in ids):
+            # a layer or scenario that did not exist when the page was loaded, add a slot for it and send all slots
+            slots = slots + [group_id for group_id in ids if group_id not in slots]
+            patch[MAP_SLOT_LAYER_GROUPS]['props']['children'] = [groups[group_id]() if group_id in groups else empty_layer_group(group_id) for group_id in slots]
+
+        else:
+            # the slots never move, so only the changed ones are sent, the other groups stay untouched in the browser
+            changed = False
+
+            for index, group_id in enumerate(slots):
+
+                if group_id in groups and (group_id not in shown or not same_options):
+                    patch[MAP_SLOT_LAYER_GROUPS]['props']['children'][index] = groups[group_id]()
+                    changed = True
+
+                elif group_id not in groups and group_id in shown:
+                    patch[MAP_SLOT_LAYER_GROUPS]['props']['children'][index] = empty_layer_group(group_id)
+                    changed = True
+
+            if not changed and not vector_tiles:
+                raise PreventUpdate
+
+        return [patch, vector_tile_layers, {'slots': slots, 'ids': ids, 'signature': signature}]
+
+    # show the vector tile layers on the map
+    app.clientside_callback(
+        """
+        function(layers) {
+            window.updateVectorTileLayers(layers || []);
+            return window.dash_clientside.no_update;
+        }
+        """,
+        Output('report-dots-tick', 'data', allow_duplicate=True),
+        Input('vector_tile_layers', 'data'),
+        prevent_initial_call=True,
+    )
+
+    # report the bounds of the map once it stopped moving for VIEWPORT_DEBOUNCE_MS, not on every step of a pan or zoom animation
+    app.clientside_callback(
+        """
+        function(bounds) {
+            if (!bounds) return window.dash_clientside.no_update;
+            window._mapBoundsRequest = (window._mapBoundsRequest || 0) + 1;
+            var request = window._mapBoundsRequest;
+            return new Promise(function(resolve) {
+                setTimeout(function() {
+                    resolve(request === window._mapBoundsRequest ? bounds : window.dash_clientside.no_update);
+                }, %d);
+            });
+        }
+        """ % VIEWPORT_DEBOUNCE_MS,
+        Output('map_bounds', 'data'),
+        Input('map', 'bounds'),
+        prevent_initial_call=True,
+    )
+
+    # the layers are loaded for the map bounds plus a margin, moving the map only reloads them when it leaves this area
+    @app.callback(
+        Output('map_viewport', 'data'),
+        Input('map_bounds', 'data'),
+        State('map_viewport', 'data'),
+        prevent_initial_call=True
+    )
+    def update_map_viewport(bounds, viewport):
+        """
+        Sets the viewport the layers are loaded for, [west, south, east, north], when the map bounds ([[south, west], [north, east]]) are
+        no longer inside it, or when the map was zoomed in so far that the viewport is much larger than the bounds.
+        """
+
+        if not bounds:
+            raise PreventUpdate
+
+        (south, west), (north, east) = bounds
+
+        if viewport is not None:
+            v_west, v_south, v_east, v_north = viewport
+            inside = v_west <= west and v_south <= south and v_east >= east and v_north >= north
+            zoomed_in = (east - west) * (north - south) * VIEWPORT_MAX_AREA_RATIO < (v_east - v_west) * (v_north - v_south)
+
+            if inside and not zoomed_in:
+                raise PreventUpdate
+
+        margin_x = (east - west) * VIEWPORT_MARGIN
+        margin_y = (north - south) * VIEWPORT_MARGIN
+
+        # rounded, so the viewport can be part of the layer cache key
+        return [
+            round(max(west - margin_x, -180), 4),
+            round(max(south - margin_y, -90), 4),
+            round(min(east + margin_x, 180), 4),
+            round(min(north + margin_y, 90), 4),
+        ]
+
+    # zooming only redraws the layers when the zoom level crosses into another band of simplified geometries
+    @app.callback(
+        Output('map_geometry_level', 'data'),
+        Input('map', 'zoom'),
+        State('map_geometry_level', 'data'),
+        prevent_initial_call=True
+    )
+    def update_geometry_level(zoom, current_level):
+        level = geometry_level(zoom)
+
+        if level == current_level:
+            raise PreventUpdate
+
+        return level
 
     # if a new event range was selected, update the event_range marks
     @app.callback(
@@ -1043,15 +1177,13 @@ def callbacks_map(app: Dash):
         if n_clicks is None:
             raise PreventUpdate
         
-        engine, session = autoconnect_db()
-
         # call the reload function
-        refresh(session, True)
+        with session_scope() as session:
+            refresh(session, verbose=True)
+
+        # the data versions changed, the cached layer groups of this process are outdated
+        layer_group_cache.clear()
 
-        # close database connection
-        session.close()
-        engine.dispose()
-        
         raise PreventUpdate
 
         # return nothing
@@ -1128,24 +1260,22 @@ def callbacks_map(app: Dash):
         trigger_type, trigger_number = trigger_id['id'].split('-')
     
         # connect to the db
-        engine, session = autoconnect_db()
+        with session_scope() as session:
 
-        if trigger_type == 'events':
-            feature_hash = session.query(Feature).filter(Feature.id == trigger_number).first().properties['hash']
-        elif trigger_type == 'predictions':
-            feature_hash = session.query(Feature).filter(Feature.id == trigger_number).first().properties['hash']
-        else:
-            print(f"Invalid trigger type {trigger_type} in highlight_prediction")
-            raise PreventUpdate
-        
-        # close database connection
-        session.close()
-        engine.dispose()
+            if trigger_type == 'events':
+                feature_hash = session.query(Feature).filter(Feature.id == trigger_number).first().properties['hash']
+            elif trigger_type == 'predictions':
+                feature_hash = session.query(Feature).filter(Feature.id == trigger_number).first().properties['hash']
+            else:
+                print(f"Invalid trigger type {trigger_type} in highlight_prediction")
+                raise PreventUpdate
 
         # highlight all features with the same hash
-        map_children = highlight_events_predictions(feature_hash, map_children)
+        # only the layer groups are sent back to the browser
+        patch = dash.Patch()
+        patch[MAP_SLOT_LAYER_GROUPS]['props']['children'] = highlight_events_predictions(feature_hash, map_children[MAP_SLOT_LAYER_GROUPS]['props']['children'])
 
-        return map_children
+        return patch
 
     # on double click, hide all other predictions
     @app.callback(
@@ -1198,9 +1328,11 @@ def callbacks_map(app: Dash):
             raise PreventUpdate
 
         # hide all features with a different hash
-        map_children = highlight_events_predictions(feature_hash, map_children, hide_other=True)
+        # only the layer groups are sent back to the browser
+        patch = dash.Patch()
+        patch[MAP_SLOT_LAYER_GROUPS]['props']['children'] = highlight_events_predictions(feature_hash, map_children[MAP_SLOT_LAYER_GROUPS]['props']['children'], hide_other=True)
 
-        return map_children
+        return patch
     
     @app.callback(
         Output('geocoder_entity_dropdown', 'options'),
@@ -1361,24 +1493,16 @@ def callbacks_map(app: Dash):
                     print(f"Bounding box parse error: {e}")
         return elements, (max_lat, min_lat, max_lon, min_lon)
 
-    def get_children(map_children):
-        # Remove previous temp markers and rectangles
-        children = [
-            c for c in map_children
-            if not (
-                (isinstance(c["props"]["id"], str) and (
-                        c["props"]["id"].startswith("tempmarker_") or
-                        c["props"]["id"].startswith("tmp_rect_") or
-                        c["props"]["id"].startswith("tmp_polygon_") or
-                        c["props"]["id"].startswith("report_tmp_marker") or
-                        c["props"]["id"].startswith("report_tmp_rect") or
-                        c["props"]["id"].startswith("report_tmp_polygon") or
-                        c["props"]["id"].startswith("tmp_line") or
-                        c["props"]["id"].startswith("tmp_layer")
-                ))
-            )
-        ]
-        return children
+    def temp_elements_patch(report_polygons: list = [], geocoder: list = []) -> dash.Patch:
+        """
+        Returns a dash.Patch of the map children that replaces the temporary elements: the locations of the
+        selected report (`report_polygons`) and the markers and areas of the geocoder (`geocoder`).
+        """
+
+        patch = dash.Patch()
+        patch[MAP_SLOT_REPORT_POLYGONS]['props']['children'] = report_polygons
+        patch[MAP_SLOT_GEOCODER]['props']['children'] = geocoder
+        return patch
 
     @app.callback(
         Output('active-report-id', 'data'),
@@ -1409,13 +1533,9 @@ def callbacks_map(app: Dash):
         updated_snapshot[str(report_id)] = entry
         if username:
             try:
-                engine, session = autoconnect_db()
-                try:
+                with session_scope() as session:
                     _upsert_user_state(username, report_id, session, new=False)
                     session.commit()
-                finally:
-                    session.close()
-                    engine.dispose()
             except Exception:
                 pass
         return new_active_id, updated_snapshot
@@ -1439,13 +1559,9 @@ def callbacks_map(app: Dash):
         entry['new'] = False
         updated_snapshot[str(report_id)] = entry
         try:
-            engine, session = autoconnect_db()
-            try:
+            with session_scope() as session:
                 _upsert_user_state(username, report_id, session, new=False)
                 session.commit()
-            finally:
-                session.close()
-                engine.dispose()
         except Exception:
             pass
         return updated_snapshot
@@ -1455,17 +1571,16 @@ def callbacks_map(app: Dash):
         Output('active-report-locations', 'data'),
         Input('active-report-id', 'data'),
         Input('locations-changed', 'data'),
-        State('map', 'children'),
         State('current-user', 'data'),
         prevent_initial_call=True
     )
-    def render_report_polygons(report_id, _locations_changed, map_children, username):
-        children = get_children(map_children)
+    def render_report_polygons(report_id, _locations_changed, username):
+        # only the containers of the temporary elements are patched, the geocoder results are removed as well
+        children = temp_elements_patch()
         if not report_id:
             return children, []
 
-        engine, session = autoconnect_db()
-        try:
+        with session_scope() as session:
             report = session.query(Report).filter(Report.id == report_id).first()
             if not report:
                 return children, []
@@ -1477,9 +1592,6 @@ def callbacks_map(app: Dash):
                 ).first()
                 if urs and urs.locations is not None:
                     effective_locations = urs.locations
-        finally:
-            session.close()
-            engine.dispose()
 
         if not effective_locations:
             return children, []
@@ -1499,7 +1611,7 @@ def callbacks_map(app: Dash):
 
         if polygons:
             tmp_layer = dl.LayerGroup(children=polygons, id=f'tmp_layer_{time.time()}')
-            children = [tmp_layer] + children
+            children = temp_elements_patch(report_polygons=[tmp_layer])
 
         return children, dot_locations or []
 
@@ -1515,10 +1627,9 @@ def callbacks_map(app: Dash):
         Input('geocoder_entity_dropdown', 'value'),
         State('geocoder_entities', 'data'),
         State('geocoder_types', 'data'),
-        State('map', 'children'),
         prevent_initial_call=True
     )
-    def show_entities(sel, entities, types, children):
+    def show_entities(sel, entities, types):
 
         if sel is None or not entities:
             raise PreventUpdate
@@ -1526,9 +1637,6 @@ def callbacks_map(app: Dash):
         # sel holds the index of the selected entity in the dropdown
         sel = int(sel)
 
-        # remove previous geocoder markers
-        base = get_children(children)
-
         # build markers for every entity
         markers = []
         rectangles = []
@@ -1599,7 +1707,8 @@ def callbacks_map(app: Dash):
         sel_desc = sel_e.get('name', '')
         sel_url = f"https://www.openstreetmap.org/{sel_e['osm_type']}/{sel_e['osm_id']}"
 
-        new_children = base + markers + rectangles
+        # replaces the previous geocoder markers, the report polygons are removed as well
+        new_children = temp_elements_patch(geocoder=markers + rectangles)
 
         return type_children, sel_desc, sel_url, sel_url, f'Latitude: {sel_lat}', f'Longitude: {sel_lon}', new_children
 
@@ -1778,8 +1887,7 @@ def callbacks_map(app: Dash):
         is_initial_load = not old_loaded_at
 
         initial_pending_count = 0
-        engine, session = autoconnect_db()
-        try:
+        with session_scope() as session:
             def _query_reports_inner(since=None):
                 q = session.query(Report).filter(Report.timestamp <= datetime.now(timezone.utc))
                 if since:
@@ -1835,12 +1943,9 @@ def callbacks_map(app: Dash):
                         filter_platform=eff_platform, filter_event_type=eff_events,
                         filter_relevance_type=eff_relevance,
                         loc_filter=event_type_toggle or 'all',
-                        new_ids=new_ids, added_ids=added_ids,
+                        new_ids=new_ids, added_ids=added_ids, username=username,
                         **_vis_flags(filter_visibility),
                     )
-        finally:
-            session.close()
-            engine.dispose()
 
         _banner_base = {
             'display': 'block', 'width': '100%', 'margin-bottom': '6px',
@@ -1861,8 +1966,7 @@ def callbacks_map(app: Dash):
             pending = []
             if old_loaded_at:
                 try:
-                    engine2, session2 = autoconnect_db()
-                    try:
+                    with session_scope() as session2:
                         q = session2.query(Report).filter(Report.timestamp <= datetime.now(timezone.utc))
                         if os.environ.get('DEMO_MODE') == '1':
                             q = q.filter(Report.identifier.like('demo-%'))
@@ -1881,16 +1985,12 @@ def callbacks_map(app: Dash):
                             _vis_flags(filter_visibility),
                         )
                         pending = [r for r in pending if r.id not in added_ids]
-                    finally:
-                        session2.close()
-                        engine2.dispose()
                 except Exception:
                     pending = []
 
             if autoupdate and 'on' in autoupdate and pending:
                 # Auto-update on: admit pending posts immediately, same as interval path.
-                engine3, session3 = autoconnect_db()
-                try:
+                with session_scope() as session3:
                     _bulk_admit_reports(username, [r.id for r in pending], session3)
                     session3.commit()
                     _, _, _, _, _, snapshot = _get_user_state(username, session3)
@@ -1899,9 +1999,6 @@ def callbacks_map(app: Dash):
                         event_type_toggle, username=username, session=session3,
                         filter_visibility=filter_visibility, lang=lang,
                     )
-                finally:
-                    session3.close()
-                    engine3.dispose()
                 return sidebar_content, reset_active, datetime.now(timezone.utc).isoformat(), new_posts_label(lang, 0), _banner_idle, snapshot, dash.no_update
 
             count = len(pending)
@@ -1941,14 +2038,13 @@ def callbacks_map(app: Dash):
         except Exception:
             raise PreventUpdate
         eff_platform, eff_events, eff_relevance = _normalize_filters(filter_platform, filter_event_type, filter_relevance_type)
-        engine, session = autoconnect_db()
         _banner_base = {
             'display': 'block', 'width': '100%', 'margin-bottom': '6px',
             'font-size': '9px', 'padding': '4px 8px', 'cursor': 'pointer',
             'border-radius': '4px', 'text-align': 'center',
         }
         _banner_idle = {**_banner_base, 'border': '1px solid #ddd', 'background': '#f5f5f5', 'color': '#aaa', 'font-weight': 'normal'}
-        try:
+        with session_scope() as session:
             seen_ids, flagged_authors, user_locs_map, added_ids, new_ids, snapshot = _get_user_state(username, session)
 
             q = session.query(Report).filter(
@@ -1996,9 +2092,6 @@ def callbacks_map(app: Dash):
 
             # Manual mode: show banner only, no state change
             return new_posts_label(lang, count), {**_banner_base, 'border': '1px solid #42a5f5', 'background': '#e3f2fd', 'color': '#1565c0', 'font-weight': 'bold'}, dash.no_update, dash.no_update, dash.no_update
-        finally:
-            session.close()
-            engine.dispose()
     
     # toggle the layers widget
     @app.callback(
@@ -2124,8 +2217,7 @@ def callbacks_map(app: Dash):
     def fetch_report_dots(_n, filter_platform, filter_event_type, filter_relevance_type, loc_filter,
                           filter_visibility, username):
         eff_platform, eff_events, eff_relevance = _normalize_filters(filter_platform, filter_event_type, filter_relevance_type)
-        engine, session = autoconnect_db()
-        try:
+        with session_scope() as session:
             if username:
                 seen_ids, flagged_authors, user_locs_map, added_ids, new_ids, _ = _get_user_state(username, session)
             else:
@@ -2137,12 +2229,9 @@ def callbacks_map(app: Dash):
                                 filter_platform=eff_platform,
                                 filter_event_type=eff_events,
                                 filter_relevance_type=eff_relevance,
-                                new_ids=new_ids, added_ids=added_ids,
+                                new_ids=new_ids, added_ids=added_ids, username=username,
                                 loc_filter=loc_filter or 'all',
                                 **_vis_flags(filter_visibility))
-        finally:
-            session.close()
-            engine.dispose()
 
     # Fit the map to all georeferenced locations of the clicked report
     @app.callback(
@@ -2158,8 +2247,7 @@ def callbacks_map(app: Dash):
         if not triggered:
             raise PreventUpdate
         report_id = triggered['index']
-        engine, session = autoconnect_db()
-        try:
+        with session_scope() as session:
             # look up locations: user override first, then DB
             locs = None
             if username:
@@ -2171,9 +2259,6 @@ def callbacks_map(app: Dash):
             if locs is None:
                 report = session.query(Report).filter(Report.id == report_id).first()
                 locs = report.locations if report else []
-        finally:
-            session.close()
-            engine.dispose()
         georef = [loc for loc in (locs or []) if 'osm_id' in loc and loc.get('lat') and loc.get('lon')]
         if not georef:
             raise PreventUpdate
@@ -2231,8 +2316,7 @@ def callbacks_map(app: Dash):
 
         eff_platform, eff_events, eff_relevance = _normalize_filters(filter_platform, filter_event_type, filter_relevance_type)
 
-        engine, session = autoconnect_db()
-        try:
+        with session_scope() as session:
             # Get current hide state
             existing = session.query(UserReportState).filter_by(
                 username=username, report_id=report_id
@@ -2247,7 +2331,7 @@ def callbacks_map(app: Dash):
                                 user_locs_map=user_locs_map,
                                 filter_platform=eff_platform, filter_event_type=eff_events,
                                 filter_relevance_type=eff_relevance, loc_filter=event_type_toggle or 'all',
-                                new_ids=new_ids, added_ids=added_ids, **vis)
+                                new_ids=new_ids, added_ids=added_ids, username=username, **vis)
             sidebar = _build_sidebar_content(
                 filter_platform, filter_event_type, filter_relevance_type,
                 event_type_toggle, username=username, session=session,
@@ -2255,9 +2339,6 @@ def callbacks_map(app: Dash):
                 max_timestamp=loaded_at, lang=lang or 'de',
             )
             return snapshot, dots, sidebar
-        finally:
-            session.close()
-            engine.dispose()
 
     # Server-side flag toggle — replaces the JS _toggleAuthorFlag for sidebar flag buttons
     @app.callback(
@@ -2293,8 +2374,7 @@ def callbacks_map(app: Dash):
 
         eff_platform, eff_events, eff_relevance = _normalize_filters(filter_platform, filter_event_type, filter_relevance_type)
 
-        engine, session = autoconnect_db()
-        try:
+        with session_scope() as session:
             # Determine current flag state for this author
             existing_flagged = session.query(UserReportState).filter_by(
                 username=username, flag=True, flag_author=author
@@ -2329,7 +2409,7 @@ def callbacks_map(app: Dash):
                                 user_locs_map=user_locs_map,
                                 filter_platform=eff_platform, filter_event_type=eff_events,
                                 filter_relevance_type=eff_relevance, loc_filter=event_type_toggle or 'all',
-                                new_ids=new_ids, added_ids=added_ids, **vis)
+                                new_ids=new_ids, added_ids=added_ids, username=username, **vis)
             sidebar = _build_sidebar_content(
                 filter_platform, filter_event_type, filter_relevance_type,
                 event_type_toggle, username=username, session=session,
@@ -2337,9 +2417,6 @@ def callbacks_map(app: Dash):
                 max_timestamp=loaded_at, lang=lang or 'de',
             )
             return snapshot, dots, sidebar
-        finally:
-            session.close()
-            engine.dispose()
 
     # Clientside: push dot data + report-state to JS globals; update sidebar DOM in one pass
     app.clientside_callback(
@@ -2506,11 +2583,13 @@ def callbacks_map(app: Dash):
         kwargs may include: hide, flag, flag_author, locations, first_seen_at, new
         Silently skips if report_id no longer exists in the reports table.
         """
-        if not session.query(Report.id).filter(Report.id == report_id).scalar():
+        report_timestamp = session.query(Report.timestamp).filter(Report.id == report_id).scalar()
+        if report_timestamp is None:
             return
         stmt = pg_insert(UserReportState).values(
             username=username,
             report_id=report_id,
+            report_timestamp=report_timestamp,
             **kwargs,
         )
         update_cols = {k: stmt.excluded[k] for k in kwargs}
@@ -2519,6 +2598,9 @@ def callbacks_map(app: Dash):
             set_=update_cols,
         )
         session.execute(stmt)
+        # keep the users rows in report_locations in sync with the override
+        if 'locations' in kwargs:
+            sync_report_locations(session, report_id, kwargs['locations'], username=username)
 
     def _bulk_admit_reports(username, report_ids, session):
         """
@@ -2526,10 +2608,15 @@ def callbacks_map(app: Dash):
         Rows that don't exist yet are created with defaults (hide=False, flag=False).
         """
         now = datetime.now(timezone.utc)
+        # the state rows are partitioned by the timestamp of their report
+        report_timestamps = dict(session.query(Report.id, Report.timestamp).filter(Report.id.in_(list(report_ids))).all())
         for rid in report_ids:
+            if rid not in report_timestamps:
+                continue
             stmt = pg_insert(UserReportState).values(
                 username=username,
                 report_id=rid,
+                report_timestamp=report_timestamps[rid],
                 first_seen_at=now,
                 hide=False,
                 flag=False,
@@ -2549,19 +2636,7 @@ def callbacks_map(app: Dash):
         if vis.get('hide_unflagged'):
             reports = [r for r in reports if r.author and r.author in flagged_authors]
         if loc_filter != 'all':
-            filtered = []
-            for r in reports:
-                eff_locs = user_locs_map.get(r.id, r.locations) or []
-                has_loc  = any('osm_id' in e for e in eff_locs)
-                has_pend = not has_loc and bool(eff_locs)
-                if loc_filter == 'localized' and not has_loc:
-                    continue
-                if loc_filter == 'pending' and not has_pend:
-                    continue
-                if loc_filter == 'unlocalized' and (has_loc or has_pend):
-                    continue
-                filtered.append(r)
-            reports = filtered
+            reports = [r for r in reports if (location_status(user_locs_map[r.id]) if r.id in user_locs_map else r.location_status) == loc_filter]
         return reports
 
     def _render_sidebar(session, filter_platform, filter_event_type, filter_relevance_type, event_type_toggle, seen_ids=None, flagged_authors=None, user_locs_map=None, filter_visibility=None, added_ids=None, max_timestamp=None):
@@ -2584,8 +2659,25 @@ def callbacks_map(app: Dash):
                     filter_platform=None, filter_event_type=None,
                     filter_relevance_type=None, loc_filter='all',
                     hide_seen=False, hide_flagged=False, hide_unflagged=False,
-                    new_ids=None, added_ids=None):
-        q = session.query(Report).filter(Report.timestamp <= datetime.now(timezone.utc))
+                    new_ids=None, added_ids=None, username=None):
+        """
+        Build the report dots with a single query over reports joined with their georeferenced report_locations.
+        For reports in user_locs_map the locations of the users override are used, see effective_locations().
+        """
+        _seen_ids = seen_ids or set()
+        _flagged = flagged_authors or set()
+        q = session.query(
+            Report.id, Report.text, Report.author, Report.platform, Report.timestamp,
+            Report.event_type, Report.relevance, Report.url,
+            ReportLocation.name, ReportLocation.mention, ReportLocation.display_name,
+            func.ST_Y(ReportLocation.geometry).label('lat'), func.ST_X(ReportLocation.geometry).label('lon'),
+        ).join(ReportLocation, ReportLocation.report_id == Report.id)
+        q = q.filter(
+            effective_locations(username, (user_locs_map or {}).keys()),
+            ReportLocation.osm_id.isnot(None),
+            ReportLocation.geometry.isnot(None),
+            Report.timestamp <= datetime.now(timezone.utc),
+        )
         if os.environ.get('DEMO_MODE') == '1':
             q = q.filter(Report.identifier.like('demo-%'))
         if filter_platform:
@@ -2597,51 +2689,35 @@ def callbacks_map(app: Dash):
             q = q.filter(Report.relevance.in_(filter_relevance_type))
         if added_ids:
             q = q.filter(Report.id.in_(added_ids))
-        reports = q.all()
-        _seen_ids = seen_ids or set()
-        _flagged = flagged_authors or set()
-        if hide_seen:
-            reports = [r for r in reports if r.id not in _seen_ids]
-        if hide_flagged:
-            reports = [r for r in reports if not r.author or r.author not in _flagged]
+        loc_condition = location_filter_clause(loc_filter, user_locs_map)
+        if loc_condition is not None:
+            q = q.filter(loc_condition)
+        if hide_seen and _seen_ids:
+            q = q.filter(Report.id.notin_(_seen_ids))
+        if hide_flagged and _flagged:
+            from sqlalchemy import or_ as _or
+            q = q.filter(_or(Report.author.is_(None), Report.author.notin_(_flagged)))
         if hide_unflagged:
-            reports = [r for r in reports if r.author and r.author in _flagged]
+            q = q.filter(Report.author.in_(_flagged))
+        q = q.order_by(Report.id, ReportLocation.position)
         dots = []
-        for r in reports:
-            # location filter
-            if loc_filter != 'all':
-                effective = (user_locs_map or {}).get(r.id, r.locations) or []
-                is_localized = any('osm_id' in l for l in effective)
-                has_pending  = not is_localized and bool(effective)
-                if loc_filter == 'localized' and not is_localized:
-                    continue
-                if loc_filter == 'pending' and not has_pending:
-                    continue
-                if loc_filter == 'unlocalized' and (is_localized or has_pending):
-                    continue
-            effective_locs = (user_locs_map or {}).get(r.id, r.locations) or []
-            for loc in effective_locs:
-                if 'osm_id' not in loc:
-                    continue
-                lat, lon = loc.get('lat'), loc.get('lon')
-                if lat is None or lon is None:
-                    continue
-                dots.append({
-                    'report_id': r.id,
-                    'lat': lat,
-                    'lon': lon,
-                    'seen': r.id in (seen_ids or set()),
-                    'new': r.id in (new_ids or set()),
-                    'location_name': loc.get('name') or loc.get('mention') or '',
-                    'location_display': loc.get('display_name') or '',
-                    'text': (r.text or '')[:300],
-                    'author': r.author or '',
-                    'platform': r.platform or '',
-                    'timestamp': r.timestamp.strftime('%H:%M %d.%m.%Y') if r.timestamp else '',
-                    'event_type': r.event_type or '',
-                    'relevance': r.relevance or '',
-                    'url': r.url or '',
-                })
+        for row in q:
+            dots.append({
+                'report_id': row.id,
+                'lat': row.lat,
+                'lon': row.lon,
+                'seen': row.id in _seen_ids,
+                'new': row.id in (new_ids or set()),
+                'location_name': row.name or row.mention or '',
+                'location_display': row.display_name or '',
+                'text': (row.text or '')[:300],
+                'author': row.author or '',
+                'platform': row.platform or '',
+                'timestamp': row.timestamp.strftime('%H:%M %d.%m.%Y') if row.timestamp else '',
+                'event_type': row.event_type or '',
+                'relevance': row.relevance or '',
+                'url': row.url or '',
+            })
         return dots
 
     # ---- Location picking: enter pick mode (add new) ----
@@ -2677,8 +2753,7 @@ def callbacks_map(app: Dash):
             loc_index = id_dict.get('loc')
         except Exception:
             raise PreventUpdate
-        engine, session = autoconnect_db()
-        try:
+        with session_scope() as session:
             r = session.query(Report).filter(Report.id == report_id).first()
             effective_locs = r.locations if r else []
             if username:
@@ -2692,9 +2767,6 @@ def callbacks_map(app: Dash):
             if 0 <= loc_index < len(effective_locs):
                 loc = effective_locs[loc_index]
                 mention = loc.get('mention') or ''  # only the original surface form, never the resolved name
-        finally:
-            session.close()
-            engine.dispose()
         return {'report_id': report_id, 'loc_index': loc_index, 'mention': mention}
 
     # ---- Location picking: cancel pick mode ----
@@ -2806,8 +2878,7 @@ def callbacks_map(app: Dash):
         if isinstance(pick_mode, dict) and pick_mode.get('mention'):
             new_loc['mention'] = pick_mode['mention']
 
-        engine, session = autoconnect_db()
-        try:
+        with session_scope() as session:
             r = session.query(Report).filter(Report.id == report_id).first()
             if r is None:
                 raise PreventUpdate
@@ -2829,11 +2900,8 @@ def callbacks_map(app: Dash):
                                       filter_visibility=filter_visibility, added_ids=added_ids, max_timestamp=loaded_at)
             dots = _build_dots(session, seen_ids=seen_ids, flagged_authors=flagged_authors, user_locs_map=user_locs_map,
                                 filter_platform=eff_p, filter_event_type=eff_e, filter_relevance_type=eff_r,
-                                loc_filter=event_type_toggle or 'all', new_ids=new_ids, added_ids=added_ids, **_vis_flags(filter_visibility))
+                                loc_filter=event_type_toggle or 'all', new_ids=new_ids, added_ids=added_ids, username=username, **_vis_flags(filter_visibility))
             return None, sidebar, dots, (loc_rev or 0) + 1
-        finally:
-            session.close()
-            engine.dispose()
 
     # ---- Location picking: show/hide overlay (server-side) ----
     _overlay_base_style = {
@@ -2897,8 +2965,7 @@ def callbacks_map(app: Dash):
         report_id = pick_mode.get('report_id') if isinstance(pick_mode, dict) else pick_mode
         loc_index = pick_mode.get('loc_index') if isinstance(pick_mode, dict) else None
 
-        engine, session = autoconnect_db()
-        try:
+        with session_scope() as session:
             r = session.query(Report).filter(Report.id == report_id).first()
             if r is None:
                 raise PreventUpdate
@@ -2925,11 +2992,8 @@ def callbacks_map(app: Dash):
                                       filter_visibility=filter_visibility, added_ids=added_ids, max_timestamp=loaded_at)
             dots = _build_dots(session, seen_ids=seen_ids, flagged_authors=flagged_authors, user_locs_map=user_locs_map,
                                 filter_platform=eff_p, filter_event_type=eff_e, filter_relevance_type=eff_r,
-                                loc_filter=event_type_toggle or 'all', new_ids=new_ids, added_ids=added_ids, **_vis_flags(filter_visibility))
+                                loc_filter=event_type_toggle or 'all', new_ids=new_ids, added_ids=added_ids, username=username, **_vis_flags(filter_visibility))
             return None, sidebar, dots, (loc_rev or 0) + 1
-        finally:
-            session.close()
-            engine.dispose()
 
     # ---- Location removal ----
     @app.callback(
@@ -2962,8 +3026,7 @@ def callbacks_map(app: Dash):
         if report_id is None or loc_index is None:
             raise PreventUpdate
 
-        engine, session = autoconnect_db()
-        try:
+        with session_scope() as session:
             r = session.query(Report).filter(Report.id == report_id).first()
             if r is None:
                 raise PreventUpdate
@@ -2982,11 +3045,8 @@ def callbacks_map(app: Dash):
                                       filter_visibility=filter_visibility, added_ids=added_ids, max_timestamp=loaded_at)
             dots = _build_dots(session, seen_ids=seen_ids, flagged_authors=flagged_authors, user_locs_map=user_locs_map,
                                 filter_platform=eff_p, filter_event_type=eff_e, filter_relevance_type=eff_r,
-                                loc_filter=event_type_toggle or 'all', new_ids=new_ids, added_ids=added_ids, **_vis_flags(filter_visibility))
+                                loc_filter=event_type_toggle or 'all', new_ids=new_ids, added_ids=added_ids, username=username, **_vis_flags(filter_visibility))
             return sidebar, dots, (loc_rev or 0) + 1
-        finally:
-            session.close()
-            engine.dispose()
 
     # ---- Restore original locations ----
     @app.callback(
@@ -3018,8 +3078,7 @@ def callbacks_map(app: Dash):
             raise PreventUpdate
 
         eff_p, eff_e, eff_r = _normalize_filters(filter_platform, filter_event_type, filter_relevance_type)
-        engine, session = autoconnect_db()
-        try:
+        with session_scope() as session:
             # Clear user location override (set locations=None)
             _upsert_user_state(username, report_id, session, locations=None)
             session.commit()
@@ -3030,11 +3089,8 @@ def callbacks_map(app: Dash):
                                       filter_visibility=filter_visibility, added_ids=added_ids, max_timestamp=loaded_at)
             dots = _build_dots(session, seen_ids=seen_ids, flagged_authors=flagged_authors, user_locs_map=user_locs_map,
                                 filter_platform=eff_p, filter_event_type=eff_e, filter_relevance_type=eff_r,
-                                loc_filter=event_type_toggle or 'all', new_ids=new_ids, added_ids=added_ids, **_vis_flags(filter_visibility))
+                                loc_filter=event_type_toggle or 'all', new_ids=new_ids, added_ids=added_ids, username=username, **_vis_flags(filter_visibility))
             return sidebar, dots, (loc_rev or 0) + 1
-        finally:
-            session.close()
-            engine.dispose()
 
     # ---- Demo: reset button ----
     @app.callback(
@@ -3053,8 +3109,7 @@ def callbacks_map(app: Dash):
         if not n_clicks:
             raise PreventUpdate
         from data.build import seed_demo_data
-        engine, session = autoconnect_db()
-        try:
+        with session_scope() as session:
             seed_demo_data(session)
             # Clear all existing user state so nothing is pre-admitted.
             if username:
@@ -3090,9 +3145,6 @@ def callbacks_map(app: Dash):
                            {**_banner_base, 'border': '1px solid #ddd', 'background': '#f5f5f5',
                             'color': '#aaa', 'font-weight': 'normal'}
             return [], [], snapshot, loaded_at, new_posts_label(lg, count), banner_style
-        finally:
-            session.close()
-            engine.dispose()
 
     # ---- Persist filter state across page reloads ----
     @app.callback(
@@ -3153,8 +3205,7 @@ def callbacks_map(app: Dash):
         from sqlalchemy import func as sqlfunc
         if not username:
             raise PreventUpdate
-        engine, session = autoconnect_db()
-        try:
+        with session_scope() as session:
             # Count ALL current posts (admitted + pending banner posts)
             filters = [Report.timestamp <= datetime.now(timezone.utc)]
             if os.environ.get('DEMO_MODE') == '1':
@@ -3191,9 +3242,6 @@ def callbacks_map(app: Dash):
                 for r in ALL_RELEVANCE_TYPES
             ]
             return chip_children, plat_options, rel_options
-        finally:
-            session.close()
-            engine.dispose()
 
     # Visibility counts derived from snapshot (no DB round-trip needed)
     app.clientside_callback(
@@ -5,12 +5,43 @@ from datetime import datetime, timedelta
 from dash import Dash, html, dcc, Output, Input, State, callback_context, MATCH, ALL
 from dash.exceptions import PreventUpdate
 import dash_leaflet as dl
-from sqlalchemy import or_
+from sqlalchemy import or_, and_
 
-from data.connect import autoconnect_db
+from data.connect import session_scope, stream_query
 from data.model import Report
 from app.i18n import t
 
+def location_status(locations) -> str:
+    """
+    Returns the location status of a list of locations: `'localized'`, `'pending'` or `'unlocalized'`.
+    The database keeps the same status of every report in `Report.location_status`, this is only needed for user overridden locations.
+    """
+
+    if any('osm_id' in loc for loc in (locations or [])):
+        return 'localized'
+    if locations:
+        return 'pending'
+    return 'unlocalized'
+
+def location_filter_clause(loc_filter, user_locs_map=None):
+    """
+    Returns the SQL condition for the location filter (`'localized'`, `'pending'` or `'unlocalized'`), or None for `'all'`.
+    Reports with user overridden locations (user_locs_map) are checked in Python and included or excluded by their id,
+    all other reports are filtered on the generated `Report.location_status` column in the database.
+    """
+
+    if loc_filter not in ('localized', 'pending', 'unlocalized'):
+        return None
+
+    condition = Report.location_status == loc_filter
+
+    if user_locs_map:
+        overridden_ids = [int(report_id) for report_id in user_locs_map]
+        matching_ids = [int(report_id) for report_id, locations in user_locs_map.items() if location_status(locations) == loc_filter]
+        condition = or_(Report.id.in_(matching_ids), and_(Report.id.notin_(overridden_ids), condition))
+
+    return condition
+
 
 
 # the path to the config file that contains the platform specific information
@@ -43,8 +74,9 @@ def format_report(report: Report, seen_ids=None, flagged_authors=None, user_locs
     effective_locations = (user_locs_map or {}).get(report.id, report.locations)
     has_user_override = user_locs_map is not None and report.id in user_locs_map
 
-    is_localized = any('osm_id' in loc for loc in (effective_locations or []))
-    has_pending  = not is_localized and bool(effective_locations)   # has locations but none georeferenced
+    status = location_status(effective_locations) if has_user_override else report.location_status
+    is_localized = status == 'localized'
+    has_pending  = status == 'pending'   # has locations but none georeferenced
 
     if platform == 'rss':
         feed_name = report.platform.split('/')[1]
@@ -352,7 +384,6 @@ def get_sidebar_content(n=25, filter_platform=None, filter_event_type=None, filt
     flagged_authors: set of author strings flagged (from browser localStorage)
     user_locs_map: dict mapping report_id -> [loc, ...] (from browser localStorage)
     """
-    engine, session = autoconnect_db()
     filter_arguments = []
 
     if filter_platform:
@@ -390,46 +421,54 @@ def get_sidebar_content(n=25, filter_platform=None, filter_event_type=None, filt
     if os.environ.get('DEMO_MODE') == '1':
         filter_arguments.append(Report.identifier.like('demo-%'))
 
-    query = session.query(Report)
-    if filter_arguments:
-        query = query.filter(*filter_arguments)
-
-    reports = query.order_by(Report.timestamp.desc()).all()
-
-    session.close()
-
     seen_ids = seen_ids or set()
     flagged_authors = flagged_authors or set()
     user_locs_map = user_locs_map or {}
 
-    if hide_seen:
-        reports = [r for r in reports if r.id not in seen_ids]
-    if hide_flagged:
-        reports = [r for r in reports if not r.author or r.author not in flagged_authors]
-    if hide_unflagged:
-        reports = [r for r in reports if r.author and r.author in flagged_authors]
+    with session_scope() as session:
+
+        # stream only the columns needed for filtering, newest first, and stop as soon as n reports matched
+        # this keeps memory flat no matter how many reports are in the table
+        query = session.query(Report.id, Report.author)
+        if filter_arguments:
+            query = query.filter(*filter_arguments)
+
+        # the location filter runs in the database on the location status column
+        loc_condition = location_filter_clause(loc_filter, user_locs_map)
+        if loc_condition is not None:
+            query = query.filter(loc_condition)
+
+        query = query.order_by(Report.timestamp.desc())
+
+        report_ids = []
+
+        for report_id, author in stream_query(query, batch_size=max(n, 100)):
+            if hide_seen and report_id in seen_ids:
+                continue
+            if hide_flagged and author and author in flagged_authors:
+                continue
+            if hide_unflagged and not (author and author in flagged_authors):
+                continue
+
+            report_ids.append(report_id)
+
+            if len(report_ids) >= n:
+                break
+
+        # load the full reports only for the ones that are displayed
+        reports = session.query(Report).filter(Report.id.in_(report_ids)).all() if report_ids else []
+
+    # restore the order of the stream
+    order = {report_id: i for i, report_id in enumerate(report_ids)}
+    reports.sort(key=lambda report: order[report.id])
 
     if loc_filter == 'all':
         return format_reports(reports, n, seen_ids=seen_ids, flagged_authors=flagged_authors, user_locs_map=user_locs_map, new_ids=new_ids, lang=lang)
 
-    filtered_reports = []
-    for report in reports:
-        effective_locs = user_locs_map.get(report.id, report.locations)
-        has_location = any('osm_id' in e for e in (effective_locs or []))
-        has_pending = not has_location and bool(effective_locs)
-        if loc_filter == 'localized' and not has_location:
-            continue
-        if loc_filter == 'pending' and not has_pending:
-            continue
-        if loc_filter == 'unlocalized' and (has_location or has_pending):
-            continue
-        filtered_reports.append(report)
-
-    return format_reports(filtered_reports, n, seen_ids=seen_ids, flagged_authors=flagged_authors, user_locs_map=user_locs_map, lang=lang)
+    return format_reports(reports, n, seen_ids=seen_ids, flagged_authors=flagged_authors, user_locs_map=user_locs_map, lang=lang)
 
 def get_sidebar_max_timestamp(filter_platform=None, filter_event_type=None, filter_relevance_type=None):
     """Return the max timestamp (as ISO string) of reports currently visible given the filters."""
-    engine, session = autoconnect_db()
     filter_arguments = []
     if filter_platform:
         filter_arguments.append(or_(*[Report.platform.like(f'{p}%') for p in filter_platform]))
@@ -440,12 +479,10 @@ def get_sidebar_max_timestamp(filter_platform=None, filter_event_type=None, filt
     filter_arguments.append(Report.timestamp <= datetime.utcnow())
     if os.environ.get('DEMO_MODE') == '1':
         filter_arguments.append(Report.identifier.like('demo-%'))
-    try:
+    with session_scope() as session:
         from sqlalchemy import func
         result = session.query(func.max(Report.timestamp)).filter(*filter_arguments).scalar()
         return result.isoformat() if result else None
-    finally:
-        session.close()
 
 def get_sidebar_dropdown_platform_values():
     """
@@ -6,41 +6,52 @@ from dash.exceptions import PreventUpdate
 
 # internal imports
 from data.model import Base, Alert
-from data.connect import autoconnect_db
+from data.connect import session_scope, stream_query
 from data.req_nina import save_alerts
 
 
 def format_table_nina(filter: str = None):
-    engine, session = autoconnect_db()
-    data = session.query(Alert).order_by(Alert.id).limit(20000).all()
-
     formatted_data = []
 
-    for row in data:
-        # Format date and other information
-        date_str = row.timestamp.strftime('%d.%m.%Y %H:%M:%S')
-        urgency_str = "High" if row.urgency == "high" else "Medium" if row.urgency == "medium" else "Low"
-
-        # if we have a filter, check if one of the columns contains the filter string
-        if filter is not None:
-            filter_l = filter.lower()
-            if filter_l not in date_str.lower() \
-                and filter_l not in row.event.lower() \
-                and filter_l not in urgency_str.lower() \
-                and filter_l not in row.sender_name.lower() \
-                and filter_l not in row.headline.lower() \
-                and filter_l not in row.description.lower():
-                continue
-
-        # Append a dictionary for each row with more detailed columns
-        formatted_data.append({
-            "Date": date_str,
-            "Event": row.event,
-            "Urgency": urgency_str,
-            "Sender": row.sender_name,
-            "Headline": row.headline,
-            "Description": row.description[:255] + ("..." if len(row.description) > 255 else "")
-        })
+    with session_scope() as session:
+
+        # only query the displayed columns, streamed from a server-side cursor
+        query = session.query(
+            Alert.timestamp,
+            Alert.event,
+            Alert.urgency,
+            Alert.sender_name,
+            Alert.headline,
+            Alert.description
+        ).order_by(Alert.id).limit(20000)
+
+        data = stream_query(query)
+
+        for row in data:
+            # Format date and other information
+            date_str = row.timestamp.strftime('%d.%m.%Y %H:%M:%S')
+            urgency_str = "High" if row.urgency == "high" else "Medium" if row.urgency == "medium" else "Low"
+
+            # if we have a filter, check if one of the columns contains the filter string
+            if filter is not None:
+                filter_l = filter.lower()
+                if filter_l not in date_str.lower() \
+                    and filter_l not in row.event.lower() \
+                    and filter_l not in urgency_str.lower() \
+                    and filter_l not in row.sender_name.lower() \
+                    and filter_l not in row.headline.lower() \
+                    and filter_l not in row.description.lower():
+                    continue
+
+            # Append a dictionary for each row with more detailed columns
+            formatted_data.append({
+                "Date": date_str,
+                "Event": row.event,
+                "Urgency": urgency_str,
+                "Sender": row.sender_name,
+                "Headline": row.headline,
+                "Description": row.description[:255] + ("..." if len(row.description) > 255 else "")
+            })
 
     formatted_columns = [
         {'name': 'Date', 'id': 'Date'},
@@ -51,15 +62,10 @@ def format_table_nina(filter: str = None):
         {'name': 'Description', 'id': 'Description'}
     ]
 
-    session.close()
-    engine.dispose()
-
     return formatted_columns, formatted_data
 
 def build_layout_nina_warnings():
 
-    engine, session = autoconnect_db()
-
     # get the data from the Alert table
     columns, data = format_table_nina()
 
@@ -94,10 +100,6 @@ def build_layout_nina_warnings():
         )
 
     ]
-
-    # close the database connection
-    session.close()
-    engine.dispose()
     
     return layout_data_viewer
 
@@ -5,7 +5,7 @@ from sqlalchemy import inspect
 
 # internal imports
 from data.model import Base, Feature, FeatureSet, Collection, Dataset, Layer, Style, Colormap, Scenario
-from data.connect import autoconnect_db
+from data.connect import get_engine, session_scope
 
 def build_scenario_dropdown():
     """
@@ -14,28 +14,22 @@ def build_scenario_dropdown():
     """
     
     # get all available scenarios
-    engine, session = autoconnect_db()
+    with session_scope() as session:
 
-    # Check if the Scenario table exists
-    inspector = inspect(engine)
+        # Check if the Scenario table exists
+        inspector = inspect(get_engine())
 
-    if 'scenarios' not in inspector.get_table_names():
-        # Close database connection and return empty list if Scenario does not exist
-        session.close()
-        engine.dispose()
-        print("Warning: Table 'scenarios' does not exist. No Scenario dropdown will be created. You can rebuild the database by running 'python main.py -rebuild'. See more information with 'python main.py -help'.")
-        return []
+        if 'scenarios' not in inspector.get_table_names():
+            # Return empty list if Scenario does not exist
+            print("Warning: Table 'scenarios' does not exist. No Scenario dropdown will be created. You can rebuild the database by running 'python main.py -rebuild'. See more information with 'python main.py -help'.")
+            return []
 
-    scenarios = session.query(Scenario).all()
+        scenarios = session.query(Scenario).all()
 
-    # sort by ID
-    scenarios.sort(key=lambda x: x.id)
+        # sort by ID
+        scenarios.sort(key=lambda x: x.id)
 
-    scenario_dropdown = [{'label': f'{scenario.name} ({scenario.id})', 'value': scenario.id} for scenario in scenarios]
-
-    # close database connection
-    session.close()
-    engine.dispose()
+        scenario_dropdown = [{'label': f'{scenario.name} ({scenario.id})', 'value': scenario.id} for scenario in scenarios]
 
     return scenario_dropdown
 
@@ -46,28 +40,22 @@ def build_feature_set_dropdown():
     """
     
     # get all available feature sets
-    engine, session = autoconnect_db()
-
-    # Check if the FeatureSet table exists
-    inspector = inspect(engine)
+    with session_scope() as session:
 
-    if 'feature_sets' not in inspector.get_table_names():
-        # Close database connection and return empty list if FeatureSet does not exist
-        session.close()
-        engine.dispose()
-        print("Warning: Table 'feature_sets' does not exist. No FeatureSet dropdown will be created. You can rebuild the database by running 'python main.py -rebuild'. See more information with 'python main.py -help'.")
-        return []
+        # Check if the FeatureSet table exists
+        inspector = inspect(get_engine())
 
-    feature_sets = session.query(FeatureSet).all()
+        if 'feature_sets' not in inspector.get_table_names():
+            # Return empty list if FeatureSet does not exist
+            print("Warning: Table 'feature_sets' does not exist. No FeatureSet dropdown will be created. You can rebuild the database by running 'python main.py -rebuild'. See more information with 'python main.py -help'.")
+            return []
 
-    # sort by ID
-    feature_sets.sort(key=lambda x: x.id)
+        feature_sets = session.query(FeatureSet).all()
 
-    feature_set_dropdown = [{'label': f'{feature_set.name} ({feature_set.id})', 'value': feature_set.id} for feature_set in feature_sets]
+        # sort by ID
+        feature_sets.sort(key=lambda x: x.id)
 
-    # close database connection
-    session.close()
-    engine.dispose()
+        feature_set_dropdown = [{'label': f'{feature_set.name} ({feature_set.id})', 'value': feature_set.id} for feature_set in feature_sets]
 
     return feature_set_dropdown
 
@@ -77,20 +65,16 @@ def get_feature_sets_scenario(scenario_id: int):
     Format: `[Name1, Name2, Name3, ...]`
     """
 
-    engine, session = autoconnect_db()
+    with session_scope() as session:
 
-    # get the scenario
-    scenario = session.query(Scenario).get(scenario_id)
+        # get the scenario
+        scenario = session.query(Scenario).get(scenario_id)
 
-    # get the scenario's feature sets
-    feature_sets = scenario.feature_sets
+        # get the scenario's feature sets
+        feature_sets = scenario.feature_sets
 
-    # get the feature set names
-    feature_set_names = [feature_set.id for feature_set in feature_sets]
-
-    # close database connection
-    session.close()
-    engine.dispose()
+        # get the feature set names
+        feature_set_names = [feature_set.id for feature_set in feature_sets]
 
     return feature_set_names
 
@@ -242,119 +226,109 @@ def callbacks_scenario_editor(app: Dash):
 
         trigger_id = callback_context.triggered[0]['prop_id'].split('.')[0]
 
-        engine, session = autoconnect_db()
+        with session_scope() as session:
 
-        scenario_name = ''
-        scenario_description = ''
-        feature_set_ids = []
-        scenario_dropdown = []
-        next_scenario_id = None
+            scenario_name = ''
+            scenario_description = ''
+            feature_set_ids = []
+            scenario_dropdown = []
+            next_scenario_id = None
 
-        if trigger_id == 'scenario_dropdown':
-            # if no scenario was selected, do nothing
-            if scenario_id is None:
-                session.close()
-                engine.dispose()
-                raise PreventUpdate
+            if trigger_id == 'scenario_dropdown':
+                # if no scenario was selected, do nothing
+                if scenario_id is None:
+                    raise PreventUpdate
             
-            # if the selected scenario is the same as the currently selected scenario, do nothing
-            # this is done to prevent circular callbacks
-            if scenario_id is selected_scenario:
-                session.close()
-                engine.dispose()
-                raise PreventUpdate
-
-            # get the scenario
-            scenario = session.query(Scenario).get(scenario_id)
-
-            # get the scenario's name and description
-            scenario_name = scenario.name
-            scenario_description = scenario.description
-            next_scenario_id = scenario.id
-
-            # get the feature set ids
-            feature_set_ids = get_feature_sets_scenario(scenario_id)
-
-        elif trigger_id == 'button_create_scenario':
-
-            # create a new scenario
-            scenario = Scenario(
-                name='New Scenario',
-                description=''
-            )
-
-            session.add(scenario)
-            session.commit()
-
-            # Reset for creating a new scenario
-            scenario_name = scenario.name
-            scenario_description = scenario.description
-            feature_set_ids = []
-            next_scenario_id = scenario.id
-        
-        elif trigger_id == 'button_delete_scenario':
-    
-            # get the scenario
-            scenario = session.query(Scenario).get(scenario_id)
+                # if the selected scenario is the same as the currently selected scenario, do nothing
+                # this is done to prevent circular callbacks
+                if scenario_id is selected_scenario:
+                    raise PreventUpdate
+
+                # get the scenario
+                scenario = session.query(Scenario).get(scenario_id)
 
-            if scenario is None:
-                session.close()
-                engine.dispose()
-                raise PreventUpdate
-    
-            # delete the scenario
-            session.delete(scenario)
-            session.commit()
-
-            # get the scenario right before the deleted one
-            scenario = session.query(Scenario).filter(Scenario.id < scenario_id).order_by(Scenario.id.desc()).first()
-
-            if scenario is None:
-                # it seems like the scenario was the first one
-                # instead, just select the first scenario
-                scenario = session.query(Scenario).first()
-
-            if scenario is None:
-                # we tried to select the first scenario, but got None
-                # this means that there are no scenarios left
-                scenario_name = ''
-                scenario_description = ''
-                feature_set_ids = []
-                next_scenario_id = None
-            else:
                 # get the scenario's name and description
                 scenario_name = scenario.name
                 scenario_description = scenario.description
-                feature_set_ids = get_feature_sets_scenario(scenario.id)
                 next_scenario_id = scenario.id
 
-        elif trigger_id == 'button_refresh_scenarios':
+                # get the feature set ids
+                feature_set_ids = get_feature_sets_scenario(scenario_id)
 
-            # get the scenario with the id from selected_scenario
-            scenario = session.query(Scenario).get(selected_scenario)
+            elif trigger_id == 'button_create_scenario':
 
-            if scenario is None:
-                # it seems like the selected scenario was just deleted
-                # instead, now select the first scenario
-                scenario = session.query(Scenario).first()	
-            
-            if scenario is None:
-                # we tried to select the first scenario, but got None
-                # this means that there are no scenarios left
-                scenario_name = ''
-                scenario_description = ''
-                feature_set_ids = []
-                next_scenario_id = None
-            else:
-                # get the scenario's name and description
+                # create a new scenario
+                scenario = Scenario(
+                    name='New Scenario',
+                    description=''
+                )
+
+                session.add(scenario)
+                session.commit()
+
+                # Reset for creating a new scenario
                 scenario_name = scenario.name
                 scenario_description = scenario.description
-                feature_set_ids = get_feature_sets_scenario(scenario.id)
+                feature_set_ids = []
                 next_scenario_id = scenario.id
         
-        # close database connection
-        session.close()
-        engine.dispose()
+            elif trigger_id == 'button_delete_scenario':
+    
+                # get the scenario
+                scenario = session.query(Scenario).get(scenario_id)
+
+                if scenario is None:
+                    raise PreventUpdate
+    
+                # delete the scenario
+                session.delete(scenario)
+                session.commit()
+
+                # get the scenario right before the deleted one
+                scenario = session.query(Scenario).filter(Scenario.id < scenario_id).order_by(Scenario.id.desc()).first()
+
+                if scenario is None:
+                    # it seems like the scenario was the first one
+                    # instead, just select the first scenario
+                    scenario = session.query(Scenario).first()
+
+                if scenario is None:
+                    # we tried to select the first scenario, but got None
+                    # this means that there are no scenarios left
+                    scenario_name = ''
+                    scenario_description = ''
+                    feature_set_ids = []
+                    next_scenario_id = None
+                else:
+                    # get the scenario's name and description
+                    scenario_name = scenario.name
+                    scenario_description = scenario.description
+                    feature_set_ids = get_feature_sets_scenario(scenario.id)
+                    next_scenario_id = scenario.id
+
+            elif trigger_id == 'button_refresh_scenarios':
+
+                # get the scenario with the id from selected_scenario
+                scenario = session.query(Scenario).get(selected_scenario)
+
+                if scenario is None:
+                    # it seems like the selected scenario was just deleted
+                    # instead, now select the first scenario
+                    scenario = session.query(Scenario).first()	
+            
+                if scenario is None:
+                    # we tried to select the first scenario, but got None
+                    # this means that there are no scenarios left
+                    scenario_name = ''
+                    scenario_description = ''
+                    feature_set_ids = []
+                    next_scenario_id = None
+                else:
+                    # get the scenario's name and description
+                    scenario_name = scenario.name
+                    scenario_description = scenario.description
+                    feature_set_ids = get_feature_sets_scenario(scenario.id)
+                    next_scenario_id = scenario.id
 
         # refresh the scenario dropdown
         scenario_dropdown = build_scenario_dropdown()
@@ -379,62 +353,54 @@ def callbacks_scenario_editor(app: Dash):
         # check if a scenario with that id already exists
         # if yes, override it
         # if no, create a new scenario
-        engine, session = autoconnect_db()
+        with session_scope() as session:
 
-        if feature_set_ids is None:
-            feature_set_ids = [0]
+            if feature_set_ids is None:
+                feature_set_ids = [0]
 
-        # get all FeatureSets that are selected in feature_set_ids
-        feature_sets = session.query(FeatureSet).filter(FeatureSet.id.in_(feature_set_ids)).all()
-        feature_sets = [] if feature_sets is None else feature_sets
+            # get all FeatureSets that are selected in feature_set_ids
+            feature_sets = session.query(FeatureSet).filter(FeatureSet.id.in_(feature_set_ids)).all()
+            feature_sets = [] if feature_sets is None else feature_sets
 
-        if scenario_id is None:
+            if scenario_id is None:
 
-            # discard empty scenarios
-            if name == '' and description == '':
-                session.close()
-                engine.dispose()
-                raise PreventUpdate
+                # discard empty scenarios
+                if name == '' and description == '':
+                    raise PreventUpdate
 
-            # create a new scenario
-            scenario = Scenario(
-                name=name,
-                description=description
-            )
+                # create a new scenario
+                scenario = Scenario(
+                    name=name,
+                    description=description
+                )
 
-            # add the feature sets to the scenario
-            scenario.feature_sets = feature_sets
+                # add the feature sets to the scenario
+                scenario.feature_sets = feature_sets
 
-            session.add(scenario)
-            session.commit()
+                session.add(scenario)
+                session.commit()
 
-            # get the scenario id
-            scenario_id = scenario.id
-        else:
+                # get the scenario id
+                scenario_id = scenario.id
+            else:
                 
-            # get the scenario
-            scenario = session.query(Scenario).get(scenario_id)
+                # get the scenario
+                scenario = session.query(Scenario).get(scenario_id)
 
-            if scenario is None:
-                session.close()
-                engine.dispose()
-                raise PreventUpdate
+                if scenario is None:
+                    raise PreventUpdate
     
-            # update the scenario
-            scenario.name = name
-            scenario.description = description
+                # update the scenario
+                scenario.name = name
+                scenario.description = description
 
-            # get all FeatureSets that are selected in feature_set_ids
-            feature_sets = session.query(FeatureSet).filter(FeatureSet.id.in_(feature_set_ids)).all()
+                # get all FeatureSets that are selected in feature_set_ids
+                feature_sets = session.query(FeatureSet).filter(FeatureSet.id.in_(feature_set_ids)).all()
 
-            # add the feature sets to the scenario
-            scenario.feature_sets = feature_sets
+                # add the feature sets to the scenario
+                scenario.feature_sets = feature_sets
     
-            session.commit()
-
-        # close database connection
-        session.close()
-        engine.dispose()
+                session.commit()
 
         # refresh the scenario dropdown
         scenario_dropdown = build_scenario_dropdown()
@@ -8,7 +8,6 @@ import json
 
 # internal imports
 from data.model import Base, Feature, FeatureSet, Collection, Dataset, Layer, Style, Colormap, Scenario
-from data.connect import autoconnect_db
 from data.build import get_default_style, feature_to_obj
 
 
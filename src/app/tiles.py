@@ -0,0 +1,193 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+from dotenv import load_dotenv
+from flask import Response, abort
+from sqlalchemy import text
+
+# internal imports
+from data.model import FeatureSet
+from data.connect import session_scope
+from app.convert import geometry_level, style_to_dict
+
+# the settings below are read on import, load them from .env first
+load_dotenv()
+
+# Mapbox Vector Tiles of the map layers, rendered by PostGIS with ST_AsMVT
+# every FeatureSet of a layer is its own layer inside the tile, named fs_<feature_set_id>, so the browser can style it with the Style of the FeatureSet
+# rendered tiles are cached on disk under <TILE_CACHE_DIR>/<layer_id>/<version>/<z>/<x>/<y>.pbf, the version is a hash of the
+# data versions of the FeatureSets of the layer (see data/payloads.py), so a tile is rendered again as soon as one of them changes
+
+# where the rendered tiles are stored
+TILE_CACHE_DIR = os.getenv('TILE_CACHE_DIR', os.path.join('data', 'tile_cache'))
+
+# set to True to show the layers as vector tiles by default, instead of one component per feature
+MAP_VECTOR_TILES = os.getenv('MAP_VECTOR_TILES', 'false').lower() in ('1', 'true', 'yes')
+
+# size of a tile in MVT coordinates, and the buffer around it in the same units, so lines and polygons are not cut visibly at the tile edges
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
+MVT_MIME_TYPE = 'application/vnd.mapbox-vector-tile'
+
+def mvt_layer_name(feature_set_id: int) -> str:
+    return f"fs_{feature_set_id}"
+
+def tile_version(feature_sets) -> str:
+    """
+    Returns the version of the tiles of a layer, changes whenever the features of one of its FeatureSets change.
+    """
+
+    versions = sorted((feature_set.id, feature_set.data_version) for feature_set in feature_sets)
+
+    return hashlib.md5(repr(versions).encode('utf-8')).hexdigest()[:16]
+
+def render_tile(session, feature_set_ids: list, z: int, x: int, y: int) -> bytes:
+    """
+    Renders the tile z/x/y with the features of the FeatureSets `feature_set_ids`, one MVT layer per FeatureSet.
+    Lines and polygons use the simplified geometry of the zoom level (see Feature.geometry_low and app.convert.geometry_level()).
+    The features are selected with the spatial index on features.geometry. Returns an empty bytes object if no feature is in the tile.
+    """
+
+    level = geometry_level(z)
+    geometry = 'f.geometry' if level == 'geometry' else f'COALESCE(f.{level}, f.geometry)'
+
+    tile = b''
+
+    for feature_set_id in feature_set_ids:
+        data = session.execute(text(f"""
+            WITH bounds AS (
+                SELECT ST_TileEnvelope(:z, :x, :y) AS tile, ST_Transform(ST_TileEnvelope(:z, :x, :y, margin => :margin), 4326) AS query
+            ), mvt AS (
+                SELECT f.id, f.properties, f.feature_set_id AS _feature_set,
+                    ST_AsMVTGeom(ST_Transform({geometry}, 3857), bounds.tile, :extent, :buffer, true) AS geom
+                FROM features f, bounds
+                WHERE f.feature_set_id = :feature_set_id AND f.geometry && bounds.query
+            )
+            SELECT ST_AsMVT(mvt, :name, :extent, 'geom', 'id') FROM mvt WHERE geom IS NOT NULL
+        """), {
+            'z': z, 'x': x, 'y': y,
+            'margin': TILE_BUFFER / TILE_EXTENT,
+            'extent': TILE_EXTENT,
+            'buffer': TILE_BUFFER,
+            'feature_set_id': feature_set_id,
+            'name': mvt_layer_name(feature_set_id),
+        }).scalar()
+
+        # the layers of a tile are independent, the tiles of single layers can be concatenated
+        if data:
+            tile += bytes(data)
+
+    return tile
+
+def _write_atomic(path: str, data: bytes):
+    # several workers may render the same tile at the same time
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def remove_outdated_tiles(layer_id: int, version: str):
+    """
+    Removes the cached tiles of all other versions of the layer.
+    """
+
+    layer_dir = os.path.join(TILE_CACHE_DIR, str(layer_id))
+
+    if not os.path.isdir(layer_dir):
+        return
+
+    for name in os.listdir(layer_dir):
+        if name != version:
+            shutil.rmtree(os.path.join(layer_dir, name), ignore_errors=True)
+
+def get_tile(layer_id: int, z: int, x: int, y: int):
+    """
+    Returns the tile z/x/y of the layer from the disk cache, renders and caches it if needed.
+    Returns None if the layer does not exist.
+    """
+
+    with session_scope() as session:
+
+        feature_sets = session.query(FeatureSet).filter(FeatureSet.layer_id == layer_id).all()
+
+        if not feature_sets:
+            return None
+
+        version = tile_version(feature_sets)
+        path = os.path.join(TILE_CACHE_DIR, str(layer_id), version, str(z), str(x), f"{y}.pbf")
+
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            pass
+
+        # the first tile of a new version removes the tiles of the old one
+        if not os.path.isdir(os.path.join(TILE_CACHE_DIR, str(layer_id), version)):
+            remove_outdated_tiles(layer_id, version)
+
+        tile = render_tile(session, [feature_set.id for feature_set in feature_sets], z, x, y)
+
+    _write_atomic(path, tile)
+
+    return tile
+
+def get_tile_styles(layer_ids: list) -> list:
+    """
+    Returns the vector tile configuration of the layers for the browser (see assets/vector_tiles.js):
+    a list of {layer_id, version, styles: {fs_<id>: style dict}, popups: {fs_<id>: {name, properties}}} with the leaflet style
+    and the popup properties of every FeatureSet. Points are drawn as circles in the marker color, colormaps are not applied.
+    """
+
+    layers = []
+
+    with session_scope() as session:
+        for layer_id in layer_ids:
+            feature_sets = session.query(FeatureSet).filter(FeatureSet.layer_id == layer_id).all()
+
+            styles = {}
+            popups = {}
+
+            for feature_set in feature_sets:
+                name = mvt_layer_name(feature_set.id)
+                style = style_to_dict(feature_set.style) if feature_set.style is not None else {}
+                style['radius'] = 6
+                if feature_set.style is not None and feature_set.style.marker_color:
+                    style['markerColor'] = feature_set.style.marker_color
+                styles[name] = style
+                popups[name] = {
+                    'name': feature_set.name,
+                    'properties': feature_set.style.popup_properties if feature_set.style is not None else None
+                }
+
+            # the version is part of the url, so the browser cache is invalidated together with the disk cache
+            layers.append({'layer_id': int(layer_id), 'version': tile_version(feature_sets), 'styles': styles, 'popups': popups})
+
+    return layers
+
+def register_tile_routes(server):
+    """
+    Adds the tile route /tiles/<layer_id>/<z>/<x>/<y>.pbf to the Flask server of the Dash app.
+    """
+
+    @server.route('/tiles/<int:layer_id>/<int:z>/<int:x>/<int:y>.pbf')
+    def route_tile(layer_id, z, x, y):
+
+        if z < 0 or z > 24 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            abort(404)
+
+        tile = get_tile(layer_id, z, x, y)
+
+        if tile is None:
+            abort(404)
+
+        response = Response(tile, mimetype=MVT_MIME_TYPE)
+
+        # the urls contain the version, a tile never changes
+        response.headers['Cache-Control'] = 'public, max-age=86400'
+
+        return response
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Benchmark the feature ingestion paths (see data/bulk.py).
+
+Run from the src/ directory against a running database:
+
+    python benchmark_feature_ingestion.py [--features 500000]
+
+Generates a synthetic collection of GeoJSON features (points, lines and
+polygons around Hamburg) and writes it into the features table twice: once
+with one ORM Feature per GeoJSON feature (build.feature_to_obj, the path used
+before) and once with COPY (bulk.copy_features). Prints features/second of
+both. Everything is written in one transaction that is rolled back at the end,
+the database is not changed.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+# Allow imports from src/
+sys.path.insert(0, os.path.dirname(__file__))
+
+from data.connect import session_scope
+from data.model import Feature, FeatureSet, Layer
+from data.build import feature_to_obj, get_default_style
+from data.bulk import copy_features
+
+# how many ORM features are flushed at once
+ORM_BATCH_SIZE = 10000
+
+def synthetic_features(n: int, seed: int = 0):
+    """
+    Generator of `n` GeoJSON features, a third each points, lines and polygons.
+    """
+
+    rng = random.Random(seed)
+
+    for i in range(n):
+        lon, lat = 9.7 + rng.random() * 0.5, 53.4 + rng.random() * 0.3
+
+        if i % 3 == 0:
+            geometry = {'type': 'Point', 'coordinates': [lon, lat]}
+        elif i % 3 == 1:
+            geometry = {'type': 'LineString', 'coordinates': [[lon + k * 0.001, lat + rng.random() * 0.001] for k in range(8)]}
+        else:
+            ring = [[lon, lat], [lon + 0.002, lat], [lon + 0.002, lat + 0.002], [lon, lat + 0.002], [lon, lat]]
+            geometry = {'type': 'Polygon', 'coordinates': [ring]}
+
+        yield {
+            'type': 'Feature',
+            'geometry': geometry,
+            'properties': {'id': i, 'name': f'feature {i}', 'value': rng.random(), 'timestamp': 1700000000 + i},
+        }
+
+def ingest_orm(session, features, feature_set_id: int) -> int:
+    count = 0
+
+    for geojson_feature in features:
+        db_feature = feature_to_obj(geojson_feature)
+
+        if db_feature is None:
+            continue
+
+        db_feature.feature_set_id = feature_set_id
+        session.add(db_feature)
+        count += 1
+
+        if count % ORM_BATCH_SIZE == 0:
+            session.flush()
+            session.expunge_all()
+
+    session.flush()
+    session.expunge_all()
+
+    return count
+
+def ingest_copy(session, features, feature_set_id: int) -> int:
+    return copy_features(session, features, feature_set_id)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the feature ingestion paths')
+    parser.add_argument('--features', type=int, default=500_000, help='number of synthetic features')
+    args = parser.parse_args()
+
+    with session_scope() as session:
+
+        # a feature set only for the benchmark, rolled back with everything else
+        feature_set = FeatureSet(name='benchmark', layer=Layer(name='benchmark'), style=get_default_style())
+        session.add(feature_set)
+        session.flush()
+        feature_set_id = feature_set.id
+
+        results = {}
+
+        for name, ingest in (('ORM (feature_to_obj)', ingest_orm), ('COPY (copy_features)', ingest_copy)):
+            print(f"{name}: writing {args.features} features...")
+
+            start = time.perf_counter()
+            count = ingest(session, synthetic_features(args.features), feature_set_id)
+            elapsed = time.perf_counter() - start
+
+            results[name] = (count, elapsed)
+
+            # start the next path from an empty feature set
+            session.query(Feature).filter(Feature.feature_set_id == feature_set_id).delete(synchronize_session=False)
+
+        session.rollback()
+
+    print()
+    for name, (count, elapsed) in results.items():
+        print(f"{name:<22} {count} features in {elapsed:.1f}s, {count / elapsed:,.0f} features/s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Benchmark the reports indexes (see Report.__table_args__ and build.REPORT_INDEX_MIGRATIONS).
+
+Run from the src/ directory against a running database:
+
+    python benchmark_report_indexes.py [--rows 1000000]
+
+Fills a temporary copy of the reports table with synthetic rows, prints the
+query plans of the hot path queries without indexes, creates the indexes and
+prints the plans again. The temporary table is dropped with the connection,
+the real reports table is not touched.
+"""
+
+import argparse
+import os
+import sys
+
+from sqlalchemy import text
+
+# Allow imports from src/
+sys.path.insert(0, os.path.dirname(__file__))
+
+from data.connect import get_engine
+from data.build import REPORT_INDEX_MIGRATIONS
+
+TABLE = 'bench_reports'
+
+# the queries of the sidebar, dots, banner and save_posts, run against the benchmark table
+QUERIES = {
+    'save_posts duplicate check': f"SELECT id FROM {TABLE} WHERE identifier = 'post-500000'",
+    'sidebar, newest reports': f"SELECT id FROM {TABLE} WHERE timestamp <= now() ORDER BY timestamp DESC LIMIT 25",
+    'sidebar, platform filter': f"SELECT id FROM {TABLE} WHERE platform LIKE 'rss%' AND timestamp <= now() ORDER BY timestamp DESC LIMIT 25",
+    'sidebar, platform and event filter': f"SELECT id FROM {TABLE} WHERE platform LIKE 'mastodon%' AND event_type IN ('Menschen betroffen', 'Verletzte & Tote') AND relevance IN ('high', 'medium') ORDER BY timestamp DESC LIMIT 25",
+    'max timestamp, platform filter': f"SELECT max(timestamp) FROM {TABLE} WHERE platform LIKE 'bluesky%'",
+    'demo mode filter': f"SELECT count(*) FROM {TABLE} WHERE identifier LIKE 'demo-%'",
+}
+
+# synthetic data with roughly the distribution of the real table
+FILL = f"""
+INSERT INTO {TABLE} (identifier, text, url, platform, timestamp, event_type, relevance, locations, original_locations, author, seen, author_flagged)
+SELECT
+    CASE WHEN i % 1000 = 0 THEN 'demo-' || i ELSE 'post-' || i END,
+    'report ' || i,
+    'https://example.com/' || i,
+    (ARRAY['mastodon', 'bluesky', 'reddit', 'youtube', 'rss/ndr', 'rss/mopo'])[1 + i % 6],
+    now() - (i || ' seconds')::interval,
+    (ARRAY['Irrelevant', 'Menschen betroffen', 'Warnungen & Hinweise', 'Infrastruktur-Schäden', 'Verletzte & Tote', 'Sonstiges'])[1 + (i / 7) % 6],
+    (ARRAY['high', 'medium', 'low', 'none'])[1 + (i / 3) % 4],
+    '[]', '[]', 'author' || (i % 5000), false, false
+FROM generate_series(1, :rows) AS i
+"""
+
+def print_plans(connection, title):
+    print(f"\n===== {title} =====")
+
+    for name, sql in QUERIES.items():
+        plan = connection.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {sql}")).scalars().all()
+        print(f"\n--- {name}")
+        print(sql)
+        print('\n'.join(plan))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the reports indexes')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='number of synthetic reports')
+    args = parser.parse_args()
+
+    with get_engine().connect() as connection:
+
+        print(f"Filling {TABLE} with {args.rows} rows...")
+        connection.execute(text(f"CREATE TEMP TABLE {TABLE} (LIKE reports INCLUDING DEFAULTS)"))
+        connection.execute(text(FILL), {'rows': args.rows})
+        connection.execute(text(f"ANALYZE {TABLE}"))
+
+        print_plans(connection, 'without indexes')
+
+        print(f"\nCreating indexes...")
+        for sql in REPORT_INDEX_MIGRATIONS:
+            if sql.startswith('CREATE'):
+                # the index names have to be unique per schema, temporary tables live in their own schema
+                connection.execute(text(sql.replace(' ON reports ', f' ON {TABLE} ')))
+        connection.execute(text(f"ANALYZE {TABLE}"))
+
+        print_plans(connection, 'with indexes')
+
+        connection.rollback()
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 import json
 import os
-import requests
+import time
 from datetime import datetime, timedelta, timezone
 from tqdm import tqdm
 
@@ -8,11 +8,17 @@ from tqdm import tqdm
 from sqlalchemy import text, func, inspect
 from geoalchemy2 import WKTElement
 from shapely.geometry import shape
-from data.model import Base, TABLES, Feature, FeatureSet, Dataset, Collection, Layer, Style, Colormap, Report, UserReportState
-from data.connect import autoconnect_db
+from data.model import LOCATION_STATUS_SQL, GEOMETRY_LEVELS, simplified_geometry_sql, Base, TABLES, Feature, FeatureSet, Dataset, Collection, Layer, Style, Colormap, Report, UserReportState, ReportLocation
+from data.connect import get_engine, session_scope
+from data.report_locations import location_rows, backfill_report_locations
+from data.partitions import ensure_partitions, partition_existing_tables
+from data.snapshot import SNAPSHOT_PATH, import_snapshot
+from data.payloads import build_payloads, invalidate_payloads
+from data.bulk import staging_lock, create_staging_table, index_staging_table, stage_features, discard_staged_features, apply_staged_features
 
 # request imports
-from data.req_hamburg import get_api_collections, get_items_endpoint, get_base_endpoint, request_items
+from data.req_hamburg import get_api_collections, get_items_endpoint, get_base_endpoint, fetch_items_parallel
+from data.http_cache import cached_get
 
 # the accepted json types for the item endpoints
 ACCEPTED_JSON_TYPES = ['application/json', 'application/geo+json']
@@ -36,7 +42,7 @@ def api_to_db(session, refresh=True, verbose=False):
         collection_identifiers = dataset_config['collections'].keys()
 
         # request the dataset from the API
-        dataset_response = requests.get(url).json()
+        dataset_response = cached_get(url).json()
 
         # takes the name from the api_config.json if it exists
         # otherwise use the name from the API response
@@ -156,63 +162,150 @@ def api_to_db(session, refresh=True, verbose=False):
             refresh(session, verbose=verbose)
 
 
-def refresh(session, verbose=False):
+def purge_api_features(session, exclude=(), verbose=False) -> int:
+    """
+    Deletes all Features whose FeatureSet has a Collection (the ones that are accessible via API) with one set-based DELETE,
+    except the Features of the FeatureSets with the ids in `exclude`. Their content versions are reset as well.
+    Does not commit. Returns the number of deleted Features.
+    """
+
+    start = time.perf_counter()
+    params = {'exclude': list(exclude)}
+
+    deleted = session.execute(text("""
+        DELETE FROM features f
+        USING feature_sets fs
+        WHERE f.feature_set_id = fs.id AND fs.collection_id IS NOT NULL AND fs.id <> ALL(:exclude)
+    """), params).rowcount
+
+    session.execute(text("UPDATE feature_sets SET content_version = NULL WHERE collection_id IS NOT NULL AND id <> ALL(:exclude)"), params)
+
+    if verbose: print(f"Purged {deleted} API Features in {time.perf_counter() - start:.1f}s")
+
+    return deleted
+
+def refresh(session, full=False, verbose=False) -> dict:
     """
     Gets all Datasets in the database, requests their features and saves them in the database.
-    This overwrites existing database entries for Feature only.
+    This changes existing database entries for Feature only, and only the ones that changed upstream:
+    every collection is staged first and then compared with the stored features by key and content hash, see `apply_staged_features()`.
+    The collections are requested in parallel (see `fetch_items_parallel()`), this thread stages them page by page as they arrive.
+    The features table is only changed at the very end, all collections in one short transaction, so readers see either
+    the old or the new features of all collections. A collection whose request fails keeps its current features,
+    if the refresh fails before the end, no features are changed at all.
+    The requests go through the HTTP cache (see data/http_cache.py), a collection whose responses did not change since its last refresh
+    is neither staged nor compared, it is reported as not modified.
+    With `full`, every collection is requested and staged again, and all API Features are replaced instead of compared,
+    see `purge_api_features()`. This still happens in the transaction at the end, a collection whose request fails keeps its features.
+    Only one refresh runs at a time, in all processes, see `staging_lock()`.
+    Returns the refresh report: {collection identifier: {inserted, updated, deleted, unchanged, duplicates, failed, not_modified, seconds}}.
     """
 
-    # iterate through all Features, and delete those whose FeatureSet has a Collection
-    # those are the Features that are accessible via API and get requested again
-    # if we would not delete them, we would have duplicates
-    features = session.query(Feature).all()
+    # the staging table is shared, a second refresh waits here until this one has applied its features
+    with staging_lock(session):
 
-    for feature in features:
+        create_staging_table(session)
+        session.commit()
 
-        # if the collection is not None, the FeatureSet is accessible via API
-        if feature.feature_set.collection is not None:
-            
-            # this Feature will be requested again, so delete it
-            session.delete(feature)
+        # get all FeatureSets with a collection, the others are not accessible via API
+        # the workers only get plain values, the session stays in this thread
+        jobs = session.query(FeatureSet.id, Collection.url_items, Collection.identifier, FeatureSet.content_version).join(FeatureSet.collection).all()
 
-    # get all datasets
-    feature_sets = session.query(FeatureSet).all()
+        # without a version, no collection counts as unchanged
+        if full:
+            jobs = [(feature_set_id, url_items, identifier, None) for feature_set_id, url_items, identifier, _ in jobs]
 
-    # iterate over all FeatureSets
-    for feature_set in tqdm(feature_sets, disable=not verbose, leave=False):
-        
-        # iterate over all collections in the dataset
-        collection = feature_set.collection
+        names = {feature_set_id: identifier for feature_set_id, _, identifier, _ in jobs}
+        results = {}
 
-        # skip if the collection is None, meaning the FeatureSet is not accessible via API
-        if collection is None:
-            continue
+        # stage every page as soon as it arrives, only a few pages are held in memory at a time
+        # the staged pages are committed right away, the features table is not touched yet
+        progress = tqdm(total=len(jobs), disable=not verbose, leave=False)
 
-        # request the items from the API
-        items_response = request_items(collection)
-    
-        # skip if the request failed
-        if items_response is None:
-            continue
-    
-        # get all items from the items endpoint
-        features = items_response['features']
-    
-        for feature in features:
-    
-            # transform the feature into a database object
-            db_feature = feature_to_obj(feature)
+        for feature_set_id, features, result, seconds in fetch_items_parallel(jobs):
 
-            if db_feature is None:
+            if result is None:
+                # COPY the page straight into the staging table, see data/bulk.py
+                stage_features(session, features, feature_set_id)
+                session.commit()
                 continue
 
-            # set the feature set manually
-            db_feature.feature_set = feature_set
+            result['seconds'] = seconds
+            results[feature_set_id] = result
+            progress.update(1)
 
-            session.add(db_feature)
-    
+        progress.close()
+
+        index_staging_table(session)
+        session.commit()
+
+        # swap the staged collections in, all in one transaction
+        # only the changed rows are written, so the transaction is short and readers never wait for it
+
+        report = {}
+
+        # the FeatureSets whose features changed, their payloads are built again afterwards (see data/payloads.py)
+        changed = []
+
+        if full:
+            failed = [feature_set_id for feature_set_id, result in results.items() if result['status'] == 'failed']
+            purge_api_features(session, exclude=failed, verbose=verbose)
+            changed = [feature_set_id for feature_set_id in results if feature_set_id not in failed]
+
+        for feature_set_id, result in results.items():
+
+            if result['status'] == 'failed':
+                discard_staged_features(session, feature_set_id)
+                counts = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': None, 'duplicates': 0, 'failed': True}
+            elif result['status'] == 'unchanged':
+                # nothing was staged, the stored features are still the ones of the cached responses
+                unchanged = session.query(func.count(Feature.id)).filter(Feature.feature_set_id == feature_set_id).scalar()
+                counts = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': unchanged, 'duplicates': 0, 'failed': False}
+            else:
+                counts = apply_staged_features(session, feature_set_id)
+                counts['failed'] = False
+                session.query(FeatureSet).filter(FeatureSet.id == feature_set_id).update({FeatureSet.content_version: result['version']}, synchronize_session=False)
+
+                if counts['inserted'] or counts['updated'] or counts['deleted']:
+                    changed.append(feature_set_id)
+
+            counts['not_modified'] = result['status'] == 'unchanged'
+            counts['seconds'] = result['seconds']
+            report[names[feature_set_id]] = counts
+
+        # in the same transaction, so the old payloads are never served with the new features
+        invalidate_payloads(session, set(changed))
         session.commit()
 
+        # outside of the swap transaction, a payload that is requested in between is built on demand
+        build_payloads(session, set(changed), verbose=verbose)
+        session.commit()
+
+        if verbose: print_refresh_report(report)
+
+        return report
+
+def print_refresh_report(report: dict):
+    """
+    Prints the report of `refresh()`, one line per collection, slowest first.
+    """
+
+    print("Refresh report (inserted / updated / deleted / unchanged):")
+
+    for identifier, counts in sorted(report.items(), key=lambda item: item[1]['seconds'], reverse=True):
+        if counts['failed']:
+            print(f"  {identifier}: failed after {counts['seconds']:.1f}s, kept the current features")
+        elif counts['not_modified']:
+            print(f"  {identifier}: not modified, {counts['unchanged']} unchanged, {counts['seconds']:.1f}s")
+        else:
+            duplicates = f", {counts['duplicates']} repeated keys" if counts['duplicates'] else ""
+            print(f"  {identifier}: {counts['inserted']} / {counts['updated']} / {counts['deleted']} / {counts['unchanged']}{duplicates}, {counts['seconds']:.1f}s")
+
+    totals = {key: sum(counts[key] or 0 for counts in report.values()) for key in ('inserted', 'updated', 'deleted', 'unchanged')}
+    failed = sum(1 for counts in report.values() if counts['failed'])
+    not_modified = sum(1 for counts in report.values() if counts['not_modified'])
+    print(f"Total: {totals['inserted']} inserted, {totals['updated']} updated, {totals['deleted']} deleted, {totals['unchanged']} unchanged, {failed} failed, {not_modified} not modified")
+
 def feature_to_obj(geojson_feature: dict):
     """
     Transforms a GeoJSON feature (as a dictionary) into a database entry.
@@ -425,14 +518,72 @@ def get_default_style():
     )
     return style
 
+# indexes of the reports table, see Report.__table_args__ in model.py
+# duplicates have to be removed once before the unique index on identifier can be created, the oldest report is kept
+REPORT_INDEX_MIGRATIONS = [
+    """DO $$ BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'ix_reports_identifier') THEN
+        DELETE FROM reports a USING reports b WHERE a.identifier = b.identifier AND a.id > b.id;
+    END IF;
+END $$""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_reports_identifier ON reports (identifier varchar_pattern_ops, timestamp)",
+    "CREATE INDEX IF NOT EXISTS ix_reports_timestamp ON reports (timestamp DESC)",
+    "CREATE INDEX IF NOT EXISTS ix_reports_platform_timestamp ON reports (platform varchar_pattern_ops, timestamp DESC)",
+    f"ALTER TABLE reports ADD COLUMN IF NOT EXISTS location_status VARCHAR GENERATED ALWAYS AS ({LOCATION_STATUS_SQL}) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_reports_location_status_timestamp ON reports (location_status, timestamp DESC)",
+]
+
+# spatial and foreign key indexes of the feature and alert tables, see model.py
+# the GiST index names follow the naming of geoalchemy2 (spatial_index=True), so they match databases created by build()
+FEATURE_INDEX_MIGRATIONS = [
+    "CREATE INDEX IF NOT EXISTS idx_features_geometry ON features USING GIST (geometry)",
+    "CREATE INDEX IF NOT EXISTS idx_alerts_geometry ON alerts USING GIST (geometry)",
+    "CREATE INDEX IF NOT EXISTS ix_features_feature_set_id ON features (feature_set_id)",
+    "CREATE INDEX IF NOT EXISTS ix_feature_sets_layer_id ON feature_sets (layer_id)",
+    "ALTER TABLE features ADD COLUMN IF NOT EXISTS feature_key VARCHAR",
+    "ALTER TABLE features ADD COLUMN IF NOT EXISTS content_hash VARCHAR",
+    "CREATE INDEX IF NOT EXISTS ix_features_feature_set_key ON features (feature_set_id, feature_key)",
+    "ALTER TABLE feature_sets ADD COLUMN IF NOT EXISTS content_version VARCHAR",
+] + [
+    # computes the simplified geometries of all existing features once
+    f"ALTER TABLE features ADD COLUMN IF NOT EXISTS {column} geometry GENERATED ALWAYS AS ({simplified_geometry_sql(tolerance)}) STORED"
+    for column, _, tolerance in GEOMETRY_LEVELS
+] + [
+    "CREATE INDEX IF NOT EXISTS ix_feature_set_scenario_association_feature_set_id ON feature_set_scenario_association (feature_set_id)",
+    "CREATE INDEX IF NOT EXISTS ix_feature_set_scenario_association_scenario_id ON feature_set_scenario_association (scenario_id)",
+]
+
+def json_to_jsonb(table: str, column: str) -> str:
+    """
+    Returns a migration that changes the type of a JSON column to JSONB in place. Does nothing if the column is not JSON (anymore).
+    """
+
+    return f"""DO $$ BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = '{table}' AND column_name = '{column}' AND data_type = 'json') THEN
+        ALTER TABLE {table} ALTER COLUMN {column} TYPE JSONB USING {column}::jsonb;
+    END IF;
+END $$"""
+
+# JSON columns that are stored as JSONB, and their GIN indexes, see model.py
+# the columns have to be converted before the indexes are created
+JSONB_MIGRATIONS = [
+    json_to_jsonb('features', 'properties'),
+    json_to_jsonb('reports', 'locations'),
+    json_to_jsonb('reports', 'original_locations'),
+    json_to_jsonb('user_report_state', 'locations'),
+    "CREATE INDEX IF NOT EXISTS ix_features_properties ON features USING GIN (properties jsonb_path_ops)",
+    # the locations are filtered with location_status and report_locations, these indexes were never used and only slowed down the inserts
+    "DROP INDEX IF EXISTS ix_reports_locations",
+    "DROP INDEX IF EXISTS ix_urs_locations",
+]
+
 def migrate_columns():
     """
     Adds new columns to existing tables if they don't exist yet.
     Safe to call on an already-initialized database – uses IF NOT EXISTS.
     """
-    engine, session = autoconnect_db()
     migrations = [
-        "ALTER TABLE reports ADD COLUMN IF NOT EXISTS original_locations JSON",
+        "ALTER TABLE reports ADD COLUMN IF NOT EXISTS original_locations JSONB",
         "ALTER TABLE reports ADD COLUMN IF NOT EXISTS author VARCHAR DEFAULT ''",
         "ALTER TABLE reports ADD COLUMN IF NOT EXISTS seen BOOLEAN NOT NULL DEFAULT FALSE",
         "ALTER TABLE reports ADD COLUMN IF NOT EXISTS author_flagged BOOLEAN NOT NULL DEFAULT FALSE",
@@ -443,35 +594,82 @@ def migrate_columns():
     hide BOOLEAN NOT NULL DEFAULT FALSE,
     flag BOOLEAN NOT NULL DEFAULT FALSE,
     flag_author VARCHAR,
-    locations JSON,
+    locations JSONB,
     first_seen_at TIMESTAMP,
     CONSTRAINT uq_user_report UNIQUE (username, report_id)
 )""",
         "CREATE INDEX IF NOT EXISTS ix_urs_username ON user_report_state (username)",
+        """CREATE TABLE IF NOT EXISTS report_locations (
+    id SERIAL PRIMARY KEY,
+    report_id INTEGER NOT NULL,
+    username VARCHAR,
+    position INTEGER NOT NULL DEFAULT 0,
+    osm_id VARCHAR,
+    osm_type VARCHAR,
+    name VARCHAR,
+    display_name VARCHAR,
+    mention VARCHAR,
+    geometry geometry(POINT, 4326),
+    polygon geometry(GEOMETRY, 4326)
+)""",
+        "CREATE INDEX IF NOT EXISTS ix_report_locations_report_username ON report_locations (report_id, username)",
+        "CREATE INDEX IF NOT EXISTS idx_report_locations_geometry ON report_locations USING GIST (geometry)",
         "ALTER TABLE user_report_state ADD COLUMN IF NOT EXISTS new BOOLEAN NOT NULL DEFAULT TRUE",
-    ]
-    for sql in migrations:
+        "ALTER TABLE feature_sets ADD COLUMN IF NOT EXISTS data_version INTEGER NOT NULL DEFAULT 0",
+        """CREATE TABLE IF NOT EXISTS feature_set_payloads (
+    feature_set_id INTEGER NOT NULL REFERENCES feature_sets(id) ON DELETE CASCADE,
+    level VARCHAR NOT NULL,
+    version INTEGER NOT NULL,
+    feature_count INTEGER NOT NULL,
+    data BYTEA NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (feature_set_id, level)
+)""",
+        """CREATE TABLE IF NOT EXISTS source_versions (
+    source VARCHAR PRIMARY KEY,
+    content_version VARCHAR NOT NULL,
+    updated_at TIMESTAMP NOT NULL
+)""",
+    ] + REPORT_INDEX_MIGRATIONS + FEATURE_INDEX_MIGRATIONS + JSONB_MIGRATIONS
+    with session_scope() as session:
+        for sql in migrations:
+            # run every migration in its own savepoint, so a failing one does not abort the ones after it
+            try:
+                with session.begin_nested():
+                    session.execute(text(sql))
+            except Exception as e:
+                print(f"Migration skipped ({sql[:60]}...): {e}")
+        session.commit()
+
+        # databases created before the reports were partitioned
         try:
-            session.execute(text(sql))
+            partition_existing_tables(session, verbose=True)
         except Exception as e:
-            print(f"Migration skipped ({sql[:60]}...): {e}")
-    session.commit()
-    session.close()
-    engine.dispose()
+            session.rollback()
+            print(f"Partitioning the reports skipped: {e}")
+
+        # partitions for the upcoming reports
+        ensure_partitions(session)
+        session.commit()
+
+        # fill report_locations once, when it was just added to a database that already has reports
+        if session.query(ReportLocation.id).first() is None and session.query(Report.id).first() is not None:
+            print("Filling report_locations from the report locations...")
+            backfill_report_locations(session, verbose=True)
+            session.commit()
 
 
 def build_if_uninitialized():
     """
     Check if the database is uninitialized and if it is, run `build()`.
+    If a snapshot exists at SNAPSHOT_PATH, it is imported instead, without requesting the APIs (see data/snapshot.py).
+    If the snapshot does not match the tables of model.py, `build()` runs.
     Also runs column migrations for already-initialized databases.
     Returns True if the database was uninitialized, else False.
     """
 
-    # connect to the database
-    engine, session = autoconnect_db()
-
     # check if the tables exist
-    inspector = inspect(engine)
+    inspector = inspect(get_engine())
     existing_tables = inspector.get_table_names()
 
     # check if all tables exist
@@ -481,14 +679,20 @@ def build_if_uninitialized():
         if table.__tablename__ not in existing_tables:
             missing_tables.append(table.__tablename__)
 
-    # close the database connection
-    session.close()
-    engine.dispose()
-
     # if any tables are missing, run build()
     if len(missing_tables) > 0:
 
         print(f"Database is missing tables {missing_tables}")
+
+        if os.path.exists(SNAPSHOT_PATH):
+            print(f"Importing the snapshot {SNAPSHOT_PATH}...")
+            try:
+                import_snapshot(SNAPSHOT_PATH, verbose=True)
+                return True
+            except ValueError as e:
+                # the import did not change the database, build it from the APIs instead
+                print(f"The snapshot does not match the database: {e}")
+
         print("Running build()...")
 
         build(verbose=True)
@@ -512,7 +716,7 @@ def build(verbose=False):
     4. Creates new empty tables for all database objects from database.py
     5. Requests all datasets and collections from the API and saves them to the database (Updates tables Dataset, Collection, FeatureSet, Style, Colormap)
     6. Request all items from the collections, transform them into Features and save them to the database (Updates table Feature)
-    7. Closes the connection to the database
+    7. Returns the connection to the pool
     """
 
     if verbose: print("=========================")
@@ -520,52 +724,57 @@ def build(verbose=False):
     if verbose: print("=========================")
 
     # 1. connect to the database
+    # the session comes from the shared pool, session_scope() closes it and returns the connection at the end
     if verbose: print("Connecting to the database... ", end='')
-    engine, session = autoconnect_db()
-    if verbose: print("Done!")
+    engine = get_engine()
 
-    # 2. activate postGIS if not already enabled
-    if verbose: print("Activating extensions... ", end='')
-    session.execute(text("CREATE EXTENSION IF NOT EXISTS postgis"))
-    session.commit()
-    if verbose: print("Done!")
+    with session_scope() as session:
+        if verbose: print("Done!")
+
+        # 2. activate postGIS if not already enabled
+        if verbose: print("Activating extensions... ", end='')
+        session.execute(text("CREATE EXTENSION IF NOT EXISTS postgis"))
+        session.commit()
+        if verbose: print("Done!")
 
-    # 3. force drop all tables
-    if verbose: print("Dropping existing tables... ", end='')
-    Base.metadata.drop_all(engine)
-    if verbose: print("Done!")
+        # 3. force drop all tables
+        if verbose: print("Dropping existing tables... ", end='')
+        Base.metadata.drop_all(engine)
+        if verbose: print("Done!")
 
-    # 4. create the tables
-    if verbose: print("Creating tables... ", end='')
-    Base.metadata.create_all(engine)
-    if verbose: print("Done!")
+        # 4. create the tables
+        if verbose: print("Creating tables... ", end='')
+        Base.metadata.create_all(engine)
+        ensure_partitions(session)
+        session.commit()
+        if verbose: print("Done!")
 
-    # create special database entries for events
-    # currently unused until the event prediction project is finished
-    # if verbose: print("Preparing database entries for Event Propagation... ", end='')
-    # create_event_entries(session)
-    # if verbose: print("Done!")
+        # create special database entries for events
+        # currently unused until the event prediction project is finished
+        # if verbose: print("Preparing database entries for Event Propagation... ", end='')
+        # create_event_entries(session)
+        # if verbose: print("Done!")
 
-    # 5. transform geojson files to database entries
-    if verbose: print("Getting API Metadata... ")
-    api_to_db(session, refresh=False, verbose=verbose)
+        # 5. transform geojson files to database entries
+        if verbose: print("Getting API Metadata... ")
+        api_to_db(session, refresh=False, verbose=verbose)
 
-    # get the number of Datasets and Collections
-    dataset_count = session.query(Dataset).count()
-    collection_count = session.query(Collection).count()
-    if verbose: print(f"Saved {dataset_count} Datasets with {collection_count} Collections to the database")
+        # get the number of Datasets and Collections
+        dataset_count = session.query(Dataset).count()
+        collection_count = session.query(Collection).count()
+        if verbose: print(f"Saved {dataset_count} Datasets with {collection_count} Collections to the database")
 
-    # 6. refresh all features
-    if verbose: print("Refreshing Features... ")
-    refresh(session, verbose=verbose)
+        # 6. refresh all features
+        if verbose: print("Refreshing Features... ")
+        refresh(session, verbose=verbose)
 
-    # get the number of Datasets and Collections
-    feature_count = session.query(Feature).count()
-    if verbose: print(f"Saved {feature_count} Features to the database")
+        # get the number of Datasets and Collections
+        feature_count = session.query(Feature).count()
+        if verbose: print(f"Saved {feature_count} Features to the database")
 
-    # 7. close the database connection
-    session.close()
-    engine.dispose()
+        # update the planner statistics, so the spatial and foreign key indexes are used right away
+        session.execute(text("ANALYZE features"))
+        session.commit()
 
     if verbose: print("=========================")
     if verbose: print("Database rebuild finished")
@@ -872,6 +1081,7 @@ def seed_demo_data(session):
         records = json.load(f)
 
     session.query(UserReportState).delete(synchronize_session=False)
+    session.query(ReportLocation).delete(synchronize_session=False)
     session.query(Report).delete(synchronize_session=False)
     session.commit()
 
@@ -879,10 +1089,12 @@ def seed_demo_data(session):
     n = len(records)
     step = 300.0 / max(n - 1, 1)  # spread over 5 minutes
 
+    reports = []
+
     for i, rd in enumerate(records):
         ts = now + timedelta(seconds=i * step)
         locs = rd.get('locations', [])
-        session.add(Report(
+        reports.append(Report(
             identifier=rd['identifier'],
             text=rd['text'],
             url=rd['url'],
@@ -897,6 +1109,13 @@ def seed_demo_data(session):
             author_flagged=False,
         ))
 
+    session.add_all(reports)
+    session.flush()
+
+    # the normalized locations need the report ids
+    for report in reports:
+        session.add_all(location_rows(report.id, report.locations))
+
     session.commit()
     print(f"Demo: seeded {n} reports, first at now, last at now+5 min")
 
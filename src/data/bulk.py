@@ -0,0 +1,255 @@
+import csv
+import hashlib
+import io
+import json
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from shapely import wkb
+from shapely.geometry import shape
+from sqlalchemy import text
+
+# bulk ingestion of GeoJSON features into the features table
+# the features are converted straight to EWKB and streamed into the table with COPY, no ORM objects are created
+# the rows are the same as the ones of build.feature_to_obj()
+
+# how many features are sent per COPY statement
+COPY_BATCH_SIZE = 10000
+
+# the columns of the features table that are written, in the order of feature_to_row()
+FEATURE_COLUMNS = ('properties', 'timestamp', 'geometry_type', 'geometry', 'feature_set_id', 'feature_key', 'content_hash')
+
+# refresh() copies the features of every collection into this table first and then applies only the differences to features,
+# see apply_staged_features()
+STAGING_TABLE = 'features_staging'
+
+STAGING_TABLE_SQL = f"""CREATE UNLOGGED TABLE IF NOT EXISTS {STAGING_TABLE} (
+    properties JSONB,
+    timestamp TIMESTAMP,
+    geometry_type VARCHAR NOT NULL,
+    geometry geometry NOT NULL,
+    feature_set_id INTEGER NOT NULL,
+    feature_key VARCHAR NOT NULL,
+    content_hash VARCHAR NOT NULL
+)"""
+
+STAGING_INDEX = f"ix_{STAGING_TABLE}_feature_set_key"
+
+def content_hash(geojson_feature: dict) -> str:
+    """
+    Returns a hash of the geometry and the properties of a GeoJSON feature, independent of the order of the keys.
+    """
+
+    content = json.dumps([geojson_feature['geometry'], geojson_feature.get('properties') or {}], sort_keys=True, separators=(',', ':'))
+
+    return hashlib.md5(content.encode('utf-8')).hexdigest()
+
+def feature_key(geojson_feature: dict, digest: str) -> str:
+    """
+    Returns the key that identifies a feature between two refreshes: the id of the GeoJSON feature,
+    or its content hash if it has no id (then a changed feature counts as deleted and inserted).
+    """
+
+    if geojson_feature.get('id') is not None:
+        return f"id:{geojson_feature['id']}"
+
+    return f"hash:{digest}"
+
+def feature_to_row(geojson_feature: dict, feature_set_id: int):
+    """
+    Transforms a GeoJSON feature (as a dictionary) into a row of FEATURE_COLUMNS for `copy_features()`.
+    The geometry is hex encoded EWKB with SRID 4326. Returns None if the feature has no geometry.
+    """
+
+    if geojson_feature['geometry'] is None:
+        return None
+
+    shapely_geom = shape(geojson_feature['geometry'])
+
+    # "properties": null is valid GeoJSON
+    properties = geojson_feature.get('properties') or {}
+
+    # get and convert the timestamp from the properties
+    unix_timestamp = properties.get('timestamp', None)
+    if unix_timestamp is not None:
+        timestamp = datetime.fromtimestamp(unix_timestamp, tz=timezone.utc).isoformat()
+    else:
+        timestamp = None
+
+    digest = content_hash(geojson_feature)
+
+    return (
+        json.dumps(properties),
+        timestamp,
+        shapely_geom.geom_type,
+        wkb.dumps(shapely_geom, hex=True, srid=4326),
+        feature_set_id,
+        feature_key(geojson_feature, digest),
+        digest
+    )
+
+def copy_rows(session, rows: list, table: str = 'features'):
+    """
+    Writes `rows` (tuples of FEATURE_COLUMNS) into `table` with one COPY statement.
+    Runs in the transaction of `session`, does not commit.
+    """
+
+    # csv quotes the JSON properties, empty fields (None) are NULL
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert(f"COPY {table} ({', '.join(FEATURE_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+def copy_features(session, geojson_features, feature_set_id: int, batch_size: int = COPY_BATCH_SIZE, table: str = 'features') -> int:
+    """
+    Writes the GeoJSON features of the iterable `geojson_features` into `table` (the features table by default) with COPY,
+    `batch_size` features per statement, so a generator of features is never held in memory completely.
+    Features without geometry are skipped, like in build.feature_to_obj(). Does not commit.
+    Returns the number of written features.
+    """
+
+    count = 0
+    rows = []
+
+    for geojson_feature in geojson_features:
+
+        row = feature_to_row(geojson_feature, feature_set_id)
+
+        if row is None:
+            continue
+
+        rows.append(row)
+
+        if len(rows) >= batch_size:
+            copy_rows(session, rows, table)
+            count += len(rows)
+            rows = []
+
+    if rows:
+        copy_rows(session, rows, table)
+        count += len(rows)
+
+    return count
+
+@contextmanager
+def staging_lock(session):
+    """
+    Context manager that holds a postgres advisory lock while refresh() uses the staging table, across all processes.
+    A second refresh (i.e. the refresh button while `main.py --refresh` runs) waits until the first one has applied its features.
+    The lock is held on its own connection, because the session returns its connection to the pool on every commit.
+    """
+
+    with session.get_bind().connect() as connection:
+        connection.execute(text("SELECT pg_advisory_lock(hashtext(:name))"), {'name': STAGING_TABLE})
+
+        # the lock belongs to the connection, not to the transaction, so the connection does not stay idle in a transaction
+        connection.commit()
+
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(hashtext(:name))"), {'name': STAGING_TABLE})
+
+def create_staging_table(session):
+    """
+    Creates the staging table of refresh() if it does not exist yet and removes rows left over by an aborted refresh.
+    The index is dropped, so the staged pages are copied without index maintenance, see `index_staging_table()`.
+    Only call this while holding `staging_lock()`. Does not commit.
+    """
+
+    session.execute(text(STAGING_TABLE_SQL))
+    session.execute(text(f"DROP INDEX IF EXISTS {STAGING_INDEX}"))
+    session.execute(text(f"TRUNCATE {STAGING_TABLE}"))
+
+def index_staging_table(session):
+    """
+    Builds the index of the staging table and updates its statistics, call this after staging and before applying the features.
+    Does not commit.
+    """
+
+    session.execute(text(f"CREATE INDEX IF NOT EXISTS {STAGING_INDEX} ON {STAGING_TABLE} (feature_set_id, feature_key)"))
+    session.execute(text(f"ANALYZE {STAGING_TABLE}"))
+
+def stage_features(session, geojson_features, feature_set_id: int) -> int:
+    """
+    Writes GeoJSON features into the staging table, see `copy_features()`. Does not commit.
+    """
+
+    return copy_features(session, geojson_features, feature_set_id, table=STAGING_TABLE)
+
+def discard_staged_features(session, feature_set_id: int):
+    """
+    Removes the staged features of a FeatureSet, i.e. when its collection could not be requested completely. Does not commit.
+    """
+
+    session.execute(text(f"DELETE FROM {STAGING_TABLE} WHERE feature_set_id = :feature_set_id"), {'feature_set_id': feature_set_id})
+
+def number_duplicate_keys(session, feature_set_id: int) -> int:
+    """
+    Makes the staged keys of a FeatureSet unique: the second and later features with the same key get the key `<key>#<n>`,
+    numbered by their content hash (and by their position if they are identical), so the numbers stay the same between refreshes
+    as long as the features do not change. Does not commit. Returns the number of renamed keys.
+    """
+
+    return session.execute(text(f"""
+        UPDATE {STAGING_TABLE} s SET feature_key = s.feature_key || '#' || d.n
+        FROM (
+            SELECT ctid, row_number() OVER (PARTITION BY feature_key ORDER BY content_hash, ctid) AS n
+            FROM {STAGING_TABLE} WHERE feature_set_id = :feature_set_id
+        ) d
+        WHERE s.ctid = d.ctid AND d.n > 1
+    """), {'feature_set_id': feature_set_id}).rowcount
+
+def apply_staged_features(session, feature_set_id: int) -> dict:
+    """
+    Makes the features of a FeatureSet equal to its staged features, changing only what differs:
+    - features whose key is not staged anymore are deleted
+    - features whose key is staged with a different content hash are updated
+    - staged features with a new key are inserted
+    If a key is staged more than once (a source that repeats an id, or identical features without one), every feature is kept,
+    see `number_duplicate_keys()`. The staged features are removed afterwards. Does not commit.
+    Returns the counts `inserted`, `updated`, `deleted`, `unchanged` and `duplicates`.
+    """
+
+    params = {'feature_set_id': feature_set_id}
+    columns = ', '.join(FEATURE_COLUMNS)
+
+    duplicates = number_duplicate_keys(session, feature_set_id)
+
+    staged = f"(SELECT * FROM {STAGING_TABLE} WHERE feature_set_id = :feature_set_id)"
+
+    # features from before the content hashes have no key and are replaced once
+    deleted = session.execute(text(f"""
+        DELETE FROM features f
+        WHERE f.feature_set_id = :feature_set_id
+        AND (f.feature_key IS NULL OR NOT EXISTS (
+            SELECT 1 FROM {STAGING_TABLE} s WHERE s.feature_set_id = :feature_set_id AND s.feature_key = f.feature_key
+        ))
+    """), params).rowcount
+
+    updated = session.execute(text(f"""
+        UPDATE features f
+        SET properties = s.properties, timestamp = s.timestamp, geometry_type = s.geometry_type, geometry = s.geometry, content_hash = s.content_hash
+        FROM {staged} s
+        WHERE f.feature_set_id = :feature_set_id AND f.feature_key = s.feature_key AND f.content_hash IS DISTINCT FROM s.content_hash
+    """), params).rowcount
+
+    inserted = session.execute(text(f"""
+        INSERT INTO features ({columns})
+        SELECT {columns} FROM {staged} s
+        WHERE NOT EXISTS (SELECT 1 FROM features f WHERE f.feature_set_id = :feature_set_id AND f.feature_key = s.feature_key)
+    """), params).rowcount
+
+    total = session.execute(text("SELECT count(*) FROM features WHERE feature_set_id = :feature_set_id"), params).scalar()
+
+    discard_staged_features(session, feature_set_id)
+
+    return {
+        'inserted': inserted,
+        'updated': updated,
+        'deleted': deleted,
+        'unchanged': total - inserted - updated,
+        'duplicates': duplicates,
+    }
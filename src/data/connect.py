@@ -1,16 +1,37 @@
+import os
+import threading
+from contextlib import contextmanager
 from os import getenv
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.orm.session import Session
 from sqlalchemy.engine.base import Engine
 
-def autoconnect_db(echo=False) -> tuple[Engine, Session]:
+from data.metrics import record_rows
+
+# the process wide engine and session registry
+# the engine is created lazily on first use, so importing this module never requires a database
+_engine: Engine = None
+_engine_lock = threading.Lock()
+
+# thread-local session registry, bound to the shared engine in get_engine()
+# Dash callbacks run in the worker threads of the Flask server, so every thread gets its own session
+ScopedSession = scoped_session(sessionmaker())
+
+# number of rows fetched per round trip by stream_query()
+STREAM_BATCH_SIZE = 1000
+
+# tracks how deeply session_scope() is nested in the current thread
+# only the outermost scope closes the session, nested scopes share it
+_scope_state = threading.local()
+
+def get_db_url() -> str:
     """
-    Connect to the database. The hostname is dynamically set depending based on whether the environment variable IN_DOCKER is set to true or false.
+    Build the database connection string from the environment variables.
+    The hostname is dynamically set depending based on whether the environment variable IN_DOCKER is set to true or false.
     - if IN_DOCKER = true, then hostname = postgis
-    - if IN_DOCKER = false, then hostname = localhost\\
-    Basically just a simple wrapper around connect_db.
+    - if IN_DOCKER = false, then hostname = localhost
     """
 
     # load environment variables from .env file
@@ -35,17 +56,180 @@ def autoconnect_db(echo=False) -> tuple[Engine, Session]:
 
     # Determine the hostname
     host = "postgis" if in_docker else "localhost"
-    if ALWAYS_PRINT: 
+    if ALWAYS_PRINT:
         print(f"env IN_DOCKER={in_docker}: hostname={host}")
 
-    # connect to the database
-    (engine, session) = connect_db(host=host, port=int(port), user=user, password=password, echo=echo, db_name=db_name)
-    
+    return f"postgresql://{user}:{password}@{host}:{int(port)}/{db_name}"
+
+def get_pool_config() -> dict:
+    """
+    Returns the connection pool settings, read from the environment variables.
+    - `DB_POOL_SIZE` [int] number of connections kept open in the pool (default 5)
+    - `DB_MAX_OVERFLOW` [int] number of extra connections allowed above the pool size under load (default 10)
+    - `DB_POOL_TIMEOUT` [int] seconds to wait for a free connection before giving up (default 30)
+    - `DB_POOL_RECYCLE` [int] seconds after which a connection is replaced, -1 disables recycling (default 1800)
+    - `DB_POOL_PRE_PING` [bool] test connections before handing them out (default true)
+    """
+
+    load_dotenv()
+
+    return {
+        'pool_size': int(getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(getenv('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(getenv('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+    }
+
+def get_engine(echo=False) -> Engine:
+    """
+    Returns the process wide SQLAlchemy engine, creating it on first use.
+    The engine owns a QueuePool that is shared by every caller in this process, so do NOT call `engine.dispose()` on it.
+    """
+
+    global _engine
+
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_engine(get_db_url(), echo=echo, **get_pool_config())
+                ScopedSession.configure(bind=_engine)
+
+    return _engine
+
+def get_session() -> Session:
+    """
+    Returns the session of the current thread, bound to the shared engine.
+    Prefer `session_scope()`, which also takes care of closing the session.
+    """
+
+    get_engine()
+    return ScopedSession()
+
+@contextmanager
+def session_scope():
+    """
+    Context manager that yields the session of the current thread:
+    ```
+    with session_scope() as session:
+        session.query(...)
+        session.commit()
+    ```
+    Nothing is committed automatically, call `session.commit()` yourself.
+    On an exception the transaction is rolled back. Scopes can be nested (i.e. a callback calling a helper that opens its own scope),
+    the inner scopes reuse the session and only the outermost scope closes it and returns the connection to the pool.
+    """
+
+    depth = getattr(_scope_state, 'depth', 0)
+    session = get_session()
+    _scope_state.depth = depth + 1
+
+    try:
+        yield session
+    except BaseException:
+        if depth == 0:
+            session.rollback()
+        raise
+    finally:
+        _scope_state.depth = depth
+        if depth == 0:
+            ScopedSession.remove()
+
+def stream_query(query, batch_size=STREAM_BATCH_SIZE):
+    """
+    Iterate over the results of a query without loading the whole result into memory.
+    The rows are fetched in batches of `batch_size` from a server-side cursor, so the memory use stays flat as the tables grow.
+    Prefer querying single columns (`session.query(Alert.id, Alert.event)`) over whole entities, the rows are then plain tuples and no ORM objects are built:
+    ```
+    with session_scope() as session:
+        for alert_id, event in stream_query(session.query(Alert.id, Alert.event)):
+            ...
+    ```
+    The results have to be consumed while the session is open and before the next `session.commit()`, which closes the cursor.
+    The consumed rows are counted in the SQL metrics of the current tag (see data/metrics.py), a server-side cursor has no row count.
+    """
+
+    count = 0
+
+    try:
+        for row in query.execution_options(stream_results=True).yield_per(batch_size):
+            count += 1
+
+            if count == batch_size:
+                record_rows(count)
+                count = 0
+
+            yield row
+    finally:
+        record_rows(count)
+
+def stream_batches(query, batch_size=STREAM_BATCH_SIZE):
+    """
+    Like `stream_query()`, but yields lists of up to `batch_size` rows, i.e. for bulk updates or deletes in chunks.
+    """
+
+    batch = []
+
+    for row in stream_query(query, batch_size):
+        batch.append(row)
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def pool_status() -> dict:
+    """
+    Returns statistics of the shared connection pool, useful to size `DB_POOL_SIZE` and `DB_MAX_OVERFLOW` under load.
+    - `size` configured pool size
+    - `checked_in` idle connections in the pool
+    - `checked_out` connections currently in use
+    - `overflow` connections open above the pool size (negative while the pool is not yet filled)
+    - `max_overflow` configured overflow limit
+    """
+
+    pool = get_engine().pool
+    config = get_pool_config()
+
+    return {
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+        'max_overflow': config['max_overflow'],
+        'status': pool.status(),
+    }
+
+def _dispose_after_fork():
+    """
+    Forked child processes (i.e. the diskcache long callback workers) must not reuse the connections of the parent.
+    Drop the inherited pool without closing the parents sockets, the child opens its own connections on demand.
+    """
+
+    if _engine is not None:
+        _engine.dispose(close=False)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_dispose_after_fork)
+
+def autoconnect_db(echo=False) -> tuple[Engine, Session]:
+    """
+    Returns the shared engine and a new session bound to it.
+    Kept for scripts that want their own session next to the thread-local one.
+    The engine is shared by the whole process, close the session when done but do NOT dispose the engine.
+    """
+
+    engine = get_engine(echo=echo)
+    session = sessionmaker(bind=engine)()
+
     return (engine, session)
 
 def connect_db(host: str, port: int, user: str, password: str, db_name: str, echo=False):
     """
     Connect to the database. This function builds the database connection string and returns an engine and a session.
+    This creates a new, unshared engine. Use `get_engine()` or `session_scope()` for the pooled connections instead.
 
     returns ```(engine, session)```
     - `engine` [Engine] SQLAlchemy engine
@@ -55,4 +239,4 @@ def connect_db(host: str, port: int, user: str, password: str, db_name: str, ech
     engine = create_engine(db_string, echo=echo)
     DBSession = sessionmaker(bind=engine)
     session = DBSession()
-    return (engine, session)
\ No newline at end of file
+    return (engine, session)
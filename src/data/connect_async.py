@@ -0,0 +1,105 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from data.connect import get_db_url, get_pool_config
+
+# asyncio counterpart of data.connect, used by the ingestion servers
+# the engine is bound to the event loop it is first used in, so all async database work of a process
+# has to run on one loop: either the loop of asyncio.run(...) in a server script, or the background loop of run_coroutine()
+_async_engine: AsyncEngine = None
+_async_engine_lock = threading.Lock()
+
+# expire_on_commit=False, otherwise reading an attribute after commit() would need another (implicit) round trip,
+# which is not possible in async code
+AsyncSessionLocal = sessionmaker(class_=AsyncSession, expire_on_commit=False)
+
+# background event loop for code that is not async itself (i.e. the Flask request handlers)
+_loop: asyncio.AbstractEventLoop = None
+_loop_lock = threading.Lock()
+
+def get_async_db_url() -> str:
+    """
+    Returns the connection string of `get_db_url()` with the asyncpg driver.
+    """
+
+    return get_db_url().replace('postgresql://', 'postgresql+asyncpg://', 1)
+
+def get_async_engine(echo=False) -> AsyncEngine:
+    """
+    Returns the process wide async engine, creating it on first use.
+    Uses the same pool settings as the sync engine, see `data.connect.get_pool_config()`.
+    """
+
+    global _async_engine
+
+    if _async_engine is None:
+        with _async_engine_lock:
+            if _async_engine is None:
+                _async_engine = create_async_engine(get_async_db_url(), echo=echo, **get_pool_config())
+                AsyncSessionLocal.configure(bind=_async_engine)
+
+    return _async_engine
+
+@asynccontextmanager
+async def async_session_scope():
+    """
+    Async context manager that yields a new AsyncSession bound to the shared async engine:
+    ```
+    async with async_session_scope() as session:
+        result = await session.execute(select(...))
+        await session.commit()
+    ```
+    Nothing is committed automatically. On an exception the transaction is rolled back, the session is always closed.
+    """
+
+    get_async_engine()
+    session = AsyncSessionLocal()
+
+    try:
+        yield session
+    except BaseException:
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+async def dispose_async_engine():
+    """
+    Closes all connections of the async engine. Call this before the event loop of the engine is closed.
+    """
+
+    global _async_engine
+
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the background event loop of this process, starting it in a daemon thread on first use.
+    """
+
+    global _loop
+
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name='async-db-loop', daemon=True)
+                thread.start()
+                _loop = loop
+
+    return _loop
+
+def run_coroutine(coro, timeout=None):
+    """
+    Run a coroutine on the background event loop and wait for its result.
+    Lets sync code (i.e. a Flask request handler) use the async engine, the database work of all threads
+    is multiplexed on the one loop and its connection pool.
+    """
+
+    future = asyncio.run_coroutine_threadsafe(coro, get_background_loop())
+    return future.result(timeout)
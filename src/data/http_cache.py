@@ -0,0 +1,250 @@
+# On-disk cache for the GET requests to the upstream APIs (req_hamburg, req_nina)
+# Every response is stored with its ETag / Last-Modified headers, the next request for the same url is sent as a conditional request.
+# A 304 response is answered from the cache. In offline mode all requests are answered from the cache, without network access.
+# Entries that were not used for HTTP_CACHE_MAX_AGE_DAYS are removed, and the least recently used ones when the cache grows over HTTP_CACHE_MAX_MB.
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import requests
+from dotenv import load_dotenv
+
+# the settings below are read on import, load them from .env first
+load_dotenv()
+
+# where the responses are stored, one body and one metadata file per url
+HTTP_CACHE_DIR = os.getenv('HTTP_CACHE_DIR', os.path.join('data', 'http_cache'))
+
+# set to True to answer all requests from the cache, requests for urls that are not cached fail
+HTTP_OFFLINE = os.getenv('HTTP_OFFLINE', 'false').lower() in ('1', 'true', 'yes')
+
+# entries that were not used for this many days are removed, 0 keeps them
+HTTP_CACHE_MAX_AGE_DAYS = float(os.getenv('HTTP_CACHE_MAX_AGE_DAYS', '30'))
+
+# the least recently used entries are removed when the cache is larger than this, 0 disables the limit
+HTTP_CACHE_MAX_MB = float(os.getenv('HTTP_CACHE_MAX_MB', '512'))
+
+# seconds between two evictions of the same process
+EVICT_INTERVAL = 3600
+
+_evict_lock = threading.Lock()
+_last_evict = 0.0
+
+class CachedResponse:
+    """
+    The parts of a `requests.Response` that the request modules use.
+    - `status_code` [int] status of the response, 200 for responses from the cache
+    - `content` [bytes] body of the response
+    - `from_cache` [bool] True if the body was read from the cache (304 response, offline mode or network error)
+    - `not_modified` [bool] True if the server answered 304, or the body is the same as the cached one. False for a network error,
+      the server was not asked, callers must not treat the response as unchanged
+    - `digest` [str] hash of the body
+    """
+
+    def __init__(self, url: str, status_code: int, content: bytes, from_cache=False, not_modified=False):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.from_cache = from_cache
+        self.not_modified = not_modified
+        self.digest = hashlib.sha256(content).hexdigest()
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} for url {self.url}")
+
+def _paths(url: str) -> tuple:
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return os.path.join(HTTP_CACHE_DIR, f"{key}.meta.json"), os.path.join(HTTP_CACHE_DIR, f"{key}.body.gz")
+
+def _write_atomic(path: str, data: bytes):
+    # the fetch workers of refresh() write in parallel, a reader must never see a half written file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def load(url: str):
+    """
+    Returns the cached response of `url` as a CachedResponse, or None if it is not cached.
+    Marks the entry as used, see evict().
+    """
+
+    meta_path, body_path = _paths(url)
+
+    try:
+        with open(body_path, 'rb') as f:
+            content = gzip.decompress(f.read())
+        os.utime(body_path)
+    except (OSError, EOFError):
+        return None
+
+    return CachedResponse(url, 200, content, from_cache=True, not_modified=True)
+
+def _load_meta(url: str):
+    meta_path, _ = _paths(url)
+
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _store(url: str, response: requests.Response, digest: str):
+    meta_path, body_path = _paths(url)
+
+    # the body first, a metadata file always belongs to a complete body
+    _write_atomic(body_path, gzip.compress(response.content))
+    _write_atomic(meta_path, json.dumps({
+        'url': url,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'digest': digest,
+        'fetched_at': time.time(),
+    }).encode('utf-8'))
+
+def cached_get(url: str, headers: dict = None, timeout=None, offline: bool = None) -> CachedResponse:
+    """
+    GET `url` through the cache:
+    - with a cached response, the request is sent with If-None-Match / If-Modified-Since, a 304 is answered from the cache
+    - a 200 response is stored in the cache, other responses are returned as they are
+    - if the request fails and the url is cached, the cached response is returned
+    - in offline mode (`offline`, default HTTP_OFFLINE) only the cache is used, a url that is not cached raises `requests.ConnectionError`
+    """
+
+    offline = HTTP_OFFLINE if offline is None else offline
+    meta = _load_meta(url)
+
+    if offline:
+        cached = load(url) if meta is not None else None
+        if cached is None:
+            raise requests.ConnectionError(f"Offline mode: {url} is not cached")
+        return cached
+
+    request_headers = dict(headers or {})
+
+    if meta is not None:
+        if meta.get('etag'):
+            request_headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            request_headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        response = requests.get(url, headers=request_headers, timeout=timeout)
+    except requests.RequestException as e:
+        cached = load(url) if meta is not None else None
+        if cached is None:
+            raise
+        print(f"Request to {url} failed, using the cached response: {e}")
+        # the server was not asked, the content may have changed
+        cached.not_modified = False
+        return cached
+
+    if response.status_code == 304:
+        cached = load(url)
+        if cached is not None:
+            return cached
+
+        # the cache was deleted in between, request the full response
+        response = requests.get(url, headers=headers, timeout=timeout)
+
+    if response.status_code != 200:
+        return CachedResponse(url, response.status_code, response.content)
+
+    result = CachedResponse(url, 200, response.content)
+
+    # servers without validators answer 200 every time, compare the body instead
+    result.not_modified = meta is not None and meta.get('digest') == result.digest
+
+    _store(url, response, result.digest)
+
+    maybe_evict()
+
+    return result
+
+def evict(max_age_days: float = None, max_mb: float = None, verbose=False) -> int:
+    """
+    Removes the entries that were not used for `max_age_days` (default HTTP_CACHE_MAX_AGE_DAYS),
+    then the least recently used ones until the cache is at most `max_mb` (default HTTP_CACHE_MAX_MB) large.
+    An entry is used when it is stored or read (see load()). Returns the number of removed entries.
+    """
+
+    max_age_days = HTTP_CACHE_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    max_mb = HTTP_CACHE_MAX_MB if max_mb is None else max_mb
+
+    # {key: [last use, size]}, the body file is touched on every use
+    entries = {}
+
+    try:
+        names = os.listdir(HTTP_CACHE_DIR)
+    except OSError:
+        return 0
+
+    for name in names:
+        key = name.split('.', 1)[0]
+        try:
+            stat = os.stat(os.path.join(HTTP_CACHE_DIR, name))
+        except OSError:
+            continue
+        entry = entries.setdefault(key, [0.0, 0])
+        if name.endswith('.body.gz'):
+            entry[0] = stat.st_mtime
+        entry[1] += stat.st_size
+
+    def remove(key):
+        # the metadata first, an entry without metadata is never used again
+        for suffix in ('.meta.json', '.body.gz'):
+            try:
+                os.remove(os.path.join(HTTP_CACHE_DIR, key + suffix))
+            except OSError:
+                pass
+
+    removed = 0
+    now = time.time()
+
+    if max_age_days > 0:
+        for key, (last_use, _) in list(entries.items()):
+            if now - last_use > max_age_days * 86400:
+                remove(key)
+                del entries[key]
+                removed += 1
+
+    if max_mb > 0:
+        total = sum(size for _, size in entries.values())
+        for key, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if total <= max_mb * 1e6:
+                break
+            remove(key)
+            total -= size
+            removed += 1
+
+    if verbose: print(f"Removed {removed} entries from the HTTP cache")
+
+    return removed
+
+def maybe_evict():
+    """
+    Runs evict() at most every EVICT_INTERVAL seconds per process.
+    """
+
+    global _last_evict
+
+    if time.time() - _last_evict < EVICT_INTERVAL or not _evict_lock.acquire(blocking=False):
+        return
+
+    try:
+        _last_evict = time.time()
+        evict()
+    except Exception as e:
+        print(f"Evicting the HTTP cache failed: {e}")
+    finally:
+        _evict_lock.release()
@@ -0,0 +1,174 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.engine.base import Engine
+
+# SQL instrumentation
+# every statement executed on an instrumented engine is counted under the current tag,
+# usually the name of the Dash callback that issued it (see sql_tag() and tagged())
+
+# statements executed outside of a tagged block are counted here
+UNTAGGED = 'untagged'
+
+# how many characters of the slowest statement are kept
+MAX_STATEMENT_LENGTH = 500
+
+_current_tag: ContextVar = ContextVar('sql_tag', default=UNTAGGED)
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+_logger_thread: threading.Thread = None
+
+def _empty_stats() -> dict:
+    return {
+        'count': 0,
+        'total_time': 0.0,
+        'rows': 0,
+        'slowest_time': 0.0,
+        'slowest_statement': None,
+    }
+
+@contextmanager
+def sql_tag(name: str):
+    """
+    Context manager that counts all statements executed inside of it under `name`:
+    ```
+    with sql_tag('update_reports'):
+        session.query(...)
+    ```
+    """
+
+    token = _current_tag.set(name)
+
+    try:
+        yield
+    finally:
+        _current_tag.reset(token)
+
+def tagged(func):
+    """
+    Decorator that counts all statements executed by `func` under the name of the function.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with sql_tag(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('sql_metrics_start', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['sql_metrics_start'].pop()
+
+    # rowcount is -1 for server-side cursors and some DDL, count those as 0
+    # the rows of server-side cursors are counted while they are consumed, see record_rows()
+    rows = max(cursor.rowcount, 0)
+
+    tag = _current_tag.get()
+
+    with _stats_lock:
+        stats = _stats.setdefault(tag, _empty_stats())
+        stats['count'] += 1
+        stats['total_time'] += elapsed
+        stats['rows'] += rows
+
+        if elapsed > stats['slowest_time']:
+            stats['slowest_time'] = elapsed
+            stats['slowest_statement'] = statement[:MAX_STATEMENT_LENGTH]
+
+def record_rows(count: int):
+    """
+    Adds `count` rows to the current tag without counting a statement, for results that are consumed after the statement
+    was executed, i.e. the server-side cursors of data.connect.stream_query().
+    """
+
+    tag = _current_tag.get()
+
+    with _stats_lock:
+        _stats.setdefault(tag, _empty_stats())['rows'] += count
+
+def _handle_error(exception_context):
+    # a failed statement never reaches after_cursor_execute, drop its start time so the stack stays aligned
+    conn = exception_context.connection
+
+    if conn is not None and conn.info.get('sql_metrics_start'):
+        conn.info['sql_metrics_start'].pop()
+
+def instrument_engine(engine: Engine):
+    """
+    Register the event hooks that record the statements of `engine`. Calling this twice on the same engine has no effect.
+    """
+
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(engine, 'handle_error', _handle_error)
+
+def get_sql_metrics() -> dict:
+    """
+    Returns the recorded statistics per tag, sorted by total time (descending).
+    - `count` [int] number of statements
+    - `total_time` [float] time spent executing the statements, in seconds
+    - `mean_time` [float] mean time per statement, in seconds
+    - `rows` [int] rows returned or affected, including the rows consumed from stream_query()
+    - `slowest_time` [float] time of the slowest statement, in seconds
+    - `slowest_statement` [str] the slowest statement, truncated
+    """
+
+    with _stats_lock:
+        snapshot = {tag: dict(stats) for tag, stats in _stats.items()}
+
+    for stats in snapshot.values():
+        stats['mean_time'] = stats['total_time'] / stats['count'] if stats['count'] else 0.0
+
+    return dict(sorted(snapshot.items(), key=lambda item: item[1]['total_time'], reverse=True))
+
+def reset_sql_metrics():
+    """
+    Drops all recorded statistics.
+    """
+
+    with _stats_lock:
+        _stats.clear()
+
+def format_sql_metrics(limit=5) -> str:
+    """
+    Returns a one line summary of the `limit` tags with the highest total time.
+    """
+
+    metrics = get_sql_metrics()
+
+    if len(metrics) == 0:
+        return 'SQL: no statements recorded'
+
+    parts = [
+        f"{tag} {stats['count']}q/{stats['total_time'] * 1000:.0f}ms/{stats['rows']}rows"
+        for tag, stats in list(metrics.items())[:limit]
+    ]
+
+    return 'SQL: ' + ', '.join(parts)
+
+def start_metrics_logger(interval: int):
+    """
+    Print `format_sql_metrics()` every `interval` seconds in a daemon thread. Only one logger is started per process.
+    """
+
+    global _logger_thread
+
+    if interval <= 0 or _logger_thread is not None:
+        return
+
+    def log():
+        while True:
+            time.sleep(interval)
+            print(format_sql_metrics(), flush=True)
+
+    _logger_thread = threading.Thread(target=log, name='sql-metrics-logger', daemon=True)
+    _logger_thread.start()
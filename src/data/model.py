@@ -1,7 +1,7 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Float, JSON, Boolean, DateTime, Table, UniqueConstraint
-from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy import Column, Integer, String, ForeignKey, Float, JSON, Boolean, DateTime, Table, UniqueConstraint, Index, ForeignKeyConstraint, Computed, LargeBinary
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 from geoalchemy2 import Geometry
 
 # This file defines the database model for the application
@@ -14,28 +14,58 @@ feature_set_scenario_association = Table(
     'feature_set_scenario_association',
     Base.metadata,
     Column('id', Integer, primary_key=True),
-    Column('feature_set_id', Integer, ForeignKey('feature_sets.id'), nullable=False),
-    Column('scenario_id', Integer, ForeignKey('scenarios.id'), nullable=False)
+    Column('feature_set_id', Integer, ForeignKey('feature_sets.id'), nullable=False, index=True),
+    Column('scenario_id', Integer, ForeignKey('scenarios.id'), nullable=False, index=True)
 )
 
+# simplified versions of the feature geometries, one per zoom band: (column, first zoom level that uses a finer level, tolerance in degrees)
+# the tolerance is about half a pixel at the highest zoom level of the band, from that zoom on the next level (finally `geometry`) is used
+# ST_SimplifyPreserveTopology keeps polygons valid, points are not simplified (NULL, `geometry` is used)
+GEOMETRY_LEVELS = [
+    ('geometry_low', 10, 0.001),
+    ('geometry_medium', 13, 0.0002),
+    ('geometry_high', 16, 0.00003),
+]
+
+def simplified_geometry_sql(tolerance: float) -> str:
+    return f"CASE WHEN geometry_type IN ('Point', 'MultiPoint') THEN NULL ELSE ST_SimplifyPreserveTopology(geometry, {tolerance}) END"
+
 class Feature(Base):
     """
     Table name: features
-    - `properties` [JSON] Properties of the feature. You can control which properties are displayed in the popup by setting the `popup_properties` attribute of the style.
+    - `properties` [JSONB] Properties of the feature. You can control which properties are displayed in the popup by setting the `popup_properties` attribute of the style.
     - `timestamp` [DateTime] (Optional) Timestamp of the feature
     - `geometry_type` [String] Type of the geometry Possible values: ```{Point, LineString, Polygon, MultiPoint, MultiLineString, MultiPolygon}```
     - `geometry` [Geometry] Geometry of the feature.
     - `feature_set_id` [Integer] ID of the FeatureSet the feature belongs to
     - `feature_set` [FeatureSet] FeatureSet the feature belongs to
+    - `feature_key` [String] (Optional) Identifies the feature between two refreshes: `id:<id of the GeoJSON feature>` or `hash:<content_hash>`
+    - `content_hash` [String] (Optional) Hash of the geometry and properties of the GeoJSON feature, see data/bulk.py
+    - `geometry_low`, `geometry_medium`, `geometry_high` [Geometry] Simplified versions of `geometry` for the zoom bands of GEOMETRY_LEVELS,
+      generated by the database, not loaded unless requested
     """
     __tablename__ = 'features'
     id = Column(Integer, primary_key=True)
-    properties = Column(JSON)
+    properties = Column(JSONB)
     timestamp = Column(DateTime, nullable=True)
     geometry_type = Column(String, nullable=False)
-    geometry = Column(Geometry(geometry_type='GEOMETRY'), nullable=False)
-    feature_set_id = Column(Integer, ForeignKey('feature_sets.id'), nullable=False)
+    geometry = Column(Geometry(geometry_type='GEOMETRY', spatial_index=True), nullable=False)   # GiST index idx_features_geometry
+    feature_set_id = Column(Integer, ForeignKey('feature_sets.id'), nullable=False, index=True)
     feature_set = relationship('FeatureSet', back_populates='features')
+    feature_key = Column(String, nullable=True)      # set by the COPY ingestion, used by refresh() to compare with the upstream features
+    content_hash = Column(String, nullable=True)
+
+    # generated on every insert and update, so all ingestion paths (COPY, ORM, refresh) fill them
+    geometry_low = deferred(Column(Geometry(geometry_type='GEOMETRY', spatial_index=False), Computed(simplified_geometry_sql(GEOMETRY_LEVELS[0][2]), persisted=True)))
+    geometry_medium = deferred(Column(Geometry(geometry_type='GEOMETRY', spatial_index=False), Computed(simplified_geometry_sql(GEOMETRY_LEVELS[1][2]), persisted=True)))
+    geometry_high = deferred(Column(Geometry(geometry_type='GEOMETRY', spatial_index=False), Computed(simplified_geometry_sql(GEOMETRY_LEVELS[2][2]), persisted=True)))
+
+    __table_args__ = (
+        # GIN index for property lookups (`properties @> '{"key": value}'`)
+        Index('ix_features_properties', 'properties', postgresql_using='gin', postgresql_ops={'properties': 'jsonb_path_ops'}),
+        # lookup of the stored features by key in refresh()
+        Index('ix_features_feature_set_key', 'feature_set_id', 'feature_key'),
+    )
 
 class FeatureSet(Base):
     """
@@ -49,13 +79,15 @@ class FeatureSet(Base):
     - `collection_id` [Integer] (Optional) ID of the Collection the feature set belongs to
     - `collection` [Collection] (Optional) The Collection the feature set belongs to
     - `scenarios` [Scenario Array] List of scenarios the feature set belongs to
+    - `content_version` [String] (Optional) Hash of the upstream responses the features were last refreshed from, see refresh()
+    - `data_version` [Integer] Increased whenever the features change, a FeatureSetPayload of an older version is outdated
     """
     __tablename__ = 'feature_sets'
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     features = relationship('Feature', back_populates='feature_set')
 
-    layer_id = Column(Integer, ForeignKey('layers.id'), nullable=False)
+    layer_id = Column(Integer, ForeignKey('layers.id'), nullable=False, index=True)
     layer = relationship('Layer', back_populates='feature_sets')
 
     style_id = Column(Integer, ForeignKey('styles.id'), nullable=False)
@@ -66,6 +98,42 @@ class FeatureSet(Base):
 
     scenarios = relationship('Scenario', secondary=feature_set_scenario_association, back_populates='feature_sets') # many-to-many relationship to scenarios
 
+    content_version = Column(String, nullable=True)     # refresh() skips the collection while the upstream responses have the same version
+    data_version = Column(Integer, nullable=False, server_default='0')     # see data/payloads.py
+
+class FeatureSetPayload(Base):
+    """
+    The features of a FeatureSet as a ready to serve, gzip compressed GeoJSON FeatureCollection, see data/payloads.py
+    Table name: feature_set_payloads
+    - `feature_set_id` [Integer] ID of the FeatureSet
+    - `level` [String] Geometry column the FeatureCollection was built from, see GEOMETRY_LEVELS
+    - `version` [Integer] `data_version` of the FeatureSet the FeatureCollection was built from
+    - `feature_count` [Integer] Number of features in the FeatureCollection
+    - `data` [LargeBinary] The gzip compressed FeatureCollection
+    - `created_at` [DateTime] When the FeatureCollection was built
+    """
+    __tablename__ = 'feature_set_payloads'
+    feature_set_id = Column(Integer, ForeignKey('feature_sets.id', ondelete='CASCADE'), primary_key=True)
+    level = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False)
+    feature_count = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+class SourceVersion(Base):
+    """
+    The version of an upstream source that was last saved to the database, i.e. the NINA dashboard of an ARS, see data/req_nina.py
+    Written in the same transaction as the data, so a version is only marked as processed once its data was saved.
+    Table name: source_versions
+    - `source` [String] Name of the source, i.e. `nina:020000000000`
+    - `content_version` [String] Hash of the response that was saved
+    - `updated_at` [DateTime] When the version was saved
+    """
+    __tablename__ = 'source_versions'
+    source = Column(String, primary_key=True)
+    content_version = Column(String, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
 class Layer(Base):
     """
     Table name: layers
@@ -238,56 +306,124 @@ class Alert(Base):
     contact = Column(String, nullable=True)
 
     # geojson area
-    geometry = Column(Geometry(geometry_type='GEOMETRY'), nullable=True)
+    geometry = Column(Geometry(geometry_type='GEOMETRY', spatial_index=True), nullable=True)  # GiST index idx_alerts_geometry
     area_description = Column(String, nullable=True)
 
     zgem = Column(String, nullable=True)        # zgem is some sort of area code, but i don't know what it stands for
 
+# location status of a list of locations, the SQL version of sidebar.location_status():
+# 'localized' if any location has an osm_id, 'pending' if there are locations but none is georeferenced, 'unlocalized' otherwise
+LOCATION_STATUS_SQL = """CASE
+    WHEN locations IS NULL OR jsonb_typeof(locations) = 'null' THEN 'unlocalized'
+    WHEN locations @? '$[*].osm_id' THEN 'localized'
+    WHEN locations @? '$[*]' THEN 'pending'
+    ELSE 'unlocalized'
+END"""
+
 class Report(Base):
     """
     A single RSS entry from a news site.
+    The table is partitioned by `timestamp`, see data/partitions.py. The primary key is (id, timestamp), the ORM identifies reports by `id` alone.
     """
     __tablename__ = 'reports'
-    id = Column(Integer, primary_key=True)          # db internal id
+    id = Column(Integer, primary_key=True, autoincrement=True)          # db internal id
     identifier = Column(String, nullable=False)     # unique identifier of the report as used by the source
 
     text = Column(String, nullable=False)
     url = Column(String, nullable=False)
     platform = Column(String, nullable=False)
-    timestamp = Column(DateTime, nullable=False)
+    timestamp = Column(DateTime, primary_key=True, nullable=False)     # partition key
     event_type = Column(String, nullable=False)
     relevance = Column(String, nullable=False)
-    locations = Column(JSON, nullable=True)
-    original_locations = Column(JSON, nullable=True)   # snapshot at import time, never overwritten
+    locations = Column(JSONB, nullable=True)
+    original_locations = Column(JSONB, nullable=True)   # snapshot at import time, never overwritten
+    location_status = Column(String, Computed(LOCATION_STATUS_SQL, persisted=True))    # generated from locations, see LOCATION_STATUS_SQL
     author = Column(String, nullable=True, default='')          # username / handle of the post author
     seen = Column(Boolean, nullable=False, server_default='false')          # whether this post has been marked as seen
     author_flagged = Column(Boolean, nullable=False, server_default='false')  # whether the author has been flagged
     user_states = relationship('UserReportState', back_populates='report', cascade='all, delete-orphan')
 
+    # indexes for the sidebar, dots and banner queries and the duplicate check in save_posts
+    # varchar_pattern_ops lets `LIKE 'prefix%'` use the index, independent of the database collation
+    # keep these in sync with build.migrate_columns()
+    # unique indexes of a partitioned table have to contain the partition key, a post keeps its timestamp so (identifier, timestamp) still rejects duplicates
+    __table_args__ = (
+        Index('ix_reports_identifier', 'identifier', 'timestamp', unique=True, postgresql_ops={'identifier': 'varchar_pattern_ops'}),
+        Index('ix_reports_timestamp', timestamp.desc()),
+        Index('ix_reports_platform_timestamp', 'platform', timestamp.desc(), postgresql_ops={'platform': 'varchar_pattern_ops'}),
+        # location filter of the sidebar and the dots, newest first
+        Index('ix_reports_location_status_timestamp', 'location_status', timestamp.desc()),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
+    __mapper_args__ = {'primary_key': [id]}
+
 
 class UserReportState(Base):
     """
     Per-user mutable state for a single report.
     Replaces the old browser-local report-state and user-locations stores.
+    Partitioned like the reports, by the timestamp of the report (`report_timestamp`), see data/partitions.py.
     """
     __tablename__ = 'user_report_state'
-    id            = Column(Integer, primary_key=True)
+    id            = Column(Integer, primary_key=True, autoincrement=True)
     username      = Column(String, nullable=False, index=True)
-    report_id     = Column(Integer, ForeignKey('reports.id', ondelete='CASCADE'), nullable=False)
+    report_id     = Column(Integer, nullable=False)
+    report_timestamp = Column(DateTime, primary_key=True, nullable=False)   # copy of Report.timestamp, partition key
     hide          = Column(Boolean, nullable=False, server_default='false')   # seen/hidden
     flag          = Column(Boolean, nullable=False, server_default='false')   # author flagged
     flag_author   = Column(String, nullable=True)    # denormalised author string when flag=True
-    locations     = Column(JSON, nullable=True)       # user-overridden locations
+    locations     = Column(JSONB, nullable=True)      # user-overridden locations
     first_seen_at = Column(DateTime, nullable=True)   # NULL = not yet admitted to sidebar; set on admit
     new           = Column(Boolean, nullable=False, server_default='true')    # True until user explicitly clicks/acknowledges the report
     report        = relationship('Report', back_populates='user_states')
-    __table_args__ = (UniqueConstraint('username', 'report_id', name='uq_user_report'),)
+    __table_args__ = (
+        ForeignKeyConstraint(['report_id', 'report_timestamp'], ['reports.id', 'reports.timestamp'], ondelete='CASCADE'),
+        UniqueConstraint('username', 'report_id', 'report_timestamp', name='uq_user_report'),
+        {'postgresql_partition_by': 'RANGE (report_timestamp)'},
+    )
+    __mapper_args__ = {'primary_key': [id]}
+
+
+class ReportLocation(Base):
+    """
+    A single location of a report, normalized from the JSON lists in `Report.locations` and `UserReportState.locations`.
+    Rows with `username` NULL mirror the locations of the report, rows with a username mirror the location override of that user.
+    The JSON lists stay the source of truth, this table is kept in sync by data/report_locations.py and used for filtering and the report dots.
+    `report_id` has no foreign key, the reports table is partitioned. The rows are removed with the reports by data/partitions.py.
+    - `report_id` [Integer] ID of the report
+    - `username` [String] (Optional) user that overrode the locations of the report, NULL for the locations of the report itself
+    - `position` [Integer] index of the location in the list
+    - `osm_id` [String] (Optional) OpenStreetMap id, NULL if the location is only a mention that is not georeferenced yet
+    - `osm_type` [String] (Optional) OpenStreetMap type, i.e. `relation`, `way` or `node`
+    - `name` [String] (Optional) name of the location
+    - `display_name` [String] (Optional) full display name of the location
+    - `mention` [String] (Optional) how the location was mentioned in the text of the report
+    - `geometry` [Geometry] (Optional) point of the location
+    - `polygon` [Geometry] (Optional) outline of the location
+    """
+    __tablename__ = 'report_locations'
+    id           = Column(Integer, primary_key=True)
+    report_id    = Column(Integer, nullable=False)
+    username     = Column(String, nullable=True)
+    position     = Column(Integer, nullable=False, server_default='0')
+    osm_id       = Column(String, nullable=True)
+    osm_type     = Column(String, nullable=True)
+    name         = Column(String, nullable=True)
+    display_name = Column(String, nullable=True)
+    mention      = Column(String, nullable=True)
+    geometry     = Column(Geometry(geometry_type='POINT', srid=4326, spatial_index=True), nullable=True)     # GiST index idx_report_locations_geometry
+    polygon      = Column(Geometry(geometry_type='GEOMETRY', srid=4326, spatial_index=False), nullable=True)
+    __table_args__ = (
+        Index('ix_report_locations_report_username', 'report_id', 'username'),
+    )
 
 
 # the following tables are defined in the database
 # UPDATE THIS IF YOU ADD NEW TABLES
 # this is used at startup to check if any tables are missing
 # if any are missing, the database is rebuilt
+# tables that build.migrate_columns() adds to existing databases (ReportLocation, FeatureSetPayload, SourceVersion) are not listed here,
+# otherwise a missing one would drop all data in a rebuild instead of being migrated
 TABLES = [
     Feature,
     FeatureSet,
@@ -0,0 +1,271 @@
+import gzip
+import os
+import re
+from datetime import date, datetime, timedelta
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+from data.model import Report, UserReportState
+
+# the settings below are read on import, load them from .env first
+load_dotenv()
+
+# time partitioning of the reports
+# `reports` is partitioned by `timestamp`, `user_report_state` by the timestamp of its report (`report_timestamp`),
+# both with the same bounds, so the partitions of one day/week can be detached and archived together
+# the partitions are named <table>_p<YYYYMMDD of the first day>, rows outside of all partitions end up in <table>_default
+
+# 'day' or 'week', only affects partitions that are created after changing it
+PARTITION_INTERVAL = os.getenv('REPORT_PARTITION_INTERVAL', 'week')
+
+# how many partitions after the current one are created in advance
+PARTITIONS_AHEAD = 2
+
+# reports older than this many days are archived and removed from the database, 0 keeps all reports
+REPORT_RETENTION_DAYS = int(os.getenv('REPORT_RETENTION_DAYS', '0'))
+
+# where the archived partitions are written to, one gzip compressed csv file per table and partition
+REPORT_ARCHIVE_DIR = os.getenv('REPORT_ARCHIVE_DIR', os.path.join('data', 'archive'))
+
+# partitioned table: partition key
+PARTITIONED_TABLES = {
+    'reports': 'timestamp',
+    'user_report_state': 'report_timestamp',
+}
+
+# user_report_state references reports, its partitions have to be removed first
+ARCHIVE_ORDER = ['user_report_state', 'reports']
+
+_BOUNDS = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+def partition_bounds(day: date, interval: str = PARTITION_INTERVAL) -> tuple:
+    """
+    Returns the first day of the partition that contains `day` and the first day of the next one.
+    """
+
+    if interval == 'day':
+        return day, day + timedelta(days=1)
+
+    if interval == 'week':
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=7)
+
+    raise ValueError(f"Unknown partition interval '{interval}', use 'day' or 'week'")
+
+def partition_name(table: str, start: date) -> str:
+    return f"{table}_p{start:%Y%m%d}"
+
+def is_partitioned(session, table: str) -> bool:
+    """
+    Returns True if `table` exists and is a partitioned table.
+    """
+
+    return session.execute(
+        text("SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid WHERE c.relname = :table"),
+        {'table': table}
+    ).first() is not None
+
+def list_partitions(session, table: str) -> list:
+    """
+    Returns the partitions of `table` as a list of (name, start, end), ordered by start.
+    `start` and `end` are datetimes, both None for the default partition.
+    """
+
+    rows = session.execute(text("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = :table
+    """), {'table': table}).all()
+
+    partitions = []
+
+    for name, bound in rows:
+        match = _BOUNDS.search(bound)
+        if match:
+            partitions.append((name, datetime.fromisoformat(match.group(1)), datetime.fromisoformat(match.group(2))))
+        else:
+            partitions.append((name, None, None))
+
+    return sorted(partitions, key=lambda partition: (partition[1] is not None, partition[1]))
+
+def ensure_partitions(session, since: date = None, ahead: int = PARTITIONS_AHEAD, verbose=False):
+    """
+    Create the default partitions and the partitions from `since` (default: today) up to `ahead` partitions after the current one.
+    Existing partitions are kept. A partition can not be created while the default partition holds rows in its range,
+    in that case it is skipped and the rows stay in the default partition. Does not commit.
+    """
+
+    today = datetime.utcnow().date()
+    start, _ = partition_bounds(since or today)
+    _, end = partition_bounds(today)
+
+    for _ in range(ahead):
+        _, end = partition_bounds(end)
+
+    for table in PARTITIONED_TABLES:
+
+        if not is_partitioned(session, table):
+            continue
+
+        session.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+
+        existing = {name for name, _, _ in list_partitions(session, table)}
+
+        day = start
+        while day < end:
+            lower, upper = partition_bounds(day)
+            name = partition_name(table, lower)
+
+            if name not in existing:
+                try:
+                    with session.begin_nested():
+                        session.execute(text(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM ('{lower}') TO ('{upper}')"))
+                    if verbose: print(f"Created partition {name}")
+                except Exception as e:
+                    print(f"Partition {name} skipped: {e}")
+
+            day = upper
+
+def partition_existing_tables(session, verbose=False) -> bool:
+    """
+    Convert unpartitioned `reports` and `user_report_state` tables (databases created before the partitioning) into partitioned ones.
+    The rows are copied into the new tables with their ids, the old tables are dropped. Runs in one transaction and commits.
+    Returns True if the tables were converted.
+    """
+
+    exists = session.execute(text("SELECT to_regclass('reports') IS NOT NULL")).scalar()
+
+    if not exists or is_partitioned(session, 'reports'):
+        return False
+
+    if verbose: print("Partitioning the reports table...")
+
+    # move the old tables out of the way, their index names would collide with the ones of the new tables
+    session.execute(text("ALTER TABLE user_report_state RENAME TO user_report_state_unpartitioned"))
+    session.execute(text("ALTER TABLE reports RENAME TO reports_unpartitioned"))
+    session.execute(text("""DO $$ DECLARE r record; BEGIN
+    FOR r IN SELECT indexname FROM pg_indexes WHERE tablename IN ('reports_unpartitioned', 'user_report_state_unpartitioned') LOOP
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', r.indexname, r.indexname || '_unpartitioned');
+    END LOOP;
+END $$"""))
+
+    connection = session.connection()
+    Report.__table__.create(connection)
+    UserReportState.__table__.create(connection)
+
+    # the partitions for all existing reports have to exist before the rows are copied
+    oldest = session.execute(text("SELECT min(timestamp) FROM reports_unpartitioned")).scalar()
+    ensure_partitions(session, since=oldest.date() if oldest else None)
+
+    # generated columns (location_status) are computed again on insert
+    report_columns = ', '.join(column.name for column in Report.__table__.columns if column.computed is None)
+    session.execute(text(f"INSERT INTO reports ({report_columns}) SELECT {report_columns} FROM reports_unpartitioned"))
+
+    state_columns = [column.name for column in UserReportState.__table__.columns if column.name != 'report_timestamp' and column.computed is None]
+    session.execute(text(f"""
+        INSERT INTO user_report_state ({', '.join(state_columns)}, report_timestamp)
+        SELECT {', '.join('u.' + column for column in state_columns)}, r.timestamp
+        FROM user_report_state_unpartitioned u JOIN reports_unpartitioned r ON r.id = u.report_id
+    """))
+
+    # continue the ids after the copied rows
+    for table in PARTITIONED_TABLES:
+        session.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(max(id), 0) + 1, false) FROM {table}"))
+
+    # CASCADE drops the foreign key of report_locations, which can not reference a partitioned table
+    session.execute(text("DROP TABLE user_report_state_unpartitioned, reports_unpartitioned CASCADE"))
+
+    session.commit()
+
+    if verbose: print("Done!")
+
+    return True
+
+def copy_to_archive(session, query: str, path: str):
+    """
+    Write the rows of `query` (a table name or a SELECT statement in parentheses) to `path` as gzip compressed csv with a header.
+    """
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    cursor = session.connection().connection.cursor()
+
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        cursor.copy_expert(f"COPY {query} TO STDOUT WITH (FORMAT csv, HEADER)", f)
+
+def archive_old_partitions(session, retention_days: int = REPORT_RETENTION_DAYS, archive_dir: str = REPORT_ARCHIVE_DIR, verbose=False) -> list:
+    """
+    Detach all partitions whose reports are older than `retention_days`, write them to `archive_dir` and drop them.
+    Reports in the default partition that are older than `retention_days` are archived and deleted as well.
+    Every partition is archived in its own transaction. Does nothing if `retention_days` is 0.
+    Returns the names of the archived partitions.
+
+    An archive can be loaded into an empty table with the same columns, i.e. with psql:
+    ```
+    \\copy reports FROM PROGRAM 'gunzip -c reports_p20250106.csv.gz' WITH (FORMAT csv, HEADER)
+    ```
+    """
+
+    if retention_days <= 0 or not is_partitioned(session, 'reports'):
+        return []
+
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    archived = []
+
+    partitions = {table: list_partitions(session, table) for table in ARCHIVE_ORDER}
+
+    for _, start, end in partitions['reports']:
+
+        # keep the default partition and all partitions that still contain reports inside of the retention period
+        if end is None or end > cutoff:
+            continue
+
+        # report_locations only mirrors the locations of the reports, no need to archive it
+        names = [(table, name) for table in ARCHIVE_ORDER for name, other_start, _ in partitions[table] if other_start == start]
+        report_partition = partition_name('reports', start.date())
+        session.execute(text(f"DELETE FROM report_locations WHERE report_id IN (SELECT id FROM {report_partition})"))
+
+        for table, name in names:
+            session.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+            copy_to_archive(session, name, os.path.join(archive_dir, f"{name}.csv.gz"))
+            session.execute(text(f"DROP TABLE {name}"))
+
+        session.commit()
+        archived.extend(name for _, name in names)
+
+        if verbose: print(f"Archived {', '.join(name for _, name in names)}")
+
+    # old rows that ended up in the default partition
+    old = "SELECT id FROM reports_default WHERE timestamp < :cutoff"
+    if session.execute(text(old + " LIMIT 1"), {'cutoff': cutoff}).first() is not None:
+
+        suffix = f"default_{cutoff:%Y%m%d}"
+        cutoff_literal = f"'{cutoff:%Y-%m-%d %H:%M:%S}'"
+
+        copy_to_archive(session, f"(SELECT * FROM user_report_state_default WHERE report_timestamp < {cutoff_literal})", os.path.join(archive_dir, f"user_report_state_{suffix}.csv.gz"))
+        copy_to_archive(session, f"(SELECT * FROM reports_default WHERE timestamp < {cutoff_literal})", os.path.join(archive_dir, f"reports_{suffix}.csv.gz"))
+
+        session.execute(text(f"DELETE FROM report_locations WHERE report_id IN ({old})"), {'cutoff': cutoff})
+        # deletes the user_report_state rows through the foreign key
+        session.execute(text("DELETE FROM reports_default WHERE timestamp < :cutoff"), {'cutoff': cutoff})
+        session.commit()
+
+        archived.extend([f"user_report_state_{suffix}", f"reports_{suffix}"])
+
+        if verbose: print(f"Archived the reports before {cutoff:%Y-%m-%d} from the default partitions")
+
+    return archived
+
+def maintain_partitions(session, verbose=False) -> list:
+    """
+    Create upcoming partitions and archive the ones outside of the retention period. Commits.
+    Returns the names of the archived partitions.
+    """
+
+    ensure_partitions(session, verbose=verbose)
+    session.commit()
+
+    return archive_old_partitions(session, verbose=verbose)
@@ -0,0 +1,160 @@
+import gzip
+import json
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from data.connect import stream_query
+from data.model import GEOMETRY_LEVELS, Feature, FeatureSet, FeatureSetPayload
+
+# ready to serve FeatureCollections per FeatureSet
+# the map builds its layers from these instead of reading, parsing and formatting every feature each time a layer is shown
+# a payload belongs to one `data_version` of its FeatureSet, whoever changes the features of a FeatureSet calls invalidate_payloads(),
+# the payloads are then built again right away (build_payloads()) or on the next request (get_payload())
+#
+# get_viewport_features() returns the features of a FeatureSet in a part of the map in the same format, queried with the spatial index
+#
+# every feature of a payload is {'type': 'Feature', 'id', 'geometry', 'properties', 'timestamp' (ISO string or None), 'popup' (HTML)}
+
+# the geometry columns a payload can be built from, see GEOMETRY_LEVELS
+PAYLOAD_LEVELS = ['geometry'] + [column for column, _, _ in GEOMETRY_LEVELS]
+
+def popup_html(feature_set_name: str, popup_properties: dict, properties: dict) -> str:
+    """
+    Returns the content of the popup of a feature: the name of its FeatureSet and the `popup_properties` of the Style.
+    """
+
+    popup_content = f"<b>{feature_set_name}</b><br>"
+
+    if popup_properties is not None:
+
+        for property in popup_properties:
+            current_property = popup_properties[property]
+            value = (properties or {}).get(current_property, '')
+            popup_content += f"<b>{property}</b>: {value}<br>"
+
+    return popup_content
+
+def _geometry_column(level: str):
+    geometry = getattr(Feature, level)
+    if level != 'geometry':
+        # points have no simplified geometry
+        geometry = func.coalesce(geometry, Feature.geometry)
+    return geometry
+
+def _feature_json(feature_set: FeatureSet, popup_properties: dict, feature_id: int, properties: dict, timestamp, geojson_geometry: str) -> str:
+    # the geometries already are GeoJSON text, the features are joined as text instead of parsing them again
+    return (
+        f'{{"type":"Feature","id":{feature_id},"geometry":{geojson_geometry},'
+        f'"properties":{json.dumps(properties)},'
+        f'"timestamp":{json.dumps(timestamp.isoformat() if timestamp is not None else None)},'
+        f'"popup":{json.dumps(popup_html(feature_set.name, popup_properties, properties))}}}'
+    )
+
+def build_payload(session, feature_set: FeatureSet, level: str = 'geometry') -> tuple:
+    """
+    Returns the gzip compressed FeatureCollection of `feature_set` with the geometries of `level` and its number of features.
+    The geometries are converted to GeoJSON by the database, the features are streamed and never loaded as Feature objects.
+    """
+
+    query = session.query(Feature.id, Feature.properties, Feature.timestamp, func.ST_AsGeoJSON(_geometry_column(level))) \
+        .filter(Feature.feature_set_id == feature_set.id) \
+        .order_by(Feature.id)
+
+    popup_properties = feature_set.style.popup_properties if feature_set.style is not None else None
+
+    parts = [_feature_json(feature_set, popup_properties, *row) for row in stream_query(query)]
+
+    collection = f'{{"type":"FeatureCollection","feature_set_id":{feature_set.id},"features":[{",".join(parts)}]}}'
+
+    return gzip.compress(collection.encode('utf-8'), compresslevel=6), len(parts)
+
+def store_payload(session, feature_set: FeatureSet, level: str, data: bytes, feature_count: int):
+    """
+    Saves a payload for the current `data_version` of `feature_set`, replacing the previous one of `level`. Does not commit.
+    """
+
+    values = {
+        'feature_set_id': feature_set.id,
+        'level': level,
+        'version': feature_set.data_version,
+        'feature_count': feature_count,
+        'data': data,
+        'created_at': datetime.utcnow(),
+    }
+
+    statement = pg_insert(FeatureSetPayload).values(**values)
+    session.execute(statement.on_conflict_do_update(
+        index_elements=['feature_set_id', 'level'],
+        set_={key: statement.excluded[key] for key in ('version', 'feature_count', 'data', 'created_at')}
+    ))
+
+def build_payloads(session, feature_set_ids, levels=PAYLOAD_LEVELS, verbose=False):
+    """
+    Builds and saves the payloads of all `levels` for the FeatureSets with the ids `feature_set_ids`. Does not commit.
+    """
+
+    # populate_existing: the data_version may have been increased with a bulk update in this session
+    for feature_set in session.query(FeatureSet).filter(FeatureSet.id.in_(list(feature_set_ids))).populate_existing():
+        for level in levels:
+            data, feature_count = build_payload(session, feature_set, level)
+            store_payload(session, feature_set, level, data, feature_count)
+
+        if verbose: print(f"Built the payloads of {feature_set.name} ({feature_count} features)")
+
+def invalidate_payloads(session, feature_set_ids):
+    """
+    Marks the payloads of the FeatureSets with the ids `feature_set_ids` as outdated, call this in the transaction that changes their features.
+    Does not commit.
+    """
+
+    feature_set_ids = list(feature_set_ids)
+
+    if not feature_set_ids:
+        return
+
+    session.query(FeatureSet).filter(FeatureSet.id.in_(feature_set_ids)) \
+        .update({FeatureSet.data_version: FeatureSet.data_version + 1}, synchronize_session=False)
+    session.query(FeatureSetPayload).filter(FeatureSetPayload.feature_set_id.in_(feature_set_ids)) \
+        .delete(synchronize_session=False)
+
+def get_payload(session, feature_set: FeatureSet, level: str = 'geometry') -> dict:
+    """
+    Returns the FeatureCollection of `feature_set` with the geometries of `level`, see the top of this file.
+    A missing or outdated payload is built, saved and committed, so every payload is only built once.
+    """
+
+    data = session.query(FeatureSetPayload.data).filter(
+        FeatureSetPayload.feature_set_id == feature_set.id,
+        FeatureSetPayload.level == level,
+        FeatureSetPayload.version == feature_set.data_version
+    ).scalar()
+
+    if data is None:
+        data, feature_count = build_payload(session, feature_set, level)
+        store_payload(session, feature_set, level, data, feature_count)
+        session.commit()
+
+    return json.loads(gzip.decompress(data))
+
+def get_viewport_features(session, feature_set: FeatureSet, level: str, bbox: list, limit: int) -> list:
+    """
+    Returns the features of `feature_set` that intersect `bbox` ([west, south, east, north] in WGS84), in the format of the payload features.
+    The features are selected with the spatial index on features.geometry, at most `limit` of them, the ones closest to the center of `bbox` first.
+    """
+
+    west, south, east, north = bbox
+    envelope = func.ST_MakeEnvelope(west, south, east, north, 4326)
+    center = func.ST_SetSRID(func.ST_MakePoint((west + east) / 2, (south + north) / 2), 4326)
+
+    query = session.query(Feature.id, Feature.properties, Feature.timestamp, func.ST_AsGeoJSON(_geometry_column(level))) \
+        .filter(Feature.feature_set_id == feature_set.id, Feature.geometry.op('&&')(envelope)) \
+        .order_by(Feature.geometry.op('<->')(center)) \
+        .limit(limit)
+
+    popup_properties = feature_set.style.popup_properties if feature_set.style is not None else None
+
+    parts = [_feature_json(feature_set, popup_properties, *row) for row in query]
+
+    return json.loads(f'[{",".join(parts)}]')
@@ -0,0 +1,110 @@
+# Keeps the report_locations table in sync with the JSON location lists of reports and user overrides
+# see ReportLocation in model.py
+
+from geoalchemy2 import WKTElement
+from shapely.geometry import shape
+from sqlalchemy import and_, or_
+
+from data.connect import stream_batches
+from data.model import Report, UserReportState, ReportLocation
+
+def location_to_row(location: dict, report_id: int, username: str = None, position: int = 0) -> ReportLocation:
+    """
+    Convert a single location dict (as stored in `Report.locations`) into a ReportLocation.
+    """
+
+    # the point of the location, only if it has coordinates
+    geometry = None
+    lat, lon = location.get('lat'), location.get('lon')
+    if lat is not None and lon is not None:
+        geometry = WKTElement(f'POINT({float(lon)} {float(lat)})', srid=4326)
+
+    # the outline of the location, stored as GeoJSON geometry in the location dict
+    polygon = None
+    if location.get('polygon'):
+        try:
+            polygon = WKTElement(shape(location['polygon']).wkt, srid=4326)
+        except Exception:
+            polygon = None
+
+    osm_id = location.get('osm_id')
+
+    return ReportLocation(
+        report_id=report_id,
+        username=username,
+        position=position,
+        osm_id=str(osm_id) if 'osm_id' in location and osm_id is not None else None,
+        osm_type=location.get('osm_type'),
+        name=location.get('name'),
+        display_name=location.get('display_name'),
+        mention=location.get('mention'),
+        geometry=geometry,
+        polygon=polygon
+    )
+
+def location_rows(report_id: int, locations: list, username: str = None) -> list:
+    """
+    Convert a list of location dicts into ReportLocations.
+    """
+
+    return [location_to_row(location, report_id, username, position) for position, location in enumerate(locations or [])]
+
+def sync_report_locations(session, report_id: int, locations: list, username: str = None):
+    """
+    Replace the ReportLocations of a report (username None) or of a users override with `locations`.
+    `locations` None removes the rows, i.e. when a user override is cleared. Does not commit.
+    """
+
+    if username is None:
+        owner = ReportLocation.username.is_(None)
+    else:
+        owner = ReportLocation.username == username
+
+    session.query(ReportLocation).filter(ReportLocation.report_id == report_id, owner).delete(synchronize_session=False)
+
+    if locations:
+        session.add_all(location_rows(report_id, locations, username))
+
+def backfill_report_locations(session, verbose=False):
+    """
+    Fill the report_locations table from the JSON locations of all reports and user overrides.
+    Used once when the table is added to an existing database. Does not commit.
+    """
+
+    count = 0
+
+    reports = session.query(Report.id, Report.locations).filter(Report.locations.isnot(None))
+    for batch in stream_batches(reports):
+        rows = [row for report_id, locations in batch for row in location_rows(report_id, locations)]
+        session.add_all(rows)
+        session.flush()
+        count += len(rows)
+
+    overrides = session.query(UserReportState.report_id, UserReportState.username, UserReportState.locations).filter(UserReportState.locations.isnot(None))
+    for batch in stream_batches(overrides):
+        rows = [row for report_id, username, locations in batch for row in location_rows(report_id, locations, username)]
+        session.add_all(rows)
+        session.flush()
+        count += len(rows)
+
+    if verbose: print(f"Backfilled {count} report locations")
+
+def effective_locations(username: str = None, overridden_ids=()):
+    """
+    Condition on ReportLocation that selects the locations in effect for `username`:
+    the rows of the users override for the reports in `overridden_ids`, the rows of the report itself for all others.
+    """
+
+    overridden_ids = [int(report_id) for report_id in overridden_ids]
+
+    if not overridden_ids:
+        return ReportLocation.username.is_(None)
+
+    base = and_(ReportLocation.username.is_(None), ReportLocation.report_id.notin_(overridden_ids))
+
+    if username is None:
+        return base
+
+    own = and_(ReportLocation.username == username, ReportLocation.report_id.in_(overridden_ids))
+
+    return or_(own, base)
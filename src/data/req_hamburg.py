@@ -1,14 +1,43 @@
 # This file handles API requests to OGC API Features data sources
 # While it is specifically tailored to api.hamburg.de, it should work for other OGC API Features sources as well
 
+import os
+import hashlib
 import requests
 import json
-
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from dotenv import load_dotenv
+
+from data import http_cache
+from data.http_cache import cached_get
 from data.model import Collection, Feature
 
+# the settings below are read on import, load them from .env first
+load_dotenv()
+
 # the accepted JSON types
 ACCEPTED_JSON_TYPES = ['application/json', 'application/geo+json']
 
+# how many collections are requested at the same time in refresh()
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', '8'))
+
+# how many of those requests may go to the same host at the same time
+FETCH_PER_HOST = int(os.getenv('FETCH_PER_HOST', '4'))
+
+# minimum time between the start of two requests to the same host (in seconds)
+FETCH_HOST_DELAY = float(os.getenv('FETCH_HOST_DELAY', '0.0'))
+
+# how many items are requested per page
+FETCH_PAGE_SIZE = int(os.getenv('FETCH_PAGE_SIZE', '1000'))
+
+# how long to wait for a single page of items (in seconds)
+FETCH_TIMEOUT = 300
+
 def get_api_collections(base_api: str):
     """
     Returns the collections object from the API base URL
@@ -20,7 +49,7 @@ def get_api_collections(base_api: str):
     # the header we send with our requests
     headers = {'Content-Type': 'application/json'}
 
-    base_response = requests.get(base_api, headers=headers)
+    base_response = cached_get(base_api, headers=headers)
 
     # check if the request was successful
     if base_response.status_code == 200:
@@ -33,7 +62,7 @@ def get_api_collections(base_api: str):
             if base_link['rel'] == 'data':
                 collections_api = base_link['href']
 
-                collections_response = requests.get(collections_api, headers=headers)
+                collections_response = cached_get(collections_api, headers=headers)
 
                 # check if the request was successful
                 if collections_response.status_code == 200:
@@ -83,29 +112,220 @@ def get_base_endpoint(collection: dict):
         
 def request_items(collection: Collection, verbose=False):
     """
-    Takes in a Collection object from the database and requests the dataset items from the API.
-    Returns the GeoJSON response from the API or None if the request failed.
+    Takes in a Collection object from the database and requests all of its items from the API, page by page.
+    Returns a GeoJSON FeatureCollection with all features or None if the request failed.
+    Use `iter_items()` or `request_item_pages()` to process large collections without holding all features in memory.
     """
 
-    url_items = collection.url_items
-    entries = collection.entries
+    try:
+        features = list(iter_items(collection.url_items))
+    except requests.RequestException as e:
+        if verbose: print(f'{collection.identifier} failed: {e}')
+        return None
+
+    if verbose: print(f'{collection.identifier} returned {len(features)} out of {collection.entries} items')
 
-    # also add the limit parameter to the url
-    # it controls how many items are returned
-    # TODO: if the number of items is large, make multiple smaller requests
+    return {'type': 'FeatureCollection', 'features': features, 'numberReturned': len(features)}
 
-    url_items = url_items + f'&limit={entries}'
-    response = requests.get(url_items)
+def with_limit(url: str, limit: int) -> str:
+    """
+    Returns `url` with the query parameter `limit` set to `limit`.
+    """
 
-    if response.status_code == 200:
+    parts = urlparse(url)
+    query = dict(parse_qsl(parts.query, keep_blank_values=True))
+    query['limit'] = str(limit)
 
-        response_json = response.json()
-        if verbose: print(f'{collection.identifier} returned {response_json["numberReturned"]} out of {entries} items')
+    return urlunparse(parts._replace(query=urlencode(query)))
+
+def get_next_link(response_json: dict):
+    """
+    Returns the link with the rel 'next' of an items response, or None on the last page.
+    """
+
+    for link in response_json.get('links', []):
+        if link.get('rel') == 'next' and link.get('type', ACCEPTED_JSON_TYPES[0]) in ACCEPTED_JSON_TYPES:
+            return link['href']
 
-        return response_json
-    
     return None
 
+def request_item_responses(url_items: str, page_size: int = FETCH_PAGE_SIZE, timeout=FETCH_TIMEOUT, limiter=None):
+    """
+    Generator over the pages of the items endpoint `url_items`, following the links with the rel 'next'.
+    Yields (response, features) per page, `response` is the CachedResponse of the page, see data/http_cache.py.
+    Every request goes through `limiter` (a HostLimiter) if given. Raises `requests.RequestException` if a request fails.
+    """
+
+    url = with_limit(url_items, page_size)
+    visited = set()
+
+    while url is not None and url not in visited:
+        visited.add(url)
+
+        if limiter is None:
+            response = cached_get(url, timeout=timeout)
+        else:
+            with limiter.limit(url):
+                response = cached_get(url, timeout=timeout)
+
+        response.raise_for_status()
+        response_json = response.json()
+
+        features = response_json.get('features', [])
+
+        yield response, features
+
+        # some servers keep sending a next link after the last page
+        if len(features) == 0:
+            break
+
+        url = get_next_link(response_json)
+
+def request_item_pages(url_items: str, page_size: int = FETCH_PAGE_SIZE, timeout=FETCH_TIMEOUT, limiter=None):
+    """
+    Generator over the pages of the items endpoint `url_items`, see `request_item_responses()`.
+    Yields the list of features of every page, only one page is held in memory at a time.
+    """
+
+    for _, features in request_item_responses(url_items, page_size, timeout, limiter):
+        yield features
+
+def iter_items(url_items: str, page_size: int = FETCH_PAGE_SIZE, timeout=FETCH_TIMEOUT):
+    """
+    Generator over all features of the items endpoint `url_items`, requested page by page, see `request_item_pages()`.
+    """
+
+    for page in request_item_pages(url_items, page_size, timeout):
+        yield from page
+
+class HostLimiter:
+    """
+    Limits the concurrent requests per host to `per_host` and spaces the start of requests to the same host by at least `delay` seconds.
+    ```
+    limiter = HostLimiter(per_host=2, delay=0.5)
+    with limiter.limit(url):
+        requests.get(url)
+    ```
+    """
+
+    def __init__(self, per_host: int = FETCH_PER_HOST, delay: float = FETCH_HOST_DELAY):
+        self.per_host = max(per_host, 1)
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._next_start = {}
+
+    @contextmanager
+    def limit(self, url: str):
+        host = urlparse(url).netloc
+
+        with self._lock:
+            semaphore = self._semaphores.setdefault(host, threading.BoundedSemaphore(self.per_host))
+
+        with semaphore:
+
+            # reserve the next free start time of the host
+            with self._lock:
+                now = time.monotonic()
+                start = max(now, self._next_start.get(host, now))
+                self._next_start[host] = start + self.delay
+
+            if start > now:
+                time.sleep(start - now)
+
+            yield
+
+def fetch_items_parallel(jobs: list, workers: int = FETCH_WORKERS, per_host: int = FETCH_PER_HOST, delay: float = FETCH_HOST_DELAY, page_size: int = FETCH_PAGE_SIZE, timeout=FETCH_TIMEOUT):
+    """
+    Requests the items of many collections at the same time, page by page.
+    `jobs` is a list of (key, url_items, identifier, version) tuples with plain values, no database objects,
+    so the worker threads never touch a session. `version` is the content version of the last refresh, or None.
+    Yields (key, features, result, seconds) in the order the pages arrive:
+    - one item per page with the features of the page and `result` None
+    - one last item per collection with `features` an empty list (None if a request of the collection failed)
+      and `result` a dict with the `status` 'complete', 'unchanged' or 'failed' and the `version` of the responses
+    `seconds` is the time since the first request of the collection.
+    The pages are requested through the HTTP cache (see data/http_cache.py). Pages are only passed on once one of them changed,
+    if all pages are the same as the cached ones and their version is still `version`, no page is passed on and the status is 'unchanged'.
+    At most `workers` collections are requested at the same time, at most `per_host` requests go to the same host, see HostLimiter.
+    The workers wait while `workers` pages are not consumed yet, so memory stays bounded by the page size.
+    """
+
+    limiter = HostLimiter(per_host, delay)
+    pages = queue.Queue(maxsize=max(workers, 1))
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        # give up when the consumer stopped, otherwise a worker would block forever on a full queue
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch(job):
+        key, url_items, identifier, version = job
+        start = time.perf_counter()
+        digests = hashlib.md5()
+
+        # urls of the unchanged pages that were not passed on yet, they are read from the cache again if a later page changed
+        pending = []
+        changed = False
+
+        def put_page(features) -> bool:
+            return put((key, features, None, time.perf_counter() - start))
+
+        try:
+            for response, features in request_item_responses(url_items, page_size, timeout, limiter):
+                digests.update(response.digest.encode('ascii'))
+
+                if not changed and response.not_modified:
+                    pending.append(response.url)
+                    continue
+
+                if not changed:
+                    changed = True
+                    for url in pending:
+                        if not put_page(http_cache.load(url).json().get('features', [])):
+                            return
+
+                if not put_page(features):
+                    return
+
+            # all pages are cached, but the features in the database may be from other responses (i.e. after a rebuild)
+            if not changed and digests.hexdigest() != version:
+                for url in pending:
+                    if not put_page(http_cache.load(url).json().get('features', [])):
+                        return
+                changed = True
+
+        except Exception as e:
+            print(f"Requesting the items of {identifier} failed: {e}")
+            put((key, None, {'status': 'failed', 'version': None}, time.perf_counter() - start))
+            return
+
+        result = {'status': 'complete' if changed else 'unchanged', 'version': digests.hexdigest()}
+        put((key, [], result, time.perf_counter() - start))
+
+    executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='fetch-items')
+
+    try:
+        for job in jobs:
+            executor.submit(fetch, job)
+
+        remaining = len(jobs)
+
+        while remaining > 0:
+            item = pages.get()
+            if item[2] is not None:
+                remaining -= 1
+            yield item
+    finally:
+        stopped.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
 def get_collection_properties(collection: Collection):
     """
     This function takes in a Collection object from the database and returns the set of all properties of its features.
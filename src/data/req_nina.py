@@ -1,13 +1,16 @@
 # Handling API requests to the NINA API
 # See here: https://nina.api.bund.dev/
 
-import requests
+import asyncio
 from datetime import datetime, timedelta
+from sqlalchemy import select
 from shapely.geometry import shape
 from geoalchemy2 import WKTElement
 
-from data.model import Alert
-from data.connect import autoconnect_db
+from data.model import Alert, SourceVersion
+from data.connect import session_scope
+from data.connect_async import async_session_scope
+from data.http_cache import cached_get
 
 # the endpoint for the nina api
 BASE_URL = 'https://warnung.bund.de/api31'
@@ -16,46 +19,110 @@ BASE_URL = 'https://warnung.bund.de/api31'
 # see here: https://www.penultima.de/ars/
 ARS = '020000000000'
 
+def nina_source(ars=ARS) -> str:
+    """
+    Returns the name of the dashboard of `ars` in the source_versions table.
+    """
+
+    return f"nina:{ars}"
+
 def save_alerts(ars=ARS):
     """
     Save new all alerts from the nina api for the configured ARS to the database.
+    Does not touch the database if the dashboard did not change since it was last saved.
+    The version of the dashboard is saved in the same transaction as the alerts (see SourceVersion),
+    so a dashboard whose alerts could not be requested or saved is processed again on the next call.
+    The nina api is requested before the session for the alerts is opened, no transaction is kept open during the requests.
     """
 
-    alerts_nina, alerts_details, alerts_geojson = get_alerts()
-
     alerts_db = []
 
+    with session_scope() as session:
+        processed = session.get(SourceVersion, nina_source(ars))
+        processed_version = processed.content_version if processed is not None else None
+
+    alerts_nina, alerts_details, alerts_geojson, version = get_alerts(ars, processed_version)
+
+    # the dashboard could not be requested, or it did not change since it was saved
+    if version is None or processed_version == version:
+        return alerts_db
+
     # save all alerts to the database
-    engine, session = autoconnect_db()
+    with session_scope() as session:
+
+        # get all existing Alerts from the last 30 days
+        # to avoid duplicates
+        alerts_existing = session.query(Alert).filter(Alert.timestamp > datetime.now() - timedelta(days=30)).all()
 
-    # get all existing Alerts from the last 30 days
-    # to avoid duplicates
-    alerts_existing = session.query(Alert).filter(Alert.timestamp > datetime.now() - timedelta(days=30)).all()
+        # get the hashes of the existing alerts
+        hashes_existing = [alert.hash for alert in alerts_existing]
 
-    # get the hashes of the existing alerts
-    hashes_existing = [alert.hash for alert in alerts_existing]
+        for alert_nina in alerts_nina:
+            # compare the hash of the alert to the existing hashes
+            if alert_nina['payload']['hash'] in hashes_existing:
+                print(f'Recieved duplicate alert, skipping... (hash={alert_nina["payload"]["hash"]})')
+                continue
 
-    for alert_nina in alerts_nina:
-        # compare the hash of the alert to the existing hashes
-        if alert_nina['payload']['hash'] in hashes_existing:
-            print(f'Recieved duplicate alert, skipping... (hash={alert_nina["payload"]["hash"]})')
-            continue
+            alert_db = create_alert(alert_nina, alerts_details, alerts_geojson)
+            alerts_db.append(alert_db)
+            print(f'Saved new alert (hash={alert_nina["payload"]["hash"]})')
 
-        alert_db = create_alert(alert_nina, alerts_details, alerts_geojson)
-        alerts_db.append(alert_db)
-        print(f'Saved new alert (hash={alert_nina["payload"]["hash"]})')
+        session.add_all(alerts_db)
+        session.merge(SourceVersion(source=nina_source(ars), content_version=version, updated_at=datetime.utcnow()))
+        session.commit()
 
-    session.add_all(alerts_db)
-    session.commit()
+    return alerts_db
 
-    session.close()
-    engine.dispose()
+async def save_alerts_async(ars=ARS):
+    """
+    Async variant of `save_alerts()`.
+    The nina api is requested in a worker thread while the hashes of the existing alerts are loaded from the database.
+    """
+
+    async with async_session_scope() as session:
+
+        processed_version = await session.scalar(select(SourceVersion.content_version).filter(SourceVersion.source == nina_source(ars)))
+
+        # get the hashes of all existing Alerts from the last 30 days
+        # to avoid duplicates
+        query_existing = session.execute(select(Alert.hash).filter(Alert.timestamp > datetime.now() - timedelta(days=30)))
+
+        (alerts_nina, alerts_details, alerts_geojson, version), result_existing = await asyncio.gather(
+            asyncio.to_thread(get_alerts, ars, processed_version),
+            query_existing
+        )
+
+        # the dashboard could not be requested, or it did not change since it was saved
+        if version is None or processed_version == version:
+            return []
+
+        hashes_existing = set(result_existing.scalars().all())
+
+        alerts_db = []
+
+        for alert_nina in alerts_nina:
+            # compare the hash of the alert to the existing hashes
+            if alert_nina['payload']['hash'] in hashes_existing:
+                print(f'Recieved duplicate alert, skipping... (hash={alert_nina["payload"]["hash"]})')
+                continue
+
+            alert_db = create_alert(alert_nina, alerts_details, alerts_geojson)
+            alerts_db.append(alert_db)
+            print(f'Saved new alert (hash={alert_nina["payload"]["hash"]})')
+
+        session.add_all(alerts_db)
+        await session.merge(SourceVersion(source=nina_source(ars), content_version=version, updated_at=datetime.utcnow()))
+        await session.commit()
 
     return alerts_db
 
-def get_alerts(ars=ARS):
+def get_alerts(ars=ARS, processed_version=None):
     """
-    Get all alerts from the nina api for the configured ARS
+    Get all alerts from the nina api for the configured ARS.
+    The requests go through the HTTP cache (see data/http_cache.py).
+    Returns the alerts of the dashboard, their details and areas, and the version of the dashboard (None if it could not be requested).
+    If the version is `processed_version`, the dashboard was already saved and no alerts are returned.
+    Raises an exception if the details of an alert could not be requested, the dashboard then has to be processed again.
     """
 
     # get all alerts from the nina api dashboard
@@ -63,13 +130,15 @@ def get_alerts(ars=ARS):
 
     # get the alerts from the nina api
     try:
-        response = requests.get(url, timeout=10)
+        response = cached_get(url, timeout=10)
         response.raise_for_status()
-        
         alerts_dashboard = response.json()
     except Exception as e:
         print(f"Error fetching alerts: {e}")
-        alerts_dashboard = []
+        return [], [], [], None
+
+    if response.digest == processed_version:
+        return [], [], [], response.digest
 
     ids = [alert['id'] for alert in alerts_dashboard]
 
@@ -81,13 +150,15 @@ def get_alerts(ars=ARS):
         json_url = BASE_URL + "/warnings/" + id + ".json"
         geojson_url = BASE_URL + "/warnings/" + id + ".geojson"
 
-        json_response = requests.get(json_url)
+        json_response = cached_get(json_url)
+        json_response.raise_for_status()
         alerts_details.append(json_response.json())
 
-        geojson_reponse = requests.get(geojson_url)
+        geojson_reponse = cached_get(geojson_url)
+        geojson_reponse.raise_for_status()
         alert_geojson.append(geojson_reponse.json())
     
-    return alerts_dashboard, alerts_details, alert_geojson
+    return alerts_dashboard, alerts_details, alert_geojson, response.digest
 
 def create_alert(alert_dashboard, alert_details, alert_geojson):
     """
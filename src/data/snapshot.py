@@ -0,0 +1,186 @@
+import json
+import os
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+from data.model import Base
+from data.connect import session_scope
+from data.partitions import ensure_partitions
+
+# snapshots of the map content (datasets, collections, feature sets, layers, styles, colormaps, scenarios and features)
+# a snapshot is a single zip file with a manifest and one compressed entry per table in the binary COPY format of postgres,
+# geometries are stored as EWKB. Importing a snapshot replaces the map content, like build() but without any requests to the APIs
+
+# the settings below are read on import, load them from .env first
+load_dotenv()
+
+# where `main.py --export-snapshot` writes and `--import-snapshot` / build_if_uninitialized() read the snapshot
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', os.path.join('data', 'snapshot.zip'))
+
+# the tables in the snapshot, in the order of their foreign keys
+SNAPSHOT_TABLES = ['datasets', 'collections', 'layers', 'colormaps', 'styles', 'feature_sets', 'scenarios', 'feature_set_scenario_association', 'features']
+
+# tables that are derived from the snapshot tables, they are dropped together with them and filled again on demand (see data/payloads.py)
+DERIVED_TABLES = ['feature_set_payloads']
+
+# increase when the layout of the snapshot file changes
+SNAPSHOT_FORMAT = 1
+
+def snapshot_columns(table: str) -> list:
+    """
+    Returns the columns of `table` that are written to the snapshot, generated columns are computed again on import.
+    """
+
+    return [column.name for column in Base.metadata.tables[table].columns if column.computed is None]
+
+def column_types(session, table: str) -> dict:
+    """
+    Returns {column name: type} of `table` as stored in the database, i.e. 'geometry(Geometry,4326)' or 'jsonb'.
+    """
+
+    rows = session.execute(text("""
+        SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = CAST(:table AS regclass) AND attnum > 0 AND NOT attisdropped
+    """), {'table': table}).all()
+
+    return dict(rows)
+
+def export_snapshot(path: str = SNAPSHOT_PATH, verbose=False) -> dict:
+    """
+    Writes the map content of the database to the snapshot file `path`.
+    All tables are read in one repeatable read transaction, so the snapshot is consistent while refresh() runs.
+    The file is written next to `path` first and renamed at the end. Returns the manifest of the snapshot.
+    """
+
+    start = time.perf_counter()
+    manifest = {'format': SNAPSHOT_FORMAT, 'created_at': datetime.utcnow().isoformat(), 'tables': []}
+
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.zip')
+    os.close(fd)
+
+    try:
+        with session_scope() as session, zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as archive:
+
+            # has to be the first statement of the transaction
+            session.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY"))
+
+            cursor = session.connection().connection.cursor()
+
+            for table in SNAPSHOT_TABLES:
+                columns = snapshot_columns(table)
+                types = column_types(session, table)
+
+                with archive.open(f"{table}.copy", 'w', force_zip64=True) as entry:
+                    cursor.copy_expert(f"COPY (SELECT {', '.join(columns)} FROM {table}) TO STDOUT WITH (FORMAT binary)", entry)
+
+                manifest['tables'].append({
+                    'name': table,
+                    'columns': [{'name': column, 'type': types[column]} for column in columns],
+                    'rows': cursor.rowcount,
+                })
+
+                if verbose: print(f"Exported {cursor.rowcount} rows of {table}")
+
+            session.rollback()
+
+            archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    if verbose: print(f"Wrote {path} ({os.path.getsize(path) / 1e6:.1f} MB) in {time.perf_counter() - start:.1f}s")
+
+    return manifest
+
+def check_manifest(manifest: dict, path: str = SNAPSHOT_PATH):
+    """
+    Raises ValueError if the snapshot with `manifest` does not match the tables of model.py, i.e. when it was exported before a migration.
+    Only needs the manifest, so it runs before anything in the database is changed.
+    """
+
+    if manifest.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError(f"{path} has snapshot format {manifest.get('format')}, expected {SNAPSHOT_FORMAT}")
+
+    for table in manifest['tables']:
+        name = table['name']
+
+        if name not in SNAPSHOT_TABLES:
+            raise ValueError(f"{path} contains the unknown table {name}")
+
+        columns = [column['name'] for column in table['columns']]
+        expected = snapshot_columns(name)
+
+        if sorted(columns) != sorted(expected):
+            raise ValueError(f"Table {name} of {path} has the columns {columns}, model.py has {expected}")
+
+def import_snapshot(path: str = SNAPSHOT_PATH, verbose=False) -> dict:
+    """
+    Replaces the map content of the database with the snapshot file `path`: drops the tables of the snapshot, creates them again
+    and loads them with COPY. Reports, alerts and user states are not part of a snapshot and are kept, missing tables are created empty.
+    Raises ValueError if the snapshot does not match the tables of model.py, i.e. when it was exported before a migration.
+    The columns are checked before anything is dropped, and everything runs in one transaction, so the database is unchanged if the import fails.
+    Returns the manifest of the snapshot.
+    """
+
+    start = time.perf_counter()
+
+    with zipfile.ZipFile(path) as archive:
+        manifest = json.loads(archive.read('manifest.json'))
+
+        check_manifest(manifest, path)
+
+        with session_scope() as session:
+            try:
+                connection = session.connection()
+
+                # DDL is transactional in postgres, a failing import leaves the old tables in place
+                session.execute(text("CREATE EXTENSION IF NOT EXISTS postgis"))
+                # only the map content is replaced, the other tables are created if they are missing
+                tables = [Base.metadata.tables[name] for name in SNAPSHOT_TABLES + DERIVED_TABLES]
+                Base.metadata.drop_all(connection, tables=tables)
+                Base.metadata.create_all(connection)
+                ensure_partitions(session)
+
+                cursor = connection.connection.cursor()
+
+                for table in manifest['tables']:
+                    name = table['name']
+                    types = column_types(session, name)
+
+                    # the binary format has no type information, the columns have to be exactly the same
+                    for column in table['columns']:
+                        if types.get(column['name']) != column['type']:
+                            raise ValueError(f"Column {name}.{column['name']} of the snapshot is {column['type']}, the database has {types.get(column['name'])}")
+
+                    columns = ', '.join(column['name'] for column in table['columns'])
+
+                    with archive.open(f"{name}.copy") as entry:
+                        cursor.copy_expert(f"COPY {name} ({columns}) FROM STDIN WITH (FORMAT binary)", entry)
+
+                    # continue the ids after the loaded rows
+                    if 'id' in types:
+                        session.execute(text(f"SELECT setval(pg_get_serial_sequence('{name}', 'id'), COALESCE(max(id), 0) + 1, false) FROM {name}"))
+
+                    if verbose: print(f"Imported {table['rows']} rows of {name}")
+
+                session.commit()
+            except BaseException:
+                session.rollback()
+                raise
+
+            for table in manifest['tables']:
+                session.execute(text(f"ANALYZE {table['name']}"))
+            session.commit()
+
+    if verbose: print(f"Imported {path} from {manifest['created_at']} in {time.perf_counter() - start:.1f}s")
+
+    return manifest
@@ -1,14 +1,30 @@
 # Launches the map app
 from app.app import get_app
-from data.build import build, build_if_uninitialized
+from data.build import build, build_if_uninitialized, refresh
+from data.snapshot import SNAPSHOT_PATH, export_snapshot, import_snapshot
 import sys
 import os
 
+def get_param_value(params: list, name: str, default: str) -> str:
+    """
+    Returns the value after the launch parameter `name`, or `default` if it has none.
+    """
+
+    index = params.index(name)
+
+    if index + 1 < len(params) and not params[index + 1].startswith('-'):
+        return params[index + 1]
+
+    return default
+
 def main():
     """
     Launches the map app. Launch parameters:
     `-rebuild`: rebuilds the database
-    `-verbose`: prints status information when used with `-rebuild`
+    `-refresh`: requests the features of all collections again, `-full` replaces all of them instead of only the changed ones
+    `-verbose`: prints status information when used with `-rebuild` or `-refresh`
+    `-export-snapshot [path]`: writes the map content of the database to a snapshot file and exits
+    `-import-snapshot [path]`: replaces the map content of the database with a snapshot file, without requesting the APIs
     `-help`: prints this help message
     """
 
@@ -22,11 +38,23 @@ def main():
         if '--help' in params:
             print("""Launch Parameters:
                     -rebuild: rebuilds the database
-                    -verbose: prints status information when rebuilding the database. Must be used with -rebuild
+                    -refresh: requests the features of all collections again. With -full, all features are replaced instead of only the changed ones
+                    -verbose: prints status information when rebuilding or refreshing the database. Must be used with -rebuild or -refresh
+                    -export-snapshot [path]: writes the map content of the database to a snapshot file and exits
+                    -import-snapshot [path]: replaces the map content of the database with a snapshot file, without requesting the APIs
                     -help: prints this help message
                     """)
             return
         
+        # if launched with parameter --export-snapshot, write the snapshot and exit
+        if '--export-snapshot' in params:
+            export_snapshot(get_param_value(params, '--export-snapshot', SNAPSHOT_PATH), verbose=True)
+            return
+
+        # if launched with parameter --import-snapshot, replace the map content with the snapshot
+        if '--import-snapshot' in params:
+            import_snapshot(get_param_value(params, '--import-snapshot', SNAPSHOT_PATH), verbose=True)
+
         # if launched with parameter --rebuild, rebuild the database
         if '--rebuild' in params or '-r' in params:
 
@@ -35,6 +63,15 @@ def main():
 
             # rebuild the database
             build(verbose=verbose)
+
+        # if launched with parameter --refresh, refresh the features
+        elif '--refresh' in params:
+
+            verbose = '--verbose' in params or '-v' in params
+
+            from data.connect import session_scope
+            with session_scope() as session:
+                refresh(session, full='--full' in params, verbose=verbose)
         
         # if launched with parameter --debug, run the app in debug mode
         debug = '--debug' in params or '-d' in params
@@ -49,10 +86,9 @@ def main():
         os.environ['DEMO_MODE'] = '1'
         print("Running in demo mode")
         from data.build import seed_demo_data
-        from data.connect import autoconnect_db
-        _, _demo_session = autoconnect_db()
-        seed_demo_data(_demo_session)
-        _demo_session.close()
+        from data.connect import session_scope
+        with session_scope() as _demo_session:
+            seed_demo_data(_demo_session)
 
     # get the map app
     m = get_app()
@@ -2,14 +2,25 @@
 
 from flask import Flask, request, jsonify
 from datetime import datetime
+from os import getenv
+from sqlalchemy import select, update, delete
+from dotenv import load_dotenv
 
 # internal imports
 from data.build import feature_to_obj
-from data.connect import autoconnect_db
-from data.model import FeatureSet, Feature, Style, Layer
+from data.connect import session_scope, pool_status
+from data.connect_async import async_session_scope, run_coroutine
+from data.model import FeatureSet, FeatureSetPayload, Feature, Style, Layer
+from data.payloads import invalidate_payloads
 
 app = Flask(__name__)
 
+# the settings below are read on import, load them from .env first
+load_dotenv()
+
+# set to True to use the async database layer, see save_event_async()
+ASYNC_DB = getenv('ASYNC_DB', 'false').lower() in ('1', 'true', 'yes')
+
 # test commands
 # curl -X POST -H "Content-Type: application/json" -d "{\"event\": {\"timestamp\": 1609459200.0, \"event_type\": \"earthquake\", \"geometry\": {\"type\": \"Point\", \"coordinates\": [125.6, 10.1]}}, \"predictions\": [{\"timestamp\": 1609459300.0, \"event_type\": \"aftershock\", \"geometry\": {\"type\": \"Point\", \"coordinates\": [125.7, 10.2]}}]}" http://localhost:8051/eventserver
 # curl -X POST -H "Content-Type: application/json" "localhost:8051/eventserver" -d "{\"event\":{\"timestamp\":1704453251,\"event_type\":\"Überschwemmung\",\"geometry\":{\"type\":\"MultiPolygon\",\"coordinates\":[[[[9.805151976237221,53.56389856394301],[9.805228354115075,53.56389265651229],[9.805376979093932,53.56388117493709],[9.80539691039598,53.56387963848051],[9.805421485829001,53.56404228779252],[9.805485852452774,53.56446827574004],[9.805492193590066,53.56451037269882],[9.80526023521814,53.56456874388791],[9.805151976237221,53.56389856394301]]]]}},\"predictions\":[{\"timestamp\":1704453252,\"event_type\":\"Überschwemmung\",\"geometry\":{\"type\":\"MultiPolygon\",\"coordinates\":[[[[9.805421485829001,53.56404228779252],[9.806024310264133,53.56401005625513],[9.806050355709857,53.56424989165918],[9.8060540327049,53.564283664904146],[9.806057767300466,53.56431808495685],[9.805485852452774,53.56446827574004],[9.805421485829001,53.56404228779252]]]]}},{\"timestamp\":1704453252,\"event_type\":\"Überschwemmung\",\"geometry\":{\"type\":\"MultiPolygon\",\"coordinates\":[[[[9.80526023521814,53.56456874388791],[9.80522374165269,53.56457751995856],[9.805171947235403,53.56458997656815],[9.805134114785455,53.56430405368117],[9.804926237927074,53.56431779436748],[9.8048943590149,53.56431990552546],[9.804856267158124,53.564322427021544],[9.804690417862597,53.56433338560875],[9.804654603060136,53.56433575688982],[9.804630286966155,53.564146849304926],[9.804769731736847,53.564141668491665],[9.804890588050366,53.5641371878819],[9.804904091898583,53.564136683529114],[9.804883074187845,53.56399590698324],[9.804862351828277,53.563857159920346],[9.805068685402073,53.563844957826184],[9.805077543092109,53.56390431441464],[9.805118282129287,53.56390207166073],[9.80511815938363,53.56390117360334],[9.805151976237221,53.56389856394301],[9.80526023521814,53.56456874388791]]]]}}]}"
@@ -26,41 +37,148 @@ def receive_data(verbose=True):
     if verbose: print(f'Event with type {event["event_type"]} at {event["timestamp"]}')#
     if verbose: print(f'With {len(predictions)} Predictions')
 
+    # set ASYNC_DB=true to save the data with the async database layer, see save_event_async()
+    if ASYNC_DB:
+        return jsonify(run_coroutine(save_event_async(event, predictions, verbose)))
+
     # connect to the database
-    engine, session = autoconnect_db()
-
-    # find the layer and style with the names 'Events'
-    # TODO: later this should be replaced with a query to find the layer and style with the same name as the event_type
-    # find the FeatureSet for event and predictions
-    # they have the name "Event" and "Prediction"
-    db_feature_set_event = session.query(FeatureSet).filter(FeatureSet.name == 'Events').first()
-    db_feature_set_prediction = session.query(FeatureSet).filter(FeatureSet.name == 'Predictions').first()
-    db_layer_events = session.query(Layer).filter(Layer.name == 'Events').first()
-    db_layer_predictions = session.query(Layer).filter(Layer.name == 'Predictions').first()
-    db_style_events = session.query(Style).filter(Style.name == 'Events').first()
-    db_style_predictions = session.query(Style).filter(Style.name == 'Predictions').first()
-
-
-    if db_layer_events is None:
-        if verbose: print('No Layer with name "Events" found!')
-        return jsonify({'status': 'error', 'message': 'Internal Server Error: No Layer with name "Events" found'})
-
-    if db_layer_predictions is None:
-        if verbose: print('No Layer with name "Predictions" found!')
-        return jsonify({'status': 'error', 'message': 'Internal Server Error: No Layer with name "Predictions" found'})
+    with session_scope() as session:
+
+        # find the layer and style with the names 'Events'
+        # TODO: later this should be replaced with a query to find the layer and style with the same name as the event_type
+        # find the FeatureSet for event and predictions
+        # they have the name "Event" and "Prediction"
+        db_feature_set_event = session.query(FeatureSet).filter(FeatureSet.name == 'Events').first()
+        db_feature_set_prediction = session.query(FeatureSet).filter(FeatureSet.name == 'Predictions').first()
+        db_layer_events = session.query(Layer).filter(Layer.name == 'Events').first()
+        db_layer_predictions = session.query(Layer).filter(Layer.name == 'Predictions').first()
+        db_style_events = session.query(Style).filter(Style.name == 'Events').first()
+        db_style_predictions = session.query(Style).filter(Style.name == 'Predictions').first()
+
+
+        if db_layer_events is None:
+            if verbose: print('No Layer with name "Events" found!')
+            return jsonify({'status': 'error', 'message': 'Internal Server Error: No Layer with name "Events" found'})
+
+        if db_layer_predictions is None:
+            if verbose: print('No Layer with name "Predictions" found!')
+            return jsonify({'status': 'error', 'message': 'Internal Server Error: No Layer with name "Predictions" found'})
     
-    if db_style_events is None:
-        if verbose: print('No Style with name "Events" found!')
-        return jsonify({'status': 'error', 'message': 'Internal Server Error: No Style with name "Events" found'})
+        if db_style_events is None:
+            if verbose: print('No Style with name "Events" found!')
+            return jsonify({'status': 'error', 'message': 'Internal Server Error: No Style with name "Events" found'})
     
-    if db_style_predictions is None:
-        if verbose: print('No Style with name "Predictions" found!')
-        return jsonify({'status': 'error', 'message': 'Internal Server Error: No Style with name "Predictions" found'})
+        if db_style_predictions is None:
+            if verbose: print('No Style with name "Predictions" found!')
+            return jsonify({'status': 'error', 'message': 'Internal Server Error: No Style with name "Predictions" found'})
 
     
     
-    # Convert JSON data to database objects
-    if verbose: print('Creating Features from Event and Predictions...', end='')
+        # Convert JSON data to database objects
+        if verbose: print('Creating Features from Event and Predictions...', end='')
+        db_event, db_predictions = build_event_features(event, predictions)
+
+        # check if all objects are valid
+        if db_event is None:
+            if verbose: print('Invalid event data!')
+            return jsonify({'status': 'error', 'message': 'Invalid event data'})
+    
+        if None in db_predictions:
+            if verbose: print('One or more invalid prediction entries!')
+            return jsonify({'status': 'error', 'message': 'One or more invalid prediction entries'})
+    
+        # set the events and predictions FeatureSets
+        db_event.feature_set = db_feature_set_event
+        for prediction in db_predictions:
+            prediction.feature_set = db_feature_set_prediction
+    
+        if verbose: print('Done')
+    
+        # save the event and predictions to the database
+        if verbose: print('Saving Event and Predictions to database...', end='')
+        session.add(db_event)
+        session.add_all(db_predictions)
+
+        # the payloads of both FeatureSets are outdated now, see data/payloads.py
+        # they are built again on their next request (get_payload()), not here, so a request does not cost O(all events)
+        changed = [feature_set.id for feature_set in (db_feature_set_event, db_feature_set_prediction) if feature_set is not None]
+        invalidate_payloads(session, changed)
+        session.commit()
+        if verbose: print('Done')
+
+    # return jsonify(data)
+    if verbose: print("Success! Returning {'status': 'success'}")
+    return jsonify({'status': 'success'})
+
+async def save_event_async(event: dict, predictions: list, verbose=True) -> dict:
+    """
+    Async variant of the database part of `receive_data()`, returns the response as a dict.
+    Runs on the background loop of `data.connect_async`, so the requests of all Flask threads share one async connection pool.
+    The Events and Predictions rows are looked up with one query per table instead of two.
+    """
+
+    async with async_session_scope() as session:
+
+        names = ['Events', 'Predictions']
+
+        # find the FeatureSets, Layers and Styles with the names 'Events' and 'Predictions'
+        # TODO: later this should be replaced with a query to find the layer and style with the same name as the event_type
+        feature_sets = {row.name: row for row in (await session.execute(select(FeatureSet).filter(FeatureSet.name.in_(names)))).scalars()}
+        layers = {row.name: row for row in (await session.execute(select(Layer).filter(Layer.name.in_(names)))).scalars()}
+        styles = {row.name: row for row in (await session.execute(select(Style).filter(Style.name.in_(names)))).scalars()}
+
+        for name in names:
+            if name not in layers:
+                if verbose: print(f'No Layer with name "{name}" found!')
+                return {'status': 'error', 'message': f'Internal Server Error: No Layer with name "{name}" found'}
+
+        for name in names:
+            if name not in styles:
+                if verbose: print(f'No Style with name "{name}" found!')
+                return {'status': 'error', 'message': f'Internal Server Error: No Style with name "{name}" found'}
+
+        # Convert JSON data to database objects
+        if verbose: print('Creating Features from Event and Predictions...', end='')
+        db_event, db_predictions = build_event_features(event, predictions)
+
+        # check if all objects are valid
+        if db_event is None:
+            if verbose: print('Invalid event data!')
+            return {'status': 'error', 'message': 'Invalid event data'}
+
+        if None in db_predictions:
+            if verbose: print('One or more invalid prediction entries!')
+            return {'status': 'error', 'message': 'One or more invalid prediction entries'}
+
+        # set the events and predictions FeatureSets
+        # assign the ids, setting the relationship would load FeatureSet.features, which can't happen implicitly in async code
+        db_event.feature_set_id = feature_sets['Events'].id if 'Events' in feature_sets else None
+        for prediction in db_predictions:
+            prediction.feature_set_id = feature_sets['Predictions'].id if 'Predictions' in feature_sets else None
+
+        if verbose: print('Done')
+
+        # save the event and predictions to the database
+        if verbose: print('Saving Event and Predictions to database...', end='')
+        session.add(db_event)
+        session.add_all(db_predictions)
+
+        # the payloads of both FeatureSets are outdated now, the map builds them again on the next request (see data/payloads.py)
+        changed = [feature_set.id for feature_set in feature_sets.values()]
+        if changed:
+            await session.execute(update(FeatureSet).filter(FeatureSet.id.in_(changed)).values(data_version=FeatureSet.data_version + 1))
+            await session.execute(delete(FeatureSetPayload).filter(FeatureSetPayload.feature_set_id.in_(changed)))
+        await session.commit()
+        if verbose: print('Done')
+
+    if verbose: print("Success! Returning {'status': 'success'}")
+    return {'status': 'success'}
+
+def build_event_features(event: dict, predictions: list) -> tuple:
+    """
+    Create the Feature objects for an event and its predictions.
+    Returns `(db_event, db_predictions)`, invalid entries are None.
+    """
 
     # prepare the event data
     event_type = event['event_type']
@@ -110,38 +228,11 @@ def receive_data(verbose=True):
         # create a Feature object from the prediction
         db_predictions.append(feature_to_obj(prediction))
 
-    # check if all objects are valid
-    if db_event is None:
-        if verbose: print('Invalid event data!')
-        return jsonify({'status': 'error', 'message': 'Invalid event data'})
-    
-    if None in db_predictions:
-        if verbose: print('One or more invalid prediction entries!')
-        return jsonify({'status': 'error', 'message': 'One or more invalid prediction entries'})
-    
-    # set the events and predictions FeatureSets
-    db_event.feature_set = db_feature_set_event
-    for prediction in db_predictions:
-        prediction.feature_set = db_feature_set_prediction
-    
-    if verbose: print('Done')
-    
-    # save the event and predictions to the database
-    if verbose: print('Saving Event and Predictions to database...', end='')
-    session.add(db_event)
-    session.add_all(db_predictions)
-    session.commit()
-    if verbose: print('Done')
-
-    # close the session
-    if verbose: print('Closing database connection...', end='')
-    session.close()
-    engine.dispose()
-    if verbose: print('Done')
+    return db_event, db_predictions
 
-    # return jsonify(data)
-    if verbose: print("Success! Returning {'status': 'success'}")
-    return jsonify({'status': 'success'})
+@app.route('/pool-status', methods=['GET'])
+def route_pool_status():
+    return jsonify(pool_status())
 
 def hash_event(event):
     return f'{event["timestamp"]}_{event["event_type"]}'
@@ -1,14 +1,49 @@
 # Launches the nina server
 # This script requests the nina api for alerts every 60 seconds and saves them to the database
 
+import asyncio
+from os import getenv
 from time import sleep
-from data.req_nina import save_alerts
+from dotenv import load_dotenv
+from data.req_nina import save_alerts, save_alerts_async
+
+def print_alerts(alerts):
+    n_alerts = len(alerts)
+
+    if n_alerts > 1:
+        print(f'Saved {n_alerts} new alerts')
+    elif n_alerts == 1:
+        print(f'Saved 1 new alert')
+    else:
+        print('No new alerts')
+
+async def run_async(refresh_rate, verbose=True):
+    """
+    Async variant of the main loop, see `save_alerts_async()`.
+    """
+
+    while True:
+
+        if verbose:
+            print('Requesting... ', end='')
+
+        alerts = await save_alerts_async()
+
+        if verbose:
+            print_alerts(alerts)
+
+        await asyncio.sleep(refresh_rate)
 
 if __name__ == '__main__':
 
     VERBOSE = True
     REFRESH_RATE = 3600   # in seconds
 
+    load_dotenv()
+
+    # set ASYNC_DB=true to use the async database layer
+    ASYNC_DB = getenv('ASYNC_DB', 'false').lower() in ('1', 'true', 'yes')
+
     if VERBOSE:
         print("=========================")
         print('Starting Nina Server.')
@@ -16,20 +51,17 @@ if __name__ == '__main__':
         print('Press Ctrl+C to stop')
         print("=========================")
 
+    if ASYNC_DB:
+        asyncio.run(run_async(REFRESH_RATE, VERBOSE))
+
     while True:
 
         if VERBOSE:
             print('Requesting... ', end='')
 
         alerts = save_alerts()
-        n_alerts = len(alerts)
 
         if VERBOSE:
-            if n_alerts > 1:
-                print(f'Saved {n_alerts} new alerts')
-            elif n_alerts == 1:
-                print(f'Saved 1 new alert')
-            else:
-                print('No new alerts')
+            print_alerts(alerts)
 
         sleep(REFRESH_RATE)
\ No newline at end of file
@@ -1,6 +1,7 @@
 import os
 from collections import defaultdict
 
+import asyncio
 import requests
 import time
 from datetime import datetime, timedelta
@@ -8,12 +9,20 @@ from datetime import datetime, timedelta
 from shapely import polygonize, GeometryCollection, LineString, wkt
 from shapely.geometry import mapping
 from SPARQLWrapper import SPARQLWrapper
-from data.connect import autoconnect_db
+from dotenv import load_dotenv
+from sqlalchemy import select
+from data.connect import session_scope
+from data.connect_async import async_session_scope
 from data.model import Report
+from data.report_locations import location_rows
+from data.partitions import maintain_partitions
 
 import random   # can be removed later
 
 
+# the settings below are read on import, load them from .env first
+load_dotenv()
+
 SPARQL_ENDPOINT = os.getenv('SPARQL_ENDPOINT', '')
 if not SPARQL_ENDPOINT:
     raise ValueError("SPARQL_ENDPOINT environment variable is not set.")
@@ -30,6 +39,12 @@ TIMEOUT_DELAY = 300            # 5 minutes
 # set to True to print more information
 VERBOSE = True
 
+# how often the report partitions are created and archived (in seconds), see data/partitions.py
+PARTITION_MAINTENANCE_INTERVAL = 3600
+
+# set to True to use the async database layer, see run_async()
+ASYNC_DB = os.getenv('ASYNC_DB', 'false').lower() in ('1', 'true', 'yes')
+
 # user agent for the requests
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
 
@@ -245,83 +260,192 @@ relevance_mapping = {
     'http://rescue-mate.de/resource/none': 'none',
 }
 
+def post_to_report(json_post: dict) -> Report:
+    """Convert a post, as returned by fetch_social_media_posts(), into a Report database object"""
+
+    # get the post identifier
+    # this is the id the respective platform uses to identify the post
+    identifier = json_post['id']
+
+    entities = json_post.get('geo_linked_entities', [])
+    locations = [{
+        "lon": entity["location"]["lon"],
+        "lat": entity["location"]["lat"],
+        "name": entity["location"]["name"],
+        "boundingbox": None,
+        "osm_type": entity["location"]["osm_type"],
+        "osm_id": entity["location"]["osm_id"],
+        "polygon": entity["location"]["polygon"],
+        "mention": entity["mention"]
+    } if (entity["location"] is not None and "osm_id" in entity["location"]) else {"mention": entity["mention"]} for entity in entities ]
+
+    # convert the time field into a datetime object
+    timestamp = datetime.fromisoformat(json_post['timestamp'])
+
+    platform = json_post['platform']
+
+    text_field_key = TEXT_FIELD[platform]
+    text = json_post[text_field_key]
+
+    # special formatting for RSS feeds
+    # i.e. instead of 'rss', save 'rss/ndr'
+    if platform == 'rss':
+        platform = f'rss/{json_post["feed"]}'
+
+
+    if json_post['event_type'] == 'http://rescue-mate.de/resource/not_humanitarian':
+        json_post['relevance'] = 'http://rescue-mate.de/resource/none'
+
+
+    # create a new post object
+    report = Report(
+        identifier=identifier,
+        text=text,
+        url=json_post['url'],
+        platform=platform,
+        timestamp=timestamp,
+        relevance=relevance_mapping[json_post['relevance']],
+        event_type=event_mapping[json_post['event_type']],
+        locations=locations,
+        original_locations=locations,
+        author=json_post.get('author', ''),
+        seen=False,
+        author_flagged=False)
+
+    return report
+
 def save_posts(posts: list):
     """Save the posts to the database"""
 
-    engine, session = autoconnect_db()
+    with session_scope() as session:
 
-    # count how many posts were saved
-    counter = 0
+        # count how many posts were saved
+        counter = 0
+        reports = []
 
-    for json_post in posts:
+        for json_post in posts:
 
-        # get the post identifier
-        # this is the id the respective platform uses to identify the post
-        identifier = json_post['id']
+            # check if the post already exists
+            existing_post = session.query(Report).filter(Report.identifier == json_post['id']).first()
 
-        entities = json_post.get('geo_linked_entities', [])
-        locations = [{
-            "lon": entity["location"]["lon"],
-            "lat": entity["location"]["lat"],
-            "name": entity["location"]["name"],
-            "boundingbox": None,
-            "osm_type": entity["location"]["osm_type"],
-            "osm_id": entity["location"]["osm_id"],
-            "polygon": entity["location"]["polygon"],
-            "mention": entity["mention"]
-        } if (entity["location"] is not None and "osm_id" in entity["location"]) else {"mention": entity["mention"]} for entity in entities ]
+            # skip if the post already exists
+            if existing_post:
+                continue
 
-        # check if the post already exists
-        existing_post = session.query(Report).filter(Report.identifier == identifier).first()
+            # add the post to the session
+            report = post_to_report(json_post)
+            session.add(report)
+            reports.append(report)
 
-        # skip if the post already exists
-        if existing_post:
-            continue
+            counter += 1
+
+        # assign the report ids, then add the normalized locations
+        session.flush()
+        for report in reports:
+            session.add_all(location_rows(report.id, report.locations))
+
+        # commit the session
+        session.commit()
+
+    return counter
 
-        # convert the time field into a datetime object
-        timestamp = datetime.fromisoformat(json_post['timestamp'])
+async def save_posts_async(posts: list):
+    """
+    Async variant of save_posts().
+    Instead of one lookup per post, the existing identifiers of the whole batch are fetched with a single query.
+    """
 
-        platform = json_post['platform']
+    posts = list(posts)
 
-        text_field_key = TEXT_FIELD[platform]
-        text = json_post[text_field_key]
+    async with async_session_scope() as session:
 
-        # special formatting for RSS feeds
-        # i.e. instead of 'rss', save 'rss/ndr'
-        if platform == 'rss':
-            platform = f'rss/{json_post["feed"]}'
+        # get all identifiers of this batch that are already in the database
+        identifiers = [json_post['id'] for json_post in posts]
+        result = await session.execute(select(Report.identifier).where(Report.identifier.in_(identifiers)))
+        existing_identifiers = set(result.scalars().all())
 
+        # count how many posts were saved
+        counter = 0
+        reports = []
 
-        if json_post['event_type'] == 'http://rescue-mate.de/resource/not_humanitarian':
-            json_post['relevance'] = 'http://rescue-mate.de/resource/none'
+        for json_post in posts:
 
+            # skip if the post already exists
+            if json_post['id'] in existing_identifiers:
+                continue
 
-        # create a new post object
-        report = Report(
-            identifier=identifier,
-            text=text,
-            url=json_post['url'],
-            platform=platform,
-            timestamp=timestamp,
-            relevance=relevance_mapping[json_post['relevance']],
-            event_type=event_mapping[json_post['event_type']],
-            locations=locations,
-            original_locations=locations,
-            author=json_post.get('author', ''),
-            seen=False,
-            author_flagged=False)
+            report = post_to_report(json_post)
+            session.add(report)
+            reports.append(report)
+            existing_identifiers.add(json_post['id'])
 
-        # add the post to the session
-        session.add(report)
+            counter += 1
 
-        counter += 1
+        # assign the report ids, then add the normalized locations
+        await session.flush()
+        for report in reports:
+            session.add_all(location_rows(report.id, report.locations))
 
-    # commit and close the session
-    session.commit()
-    session.close()
+        await session.commit()
 
     return counter
 
+def prepare_posts(posts: list):
+    """Use the geometry of the linked OSM entity as the polygon of each location"""
+
+    for post in posts:
+        for location in post["geo_linked_entities"]:
+            if location["location"] is not None:
+                osm_id = location["location"]["osm_id"]
+                osm_type = location["location"]["osm_type"]
+                # polygon = fetch_osm_polygon(osm_type, osm_id)
+                location["location"]["polygon"] = location["location"]["geojson"]
+
+def maintain_report_partitions():
+    """
+    Create the upcoming partitions of the reports and archive the ones outside of the retention period (`REPORT_RETENTION_DAYS`).
+    Errors are printed, the next call tries again.
+    """
+
+    try:
+        with session_scope() as session:
+            maintain_partitions(session, verbose=VERBOSE)
+    except Exception as e:
+        print(f"Error maintaining the report partitions: {e}")
+
+async def run_async(search_since: datetime):
+    """
+    Async variant of the main loop.
+    The posts of one cycle are written to the database while the server already waits for and fetches the next cycle.
+    Writes stay sequential, so the duplicate check of a batch always sees the posts of the previous one.
+    """
+
+    write_task = None
+    last_maintenance = 0
+
+    while True:
+        if time.time() - last_maintenance > PARTITION_MAINTENANCE_INTERVAL:
+            await asyncio.to_thread(maintain_report_partitions)
+            last_maintenance = time.time()
+
+        try:
+            # SPARQLWrapper is blocking, run it in a worker thread so the pending write can progress
+            posts = await asyncio.to_thread(fetch_social_media_posts, search_since)
+        except Exception as e:
+            print(f"Error fetching posts, retrying in next cycle: {e}")
+            posts = []
+            await asyncio.sleep(10)
+
+        prepare_posts(posts)
+
+        # wait for the previous write before starting the next one
+        if write_task is not None:
+            await write_task
+
+        write_task = asyncio.create_task(save_posts_async(posts))
+
+        await asyncio.sleep(REQUEST_DELAY)
+
 def classify_post(json_post: dict) -> str:
 
     # TODO: connect to classifier when ready
@@ -425,7 +549,18 @@ if __name__ == '__main__':
     #time.sleep(30)
     start_date = datetime.now()
     search_since = start_date - timedelta(minutes=SEARCH_LOOK_BACK)
+
+    # set ASYNC_DB=true to overlap fetching and saving, see run_async()
+    if ASYNC_DB:
+        asyncio.run(run_async(search_since))
+
+    last_maintenance = 0
+
     while True:
+        if time.time() - last_maintenance > PARTITION_MAINTENANCE_INTERVAL:
+            maintain_report_partitions()
+            last_maintenance = time.time()
+
         try:
             posts = fetch_social_media_posts(search_since)
         except Exception as e:
@@ -433,13 +568,7 @@ if __name__ == '__main__':
             posts = []
             time.sleep(10)
 
-        for post in posts:
-            for location in post["geo_linked_entities"]:
-                if location["location"] is not None:
-                    osm_id = location["location"]["osm_id"]
-                    osm_type = location["location"]["osm_type"]
-                    # polygon = fetch_osm_polygon(osm_type, osm_id)
-                    location["location"]["polygon"] = location["location"]["geojson"]
+        prepare_posts(posts)
 
         saved_counter = save_posts(posts)
         # if VERBOSE: print(f'Saved {saved_counter} posts', flush=True)